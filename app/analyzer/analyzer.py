@@ -1,20 +1,124 @@
 """
 PDFフォルダ内のファイルを読み込み、
 文章を分割 → Embedding → FAISSへ登録する
+（各段階の並列実行は pipeline.py を参照）
+
+ファイル内容のハッシュで差分を判定し、
+新規・更新されたPDFだけを処理する（削除されたPDFのベクトルは取り除く）
 """
 
 import os
-from app.analyzer.file_loader import load_pdf
-from app.analyzer.text_splitter import split_text_with_overlap
-from app.analyzer.embedder import get_embedding
-from app.analyzer.index_manager import add_vector, index
+import threading
+import time
+from app.analyzer.file_loader import file_sha256
+from app.analyzer.pipeline import IngestJob, run_pipeline
+from app.analyzer import index_manager, leader_lock
+from app.analyzer.index_manager import replace_document, remove_documents, load_index, save_index, update_manifest
+from app.analyzer.doc_filter import document_attributes
+from app.core.metrics import INGEST_STAGE_SECONDS
 
 # ファイルのメタ情報読み取り用
-from app.db.documents_store import add_document_record
+from app.db import documents_store
+from app.db.documents_store import add_document_record, build_document_record, delete_document_record
 from datetime import datetime, timezone
 
+# 文書レコード・チャンクの保存先
+# - json  : documents_store.py（追記型のJSONLファイル）
+# - mysql : bulk_repository.py（documents / chunks テーブルにまとめて書き込む）
+DOCUMENT_STORE = os.getenv("DOCUMENT_STORE", "json").lower()
+
+# 抽出・分割・Embedding の処理内容を変えたら上げる
+# （上げると、内容が同じPDFも次回起動時に処理し直される）
+PIPELINE_VERSION = 1
+
+# 複数ワーカー（uvicorn --workers N）で1つの index を共有する場合は true にする
+# INDEX_DIR のロックを取れた1ワーカー（リーダー）だけが取り込みとスナップショットの保存を行い、
+# ほかのワーカー（フォロワー）はスナップショットをメモリマップで開いて検索だけを行う
+# （メモリマップした index・メタ情報は OS のページキャッシュをワーカー間で共有する）
+# 共有できるのは FAISS のベクトル本体とメタ情報の行配列・本文だけで、hnsw のグラフ・
+# キーワード検索の索引・重複検出の指紋はワーカーごとにメモリへ読み込む
+# （実際の使用量は python -m app.bench.run の workers で測れる）
+INDEX_SHARED = os.getenv("INDEX_SHARED", "false").lower() == "true"
+
+# フォロワーが新しいスナップショットを確認する間隔（秒）
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "5"))
+
+# バックグラウンド取り込みの進捗（/ready で返す）
+# state: "idle" → "loading"（スナップショット読込中）→ "running" → "completed" / "failed"
+#        フォロワーは "following"（リーダーが保存したスナップショットを読み込んで使う）
+# role : "single"（1ワーカー）/ "leader" / "follower"
+ingest_status: dict = {
+    "state": "idle",
+    "role": "single",
+    "index_loaded": False,
+    "total": 0,
+    "processed": 0,
+    "started_at": None,
+    "finished_at": None,
+    "stats": None,
+    "error": None,
+}
+_status_lock = threading.Lock()
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+
+def _update_status(**kwargs) -> None:
+    with _status_lock:
+        ingest_status.update(kwargs)
+
+
+def get_ingest_status() -> dict:
+    """
+    取り込みの進捗をコピーして返す（pending = 未処理のPDF数）
+    """
+    with _status_lock:
+        status = dict(ingest_status)
+    status["pending"] = max(status["total"] - status["processed"], 0)
+    return status
+
+
+def _is_unchanged(doc_id: str, sha256: str) -> bool:
+    """
+    前回と同じ内容・同じパイプラインで登録済みかどうか
+    """
+    entry = index_manager.doc_manifest.get(doc_id)
+    return (
+        entry is not None
+        and entry.get("sha256") == sha256
+        and entry.get("pipeline_version") == PIPELINE_VERSION
+    )
+
+
+def analyze_files(file_dir: str) -> dict:
+    """
+    PDFフォルダを差分取り込みする
+
+    Returns
+    -------
+    dict
+        {"added": 件数, "updated": 件数, "skipped": 件数, "removed": 件数, "failed": 件数,
+         "chunks": チャンク数, "duplicate_chunks": 重複のため参照として登録したチャンク数, "dedup_ratio": その割合,
+         "skipped_pages" / "skipped_chunks": 品質が低いため取り込まなかったページ数・チャンク数}
+    """
+    stats = {
+        "added": 0, "updated": 0, "skipped": 0, "removed": 0, "failed": 0,
+        "chunks": 0, "duplicate_chunks": 0, "skipped_pages": 0, "skipped_chunks": 0,
+    }
+    # MySQL の場合、台帳（doc_manifest）への登録は MySQL に書き込めてから行う
+    # （書き込めなかった文書が台帳上は登録済みになり、次回以降スキップされないように）
+    # {doc_id: (台帳の内容, "added" / "updated")}
+    deferred: dict[str, tuple[dict, str]] = {}
+
+    def on_flushed(doc_ids: list[str]) -> None:
+        for doc_id in doc_ids:
+            if doc_id in deferred:
+                update_manifest(doc_id, deferred.pop(doc_id)[0])
+
+    writer = _open_mysql_writer(on_flushed) if DOCUMENT_STORE == "mysql" else None
 
-def analyze_files(file_dir: str):
     # PDFフォルダ内のPDF一覧を取得
     pdf_paths = [
         os.path.join(file_dir, f)
@@ -22,39 +126,210 @@ def analyze_files(file_dir: str):
         if f.lower().endswith(".pdf")
     ]
 
-    # 各PDFを処理
+    # フォルダから消えたPDFのベクトルを取り除く
+    # ドキュメントIDはファイル名（拡張子なし）で一意と仮定
+    current_doc_ids = {os.path.splitext(os.path.basename(p))[0] for p in pdf_paths}
+    removed_doc_ids = [d for d in index_manager.doc_manifest if d not in current_doc_ids]
+    if removed_doc_ids:
+        for doc_id in removed_doc_ids:
+            path = index_manager.doc_manifest[doc_id].get("path")
+            if writer is not None:
+                writer.remove(doc_id, path)
+            elif path:
+                delete_document_record(path)
+        removed = remove_documents(removed_doc_ids)
+        stats["removed"] = len(removed_doc_ids)
+        print(f"削除されたPDFのベクトルを取り除きました: {removed_doc_ids} (ベクトル数: {removed})")
+
+    _update_status(total=len(pdf_paths), processed=0)
+
+    # 内容が変わっていないPDFはスキップし、残りをパイプラインに流す
+    jobs: list[IngestJob] = []
     for pdf_path in pdf_paths:
-        # ドキュメントIDはファイル名（拡張子なし）で一意と仮定
         doc_id = os.path.splitext(os.path.basename(pdf_path))[0]
         try:
-            # PDF → ページ単位で読み込み   pages: list[dict]
-            pdf_data = load_pdf(pdf_path)
-            # 後で使うため独立変数化
-            pages = pdf_data["pages"]
-            # ★ load_pdf 完了直後に documents.json へ追記
-            add_document_record(pdf_path, pages_count=len(pages), summary=pdf_data["summary"], estimated_timestamp=pdf_data["estimated_timestamp"])
-
-            for page in pages:
-                # ページ文章をチャンク分割
-                chunks = split_text_with_overlap(page["text"])
-
-                for i, chunk in enumerate(chunks):
-                    # チャンクをEmbedding
-                    embedding = get_embedding(chunk)
-
-                    # FAISSへ登録
-                    add_vector(
-                        embedding,
-                        {
-                            "doc_id": doc_id,
-                            "page": page["page"],
-                            "chunk_id": i,
-                            "text": chunk,
-                        },
-                    )
+            sha256 = file_sha256(pdf_path)
         except Exception as e:
+            stats["failed"] += 1
             print(f"[ERROR] analyzer: PDFの処理に失敗しました: {pdf_path} エラー: {e}")
+            _mark_processed()
+            continue
+        if _is_unchanged(doc_id, sha256):
+            stats["skipped"] += 1
+            _mark_processed()
+            continue
+        jobs.append(IngestJob(
+            pdf_path=pdf_path,
+            doc_id=doc_id,
+            sha256=sha256,
+            is_update=doc_id in index_manager.doc_manifest,
+        ))
+
+    # 抽出・要約・Embedding は並列に進め、登録は完了した順に1件ずつ行う
+    run_pipeline(jobs, lambda job: _register(job, stats, writer, deferred))
+
+    # まとめてためていた文書レコードを書き出す
+    if writer is not None:
+        try:
+            writer.close()
+        except Exception as e:
+            # 書き込めなかった文書は台帳に載せず、失敗として数える（次回の取り込みで処理し直す）
+            failed = [d for d in writer.pending_doc_ids() if d in deferred]
+            kinds = {doc_id: deferred.pop(doc_id)[1] for doc_id in failed}
+            for kind in kinds.values():
+                stats[kind] -= 1
+            stats["failed"] += len(failed)
+            # 新規の文書は台帳に無いので、index からも外しておく（更新の場合は次回の取り込みで入れ替わる）
+            remove_documents([d for d, kind in kinds.items() if kind == "added"])
+            print(f"[ERROR] analyzer: MySQLへの書き込みに失敗しました: {failed} エラー: {e}")
+        print(f"MySQLへの書き込み回数（トランザクション数）: {writer.transactions}")
+    else:
+        documents_store.flush()
+
+    stats["dedup_ratio"] = round(stats["duplicate_chunks"] / stats["chunks"], 4) if stats["chunks"] else 0.0
+    print(f"差分取り込み結果: {stats}")
+    return stats
+
+
+def _mark_processed() -> None:
+    with _status_lock:
+        ingest_status["processed"] += 1
+
+
+def _open_mysql_writer(on_flushed):
+    # MySQL の接続情報が無い環境でも JSON で動くよう、使うときだけ import する
+    from app.db.connect_MySQL import engine_documents, engine_chunks
+    from app.db.bulk_repository import BulkDocumentWriter
+
+    return BulkDocumentWriter(engine_documents, engine_chunks, on_flushed=on_flushed)
+
+
+def _register(job: IngestJob, stats: dict, writer=None, deferred: dict | None = None) -> None:
+    """
+    パイプラインを通ったPDF1件を登録する（失敗してもほかのPDFの処理は続ける）
+
+    writer（MySQL）を使う場合、台帳への登録は deferred に入れておき、MySQL に書き込めたときに行う
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        if job.error is not None:
+            raise job.error
+
+        # ★ 抽出・要約の完了後に文書レコードを保存（MySQL の場合はチャンクも一緒に、まとめて書き込む）
+        # ページ数は、品質が低いため飛ばしたページも含める
+        record_args = dict(
+            pages_count=len(job.pages) + len(job.skipped_pages),
+            summary=job.summary,
+            estimated_timestamp=job.estimated_timestamp,
+            sha256=job.sha256,
+            skipped_pages=job.skipped_pages,
+            skipped_chunks=job.skipped_chunks,
+        )
+        if writer is not None:
+            record = build_document_record(job.pdf_path, **record_args)
+        else:
+            record = add_document_record(job.pdf_path, **record_args)
+
+        # 新しいベクトルが揃ってから、古いベクトルと入れ替えて登録する
+        # （途中で失敗しても古い内容で検索できるようにするため。新規の場合は追加のみ）
+        replace_document(job.doc_id, job.embeddings, job.metas, job.fingerprints, job.duplicates)
+        entry = {
+            "sha256": job.sha256,
+            "pipeline_version": PIPELINE_VERSION,
+            "path": job.pdf_path,
+            # 検索の絞り込み用（doc_filter.py）
+            **document_attributes(record),
+        }
+        kind = "updated" if job.is_update else "added"
+        if writer is not None:
+            deferred[job.doc_id] = (entry, kind)
+            # chunks テーブルには重複チャンクも含めて、文書のすべてのチャンクを書き込む
+            writer.add(record, job.doc_id, job.metas + [meta for meta, _ in job.duplicates])
+        else:
+            update_manifest(job.doc_id, entry)
+        stats[kind] += 1
+        # 取り込み中にほかの文書と重複していたチャンクも、登録時に参照にまとめられる
+        n_chunks = len(job.metas) + len(job.duplicates)
+        stats["chunks"] += n_chunks
+        stats["duplicate_chunks"] += n_chunks - len(index_manager.meta_data.ids_of_docs([job.doc_id]))
+        stats["skipped_pages"] += len(job.skipped_pages)
+        stats["skipped_chunks"] += job.skipped_chunks
+        outcome = "ok"
+    except Exception as e:
+        stats["failed"] += 1
+        print(f"[ERROR] analyzer: PDFの処理に失敗しました: {job.pdf_path} エラー: {e}")
+    finally:
+        _mark_processed()
+        # 前の段階で失敗した PDF は登録していないので、処理時間は記録しない
+        if job.error is None:
+            INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="register", outcome=outcome)
+
+    # 登録結果を表示
+    print(f"FAISS登録済みベクトル数: {len(index_manager.meta_data)}")
+
+
+def run_ingest(file_dir: str) -> None:
+    """
+    スナップショットの読み込み → 差分取り込み → スナップショット保存 を順に行う
+    """
+    _update_status(state="loading", started_at=_now_iso(), finished_at=None, error=None)
+    try:
+        load_index()
+        _update_status(state="running", index_loaded=True)
+
+        stats = analyze_files(file_dir)
+        if stats["added"] or stats["updated"] or stats["removed"]:
+            save_index()
+            if INDEX_SHARED:
+                # 書き込み用に読み込んだ index を手放し、フォロワーと同じメモリマップに切り替える
+                load_index()
+        _update_status(state="completed", stats=stats, finished_at=_now_iso())
+    except Exception as e:
+        print(f"[ERROR] analyzer: 取り込みに失敗しました: {file_dir} エラー: {e}")
+        _update_status(state="failed", index_loaded=True, error=str(e), finished_at=_now_iso())
+
+
+def _reload_if_updated() -> None:
+    """
+    リーダーが新しいスナップショットを保存していれば読み込む
+    """
+    name = index_manager.current_snapshot_name()
+    if name is None or name == index_manager.loaded_snapshot:
+        return
+    if load_index():
+        _update_status(index_loaded=True, finished_at=_now_iso())
+
+
+def run_shared(file_dir: str) -> None:
+    """
+    複数ワーカーで index を共有する場合の処理
+
+    リーダーになれたら run_ingest を行う。なれなかったらフォロワーとして、
+    新しいスナップショットを INDEX_RELOAD_INTERVAL 秒ごとに確認して読み込む
+    （再起動せずに反映される）。リーダーのワーカーが終了したら、フォロワーのどれかが引き継ぐ。
+    """
+    if not leader_lock.try_acquire(index_manager.INDEX_DIR):
+        _update_status(state="following", role="follower", started_at=_now_iso(), error=None)
+        while not leader_lock.try_acquire(index_manager.INDEX_DIR):
+            try:
+                _reload_if_updated()
+            except Exception as e:
+                print(f"[ERROR] analyzer: スナップショットの再読み込みに失敗しました エラー: {e}")
+            time.sleep(INDEX_RELOAD_INTERVAL)
+        print(f"[WARN] analyzer: リーダーが不在のため、取り込みを引き継ぎます (pid: {os.getpid()})")
+
+    _update_status(role="leader")
+    run_ingest(file_dir)
 
-        # 登録結果を表示
-        print(f"FAISS登録済みベクトル数: {index.ntotal}")
 
+def start_background_ingest(file_dir: str) -> threading.Thread:
+    """
+    run_ingest を別スレッドで開始する（API の起動を待たせないため）
+    取り込み中も、登録済みの分だけで検索に答えられる
+    INDEX_SHARED=true の場合は run_shared を開始する
+    """
+    target = run_shared if INDEX_SHARED else run_ingest
+    thread = threading.Thread(target=target, args=(file_dir,), name="ingest", daemon=True)
+    thread.start()
+    return thread
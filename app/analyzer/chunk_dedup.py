@@ -0,0 +1,265 @@
+"""
+チャンクの重複検出（完全一致 ＋ SimHash による近似重複）
+
+社内のPDFには、ヘッダー・フッター・機密表示・テンプレートの定型文が
+同じ文書の各ページや別の文書に何度も出てくる。すべてを Embedding して index に入れると、
+API の呼び出しと index のメモリが無駄になり、検索結果の上位も同じ文章で埋まってしまう。
+
+そこで重複したチャンクは1つだけ index に入れ（代表チャンク）、
+ほかの出現箇所 (doc_id, page, chunk_id) は代表チャンクの「参照」として持つ。
+
+- 完全一致 : 正規化した本文の 64bit ハッシュが同じ
+- 近似重複 : 文字 3-gram の SimHash（64bit）のハミング距離が CHUNK_DEDUP_DISTANCE 以下（既定では使わない）
+             64bit を 16bit ずつ4つに分けた表で候補を探す
+             （距離が 3 以下なら、4つのうち少なくとも1つは完全に一致する）
+             参照になったチャンクは代表チャンクの本文で検索・回答されるため、
+             「月額1万円」と「月額2万円」のように数字だけ違うチャンクでも、代表の方の内容で答えてしまう。
+             本文の違いが許される定型文だけの PDF 群で使うこと
+
+代表チャンクのIDは index_manager のチャンクIDと同じ。index_manager のロックの中で更新・検索する。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from app.analyzer.lexical_index import normalize_text
+
+# 重複検出を使うか
+CHUNK_DEDUP_ENABLED = os.getenv("CHUNK_DEDUP_ENABLED", "true").lower() == "true"
+
+# 近似重複とみなす SimHash のハミング距離（0〜3。0 なら完全一致だけ）
+# 400文字のチャンクで金額が1文字違うだけだと距離は 1 になるので、既定は完全一致だけにする
+CHUNK_DEDUP_DISTANCE = min(int(os.getenv("CHUNK_DEDUP_DISTANCE", "0")), 3)
+
+# これより短いチャンクは近似重複を調べない（短い文は SimHash が偶然近くなりやすい）
+CHUNK_DEDUP_MIN_CHARS = int(os.getenv("CHUNK_DEDUP_MIN_CHARS", "64"))
+
+_BANDS = 4
+_BAND_BITS = 16
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+_FILE = "dedup.npz"
+
+# 3-gram のハッシュ用の定数（splitmix64）
+_P1 = np.uint64(0x9E3779B97F4A7C15)
+_P2 = np.uint64(0xC2B2AE3D27D4EB4F)
+_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_M2 = np.uint64(0x94D049BB133111EB)
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+
+# (完全一致ハッシュ, SimHash) の組。SimHash が None のチャンクは完全一致だけ調べる
+Fingerprint = tuple[int, int | None]
+
+
+def _simhash(text: str) -> int:
+    """
+    文字 3-gram の SimHash（プロセスをまたいでも同じ値になるよう、自前のハッシュを使う）
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    h = codes[:-2] * _P1 + codes[1:-1] * _P2 + codes[2:]
+    h ^= h >> np.uint64(30)
+    h *= _M1
+    h ^= h >> np.uint64(27)
+    h *= _M2
+    h ^= h >> np.uint64(31)
+    bits = (h[:, None] >> _BIT_SHIFTS) & np.uint64(1)
+    ones = bits.sum(axis=0)
+    value = 0
+    for i in np.flatnonzero(ones * 2 > len(h)):
+        value |= 1 << int(i)
+    return value
+
+
+def fingerprint(text: str) -> Fingerprint:
+    """
+    チャンク本文の指紋（完全一致ハッシュ, SimHash）を返す
+    """
+    normalized = normalize_text(text)
+    exact = int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "little")
+    if CHUNK_DEDUP_DISTANCE == 0 or len(normalized) < CHUNK_DEDUP_MIN_CHARS:
+        return exact, None
+    return exact, _simhash(normalized)
+
+
+def _bands(simhash: int) -> list[int]:
+    return [(simhash >> (i * _BAND_BITS)) & _BAND_MASK for i in range(_BANDS)]
+
+
+class ChunkDeduper:
+    """
+    代表チャンクの指紋と、ほかの出現箇所（参照）を持つ
+    """
+
+    def __init__(self):
+        self._exact: dict[int, int] = {}                # 完全一致ハッシュ → 代表チャンクID
+        self._fingerprints: dict[int, Fingerprint] = {}  # 代表チャンクID → 指紋
+        self._bands: list[dict[int, set[int]]] = [{} for _ in range(_BANDS)]
+        # 代表チャンクID → [(doc_id, page, chunk_id), ...]（代表チャンク自身は含まない）
+        self._refs: dict[int, list[tuple[str, int, int]]] = {}
+        # doc_id → その文書が参照している代表チャンクID
+        self._doc_refs: dict[str, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    @property
+    def ref_count(self) -> int:
+        return sum(len(refs) for refs in self._refs.values())
+
+    # ------------------------------
+    # 検索
+    # ------------------------------
+
+    def find(self, fp: Fingerprint, exclude=()) -> int | None:
+        """
+        指紋が重複する代表チャンクのIDを返す（無ければ None）
+        exclude に含まれる代表チャンクは候補にしない
+        """
+        exact, simhash = fp
+        uid = self._exact.get(exact)
+        if uid is not None and uid not in exclude:
+            return uid
+        # 近似重複を使わない設定なら、以前の設定で保存した SimHash があっても調べない
+        if simhash is None or CHUNK_DEDUP_DISTANCE == 0:
+            return None
+
+        # 距離が最も近いもの（同じ距離ならIDが小さいもの）
+        best = None
+        for table, key in zip(self._bands, _bands(simhash)):
+            for uid in table.get(key, ()):
+                if uid in exclude:
+                    continue
+                distance = (self._fingerprints[uid][1] ^ simhash).bit_count()
+                if distance <= CHUNK_DEDUP_DISTANCE and (best is None or (distance, uid) < best):
+                    best = (distance, uid)
+        return None if best is None else best[1]
+
+    def refs(self, uid: int) -> list[tuple[str, int, int]]:
+        return self._refs.get(uid, [])
+
+    def ids_referenced_by(self, doc_ids) -> np.ndarray:
+        """
+        指定した文書が参照している代表チャンクのID（昇順）
+        """
+        uids = {uid for doc_id in doc_ids for uid in self._doc_refs.get(doc_id, ())}
+        return np.array(sorted(uids), dtype="int64")
+
+    # ------------------------------
+    # 更新
+    # ------------------------------
+
+    def register(self, uid: int, fp: Fingerprint) -> None:
+        """
+        代表チャンクとして登録する（同じ完全一致ハッシュが既にあれば、先に登録した方を残す）
+        """
+        exact, simhash = fp
+        self._exact.setdefault(exact, uid)
+        self._fingerprints[uid] = fp
+        if simhash is not None:
+            for table, key in zip(self._bands, _bands(simhash)):
+                table.setdefault(key, set()).add(uid)
+
+    def add_ref(self, uid: int, doc_id: str, page: int, chunk_id: int) -> None:
+        self._refs.setdefault(uid, []).append((doc_id, page, chunk_id))
+        self._doc_refs.setdefault(doc_id, set()).add(uid)
+
+    def remove_refs_of_docs(self, doc_ids) -> int:
+        """
+        指定した文書からの参照を取り除く
+
+        Returns
+        -------
+        int
+            取り除いた参照の数
+        """
+        removed = 0
+        for doc_id in doc_ids:
+            for uid in self._doc_refs.pop(doc_id, ()):
+                refs = self._refs.get(uid)
+                if refs is None:
+                    continue
+                kept = [ref for ref in refs if ref[0] != doc_id]
+                removed += len(refs) - len(kept)
+                if kept:
+                    self._refs[uid] = kept
+                else:
+                    del self._refs[uid]
+        return removed
+
+    def unregister(self, uids) -> dict[int, tuple[Fingerprint, list[tuple[str, int, int]]]]:
+        """
+        代表チャンクの登録を取り消す
+
+        Returns
+        -------
+        dict
+            まだ参照が残っていた代表チャンクの {ID: (指紋, 参照)}
+            （呼び出し側で、参照のどれかを新しい代表チャンクにする）
+        """
+        orphans = {}
+        for uid in uids:
+            uid = int(uid)
+            fp = self._fingerprints.pop(uid, None)
+            if fp is None:
+                continue
+            exact, simhash = fp
+            if self._exact.get(exact) == uid:
+                del self._exact[exact]
+            if simhash is not None:
+                for table, key in zip(self._bands, _bands(simhash)):
+                    members = table.get(key)
+                    if members is not None:
+                        members.discard(uid)
+                        if not members:
+                            del table[key]
+            refs = self._refs.pop(uid, [])
+            for doc_id, _, _ in refs:
+                doc_refs = self._doc_refs.get(doc_id)
+                if doc_refs is not None:
+                    doc_refs.discard(uid)
+            if refs:
+                orphans[uid] = (fp, refs)
+        return orphans
+
+    # ------------------------------
+    # 保存・読み込み
+    # ------------------------------
+
+    def save(self, directory: Path) -> None:
+        uids = np.fromiter(self._fingerprints.keys(), dtype="int64", count=len(self._fingerprints))
+        fps = list(self._fingerprints.values())
+        refs = [(uid, *ref) for uid, uid_refs in self._refs.items() for ref in uid_refs]
+        docs = sorted({ref[1] for ref in refs})
+        doc_index = {doc_id: i for i, doc_id in enumerate(docs)}
+        np.savez(
+            Path(directory) / _FILE,
+            uids=uids,
+            exact=np.array([fp[0] for fp in fps], dtype="uint64"),
+            simhash=np.array([fp[1] or 0 for fp in fps], dtype="uint64"),
+            has_simhash=np.array([fp[1] is not None for fp in fps], dtype=bool),
+            ref_uids=np.array([r[0] for r in refs], dtype="int64"),
+            ref_docs=np.array([doc_index[r[1]] for r in refs], dtype="int32"),
+            ref_pages=np.array([r[2] for r in refs], dtype="int32"),
+            ref_chunks=np.array([r[3] for r in refs], dtype="int32"),
+            docs=np.array(docs, dtype=str),
+        )
+
+    @classmethod
+    def load(cls, directory: Path) -> "ChunkDeduper":
+        store = cls()
+        with np.load(Path(directory) / _FILE) as data:
+            for uid, exact, simhash, has_simhash in zip(
+                data["uids"].tolist(), data["exact"].tolist(), data["simhash"].tolist(), data["has_simhash"].tolist()
+            ):
+                store.register(uid, (exact, simhash if has_simhash else None))
+            docs = data["docs"].tolist()
+            for uid, doc, page, chunk_id in zip(
+                data["ref_uids"].tolist(), data["ref_docs"].tolist(), data["ref_pages"].tolist(), data["ref_chunks"].tolist()
+            ):
+                store.add_ref(uid, docs[doc], page, chunk_id)
+        return store
@@ -0,0 +1,116 @@
+"""
+検索の絞り込み条件（文書の属性によるフィルタ）
+
+「最新版だけ」「ある部署の文書だけ」「ある期間の文書だけ」に質問を限定するための条件。
+検索結果の上位k件を後から絞り込むと件数が足りなくなるので、
+index_manager で条件に合うチャンクIDだけを検索の対象にする（IDSelector）。
+
+文書の属性は doc_manifest（index_manager）の各文書に入れておく（document_attributes() を参照）。
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Iterable
+
+# 絞り込みに使う文書レコードの項目
+FILTER_ATTRIBUTES = ("is_latest", "content_type", "security_level", "department", "estimated_timestamp")
+
+
+def document_attributes(record: dict[str, Any]) -> dict[str, Any]:
+    """
+    文書レコードから、絞り込みに使う属性だけを取り出す
+    """
+    return {name: record.get(name) for name in FILTER_ATTRIBUTES}
+
+
+def _date_prefix(value: Any) -> str | None:
+    """
+    "2024-01-01" / "2024-01-01T00:00:00Z" などの先頭の日付部分（読めない値は None）
+    """
+    if not value:
+        return None
+    text = str(value)[:10]
+    try:
+        date.fromisoformat(text)
+    except ValueError:
+        return None
+    return text
+
+
+def _as_tuple(values: Iterable[str] | str | None) -> tuple[str, ...]:
+    if values is None:
+        return ()
+    if isinstance(values, str):
+        values = [values]
+    return tuple(sorted({v for v in values if v}))
+
+
+@dataclass(frozen=True)
+class DocFilter:
+    """
+    文書の絞り込み条件（空の項目は条件にしない。項目どうしは AND、項目内の値は OR）
+    """
+    doc_ids: tuple[str, ...] = ()
+    is_latest: bool | None = None
+    content_types: tuple[str, ...] = ()
+    security_levels: tuple[str, ...] = ()
+    departments: tuple[str, ...] = ()
+    date_from: str | None = None   # estimated_timestamp がこの日以降（YYYY-MM-DD）
+    date_to: str | None = None     # estimated_timestamp がこの日以前（YYYY-MM-DD）
+
+    @classmethod
+    def create(
+        cls,
+        doc_ids: Iterable[str] | str | None = None,
+        is_latest: bool | None = None,
+        content_types: Iterable[str] | str | None = None,
+        security_levels: Iterable[str] | str | None = None,
+        departments: Iterable[str] | str | None = None,
+        date_from: str | None = None,
+        date_to: str | None = None,
+    ) -> "DocFilter | None":
+        """
+        条件を作る（条件が1つも無い場合は None。日付が読めない場合は ValueError）
+        """
+        dates = []
+        for name, value in (("date_from", date_from), ("date_to", date_to)):
+            if value and _date_prefix(value) is None:
+                raise ValueError(f"{name} は YYYY-MM-DD 形式で指定してください: {value}")
+            dates.append(_date_prefix(value))
+
+        doc_filter = cls(
+            doc_ids=_as_tuple(doc_ids),
+            is_latest=is_latest,
+            content_types=_as_tuple(content_types),
+            security_levels=_as_tuple(security_levels),
+            departments=_as_tuple(departments),
+            date_from=dates[0],
+            date_to=dates[1],
+        )
+        return None if doc_filter == cls() else doc_filter
+
+    def matches(self, doc_id: str, attrs: dict[str, Any]) -> bool:
+        """
+        文書が条件に合うか（attrs は document_attributes() の形。属性の無い文書は is_latest=True とみなす）
+        """
+        if self.doc_ids and doc_id not in self.doc_ids:
+            return False
+        if self.is_latest is not None and bool(attrs.get("is_latest", True)) != self.is_latest:
+            return False
+        if self.content_types and attrs.get("content_type") not in self.content_types:
+            return False
+        if self.security_levels and attrs.get("security_level") not in self.security_levels:
+            return False
+        if self.departments and attrs.get("department") not in self.departments:
+            return False
+        if self.date_from or self.date_to:
+            day = _date_prefix(attrs.get("estimated_timestamp"))
+            if day is None:
+                return False
+            if self.date_from and day < self.date_from:
+                return False
+            if self.date_to and day > self.date_to:
+                return False
+        return True
@@ -1,14 +1,203 @@
+import asyncio
+import logging
+import os
+
 import numpy as np
-from app.core.clients import get_gemini_client
+from app.core.clients import call_upstream, call_upstream_async, get_gemini_client, get_async_gemini_client, is_retryable
+from app.core.tokens import estimate_tokens
+from app.analyzer.embedding_cache import TOUCH_BATCH_ITEMS, embedding_cache
+from app.core.metrics import (
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CALL_SECONDS, EMBEDDING_REQUEST_SECONDS, EMBEDDING_TEXTS_TOTAL, timed,
+)
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+
+# 1回の embed_content に載せる最大件数・最大文字数
+# （APIの上限を超えないように、環境変数で調整できるようにしておく）
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_BATCH_MAX_CHARS = int(os.getenv("EMBED_BATCH_MAX_CHARS", "60000"))
+
+
+def _embed_request(contents, kind: str):
+    """
+    embed_content を1回分呼ぶ（利用枠の待ち・再試行は call_upstream で行う。処理時間は1回ごとに記録する）
+    """
+    client_gemini = get_gemini_client()
+
+    def request():
+        with timed(EMBEDDING_REQUEST_SECONDS, model=EMBEDDING_MODEL, kind=kind):
+            return client_gemini.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=contents
+            )
+
+    texts = [contents] if isinstance(contents, str) else contents
+    return call_upstream("gemini", request, sum(estimate_tokens(t) for t in texts))
 
 
 def get_embedding(text: str) -> np.ndarray:
     """
     Gemini Embedding を取得して float32 の numpy配列で返す
+    （同じ文章はキャッシュから返す）
     """
-    client_gemini = get_gemini_client()
-    res = client_gemini.models.embed_content(
-        model="gemini-embedding-001",
-        contents=text
-    )
-    return np.array(res.embeddings[0].values, dtype="float32")
\ No newline at end of file
+    if embedding_cache is not None:
+        cached = embedding_cache.get(EMBEDDING_MODEL, text)
+        if cached is not None:
+            EMBEDDING_TEXTS_TOTAL.inc(model=EMBEDDING_MODEL, source="cache")
+            return cached
+
+    res = _embed_request(text, "single")
+    EMBEDDING_TEXTS_TOTAL.inc(model=EMBEDDING_MODEL, source="api")
+    embedding = np.array(res.embeddings[0].values, dtype="float32")
+
+    if embedding_cache is not None:
+        embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+async def get_embedding_async(text: str) -> np.ndarray:
+    """
+    get_embedding の非同期版（質問文のEmbedding用）
+    待ち時間中にイベントループを塞がないよう、非同期クライアントを使う
+    （キャッシュはメモリだけをその場で見て、SQLite の読み書きは別スレッドで行う）
+    """
+    if embedding_cache is not None:
+        cached = embedding_cache.get_memory(EMBEDDING_MODEL, text)
+        if cached is not None:
+            if embedding_cache.pending_touches() >= TOUCH_BATCH_ITEMS:
+                await asyncio.to_thread(embedding_cache.flush_touches)
+        else:
+            cached = await asyncio.to_thread(embedding_cache.get, EMBEDDING_MODEL, text)
+        if cached is not None:
+            EMBEDDING_TEXTS_TOTAL.inc(model=EMBEDDING_MODEL, source="cache")
+            return cached
+
+    client_gemini = get_async_gemini_client()
+
+    async def request():
+        with timed(EMBEDDING_REQUEST_SECONDS, model=EMBEDDING_MODEL, kind="single"):
+            return await client_gemini.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=text
+            )
+
+    res = await call_upstream_async("gemini", request, estimate_tokens(text))
+    EMBEDDING_TEXTS_TOTAL.inc(model=EMBEDDING_MODEL, source="api")
+    embedding = np.array(res.embeddings[0].values, dtype="float32")
+
+    if embedding_cache is not None:
+        await asyncio.to_thread(embedding_cache.put, EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+def _split_batches(texts: list[str], batch_size: int, max_chars: int) -> list[list[int]]:
+    """
+    texts のインデックスを、件数・文字数の上限に収まるバッチに分ける
+    """
+    batches: list[list[int]] = []
+    current: list[int] = []
+    current_chars = 0
+
+    for i, text in enumerate(texts):
+        if current and (len(current) >= batch_size or current_chars + len(text) > max_chars):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(i)
+        current_chars += len(text)
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _embed_batch(texts: list[str], ids: list[int], out: dict[int, np.ndarray]) -> None:
+    """
+    1バッチ分をEmbeddingして out[インデックス] に格納する
+
+    バッチ全体が失敗した場合は半分に分けて再試行し、
+    1件単位でも失敗したものだけを諦める（部分失敗の切り分け）
+    429・5xx などは call_upstream が再試行するので、それでも失敗した場合は例外を投げる
+    （文章の問題ではないので、諦めずに呼び出し元ごと失敗させ、次回の取り込みで再試行する）
+    """
+    EMBEDDING_BATCH_SIZE.observe(len(ids), model=EMBEDDING_MODEL)
+    try:
+        res = _embed_request([texts[i] for i in ids], "batch")
+        if len(res.embeddings) != len(ids):
+            raise ValueError(f"Embedding件数が一致しません: {len(res.embeddings)} != {len(ids)}")
+    except Exception as e:
+        if is_retryable(e):
+            EMBEDDING_TEXTS_TOTAL.inc(len(ids), model=EMBEDDING_MODEL, source="failed")
+            raise
+        if len(ids) == 1:
+            logging.error(f"Embeddingに失敗しました: index={ids[0]} エラー: {e}")
+            EMBEDDING_TEXTS_TOTAL.inc(len(ids), model=EMBEDDING_MODEL, source="failed")
+            return
+        mid = len(ids) // 2
+        _embed_batch(texts, ids[:mid], out)
+        _embed_batch(texts, ids[mid:], out)
+        return
+
+    for i, emb in zip(ids, res.embeddings):
+        out[i] = np.array(emb.values, dtype="float32")
+    EMBEDDING_TEXTS_TOTAL.inc(len(ids), model=EMBEDDING_MODEL, source="api")
+
+
+def get_embeddings(
+    texts: list[str],
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_chars: int = EMBED_BATCH_MAX_CHARS,
+) -> tuple[np.ndarray, list[int]]:
+    """
+    複数の文章をまとめて Gemini Embedding に送り、行列で返す
+
+    Returns
+    -------
+    embeddings : np.ndarray
+        成功した分のEmbedding（shape = (成功件数, 次元数), float32）
+    ok_ids : list[int]
+        embeddings の各行が texts の何番目に対応するか
+        （失敗した文章はここに含まれない。429・5xx などが再試行しても続いた場合は、
+          一部を落として返さずに例外を投げる）
+    """
+    with timed(EMBEDDING_CALL_SECONDS, model=EMBEDDING_MODEL):
+        return _get_embeddings(texts, batch_size, max_chars)
+
+
+def _get_embeddings(texts: list[str], batch_size: int, max_chars: int) -> tuple[np.ndarray, list[int]]:
+    # キャッシュにある分は API に送らない
+    out: dict[int, np.ndarray] = embedding_cache.get_many(EMBEDDING_MODEL, texts) if embedding_cache is not None else {}
+    if out:
+        EMBEDDING_TEXTS_TOTAL.inc(len(out), model=EMBEDDING_MODEL, source="cache")
+
+    # 同じ文章が複数回出てくる場合は1回だけ送る
+    first_index: dict[str, int] = {}
+    duplicates: list[tuple[int, int]] = []
+    for i, text in enumerate(texts):
+        if i in out:
+            continue
+        if text in first_index:
+            duplicates.append((i, first_index[text]))
+        else:
+            first_index[text] = i
+
+    miss_ids = list(first_index.values())
+    miss_texts = [texts[i] for i in miss_ids]
+    fetched: dict[int, np.ndarray] = {}
+    try:
+        for ids in _split_batches(miss_texts, batch_size, max_chars):
+            _embed_batch(miss_texts, ids, fetched)
+    finally:
+        # 途中で失敗しても、取得できた分はキャッシュに入れておく（再試行で API を呼ばないため）
+        if embedding_cache is not None and fetched:
+            embedding_cache.put_many(EMBEDDING_MODEL, [miss_texts[j] for j in fetched], list(fetched.values()))
+
+    for j, vec in fetched.items():
+        out[miss_ids[j]] = vec
+    for i, src in duplicates:
+        if src in out:
+            out[i] = out[src].copy()
+
+    ok_ids = sorted(out)
+    if not ok_ids:
+        return np.empty((0, 0), dtype="float32"), []
+    return np.vstack([out[i] for i in ok_ids]), ok_ids
@@ -0,0 +1,281 @@
+"""
+Embedding のキャッシュ
+
+同じ文章（同じモデル）の Embedding を二度 API に問い合わせないためのモジュール。
+再起動後の再取り込み・複数PDFに出てくる定型文・繰り返される質問文で効く。
+
+【構成】
+- キー : sha256(モデル名 + 文章)
+- 1段目: メモリ上の LRU（OrderedDict）
+- 2段目: ディスク上の SQLite（float32 のバイト列で保存）
+- ディスクの合計サイズが上限を超えたら、最後に使われたのが古い順に削除する
+  （メモリでヒットしたキーも、まとめてディスクの最終利用時刻を更新する）
+- ヒット・ミスの回数を数えて stats() で返す
+- メモリとディスクは別のロックで守る（ディスクへの書き込み中もメモリのヒットは待たない）
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", "data/cache/embeddings.sqlite3"))
+EMBED_CACHE_MEMORY_ITEMS = int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", "10000"))
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 1GB
+
+# 上限を超えたとき、ここまで減らす（毎回少しずつ消すと書き込みが増えるため）
+_EVICT_TARGET_RATIO = 0.9
+
+# メモリでヒットしたキーがこの件数たまったら、ディスクの最終利用時刻をまとめて更新する
+TOUCH_BATCH_ITEMS = 1000
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    メモリ LRU + SQLite の2段キャッシュ（スレッドセーフ）
+    """
+
+    def __init__(self, path: Path, memory_items: int, max_bytes: int):
+        self.path = Path(path)
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        # メモリでヒットして、まだディスクの最終利用時刻を更新していないキー {キー: 時刻}
+        self._touched: dict[str, float] = {}
+        # メモリ（_memory・_touched・回数）用と SQLite 用
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._disk_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ------------------------------
+    # 内部処理
+    # ------------------------------
+
+    def _db(self) -> sqlite3.Connection:
+        """
+        初回アクセス時に SQLite を開く（import 時にファイルを作らないため。_db_lock を持って呼ぶ）
+        """
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " vec BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+            self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, vec: np.ndarray) -> None:
+        # _lock を持って呼ぶ
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _memory_hit(self, key: str) -> np.ndarray | None:
+        # _lock を持って呼ぶ
+        vec = self._memory.get(key)
+        if vec is not None:
+            self._memory.move_to_end(key)
+            self._touched[key] = time.time()
+            self.memory_hits += 1
+        return vec
+
+    def _take_touched(self) -> list[tuple[float, str]]:
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        return [(at, key) for key, at in touched.items()]
+
+    def _write_touched(self, db: sqlite3.Connection, touched: list[tuple[float, str]]) -> None:
+        # _db_lock を持って呼ぶ（コミットは呼び出し側で行う）
+        if touched:
+            db.executemany("UPDATE embeddings SET last_access = MAX(last_access, ?) WHERE key = ?", touched)
+
+    def _evict_disk(self) -> None:
+        """
+        ディスクの合計サイズが上限を超えていたら、古いものから削除する（_db_lock を持って呼ぶ）
+        """
+        if self._disk_bytes <= self.max_bytes:
+            return
+        db = self._db()
+        # メモリでだけ使われているキーを古いものとして消さないように、先に最終利用時刻を更新する
+        self._write_touched(db, self._take_touched())
+        target = int(self.max_bytes * _EVICT_TARGET_RATIO)
+        while self._disk_bytes > target:
+            rows = db.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            evict = []
+            for key, size in rows:
+                if self._disk_bytes <= target:
+                    break
+                evict.append((key,))
+                self._disk_bytes -= size
+            db.executemany("DELETE FROM embeddings WHERE key = ?", evict)
+            db.commit()
+            self.evictions += len(evict)
+
+    # ------------------------------
+    # 公開API
+    # ------------------------------
+
+    def get_many(self, model: str, texts: list[str]) -> dict[int, np.ndarray]:
+        """
+        キャッシュにある分だけ {texts のインデックス: ベクトル} で返す
+        """
+        found: dict[int, np.ndarray] = {}
+        keys = [cache_key(model, t) for t in texts]
+
+        disk_keys: dict[str, list[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vec = self._memory_hit(key)
+                if vec is not None:
+                    found[i] = vec
+                else:
+                    disk_keys.setdefault(key, []).append(i)
+
+        if disk_keys:
+            now = time.time()
+            loaded: dict[str, np.ndarray] = {}
+            with self._db_lock:
+                db = self._db()
+                key_list = list(disk_keys)
+                # SQLite の変数上限に収まるよう分けて問い合わせる
+                for start in range(0, len(key_list), 500):
+                    part = key_list[start:start + 500]
+                    placeholders = ",".join("?" * len(part))
+                    for key, blob in db.execute(
+                        f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", part
+                    ):
+                        loaded[key] = np.frombuffer(blob, dtype="float32").copy()
+                # メモリでヒットした分の最終利用時刻も一緒に更新する
+                touched = self._take_touched() + [(now, key) for key in loaded]
+                if touched:
+                    self._write_touched(db, touched)
+                    db.commit()
+
+            with self._lock:
+                for key, vec in loaded.items():
+                    self._remember(key, vec)
+                    for i in disk_keys[key]:
+                        found[i] = vec
+                self.disk_hits += sum(len(disk_keys[k]) for k in loaded)
+                self.misses += len(texts) - len(found)
+        elif len(self._touched) >= TOUCH_BATCH_ITEMS:
+            self.flush_touches()
+
+        # 呼び出し側で正規化などの書き換えをしてもキャッシュが壊れないようコピーを返す
+        return {i: v.copy() for i, v in found.items()}
+
+    def put_many(self, model: str, texts: list[str], vectors) -> None:
+        """
+        texts と vectors（同じ順番）をキャッシュに保存する
+        """
+        if len(texts) == 0:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vec in zip(texts, vectors):
+                vec = np.array(vec, dtype="float32")
+                key = cache_key(model, text)
+                self._remember(key, vec)
+                blob = vec.tobytes()
+                rows.append((key, blob, len(blob), now))
+
+        with self._db_lock:
+            db = self._db()
+            self._write_touched(db, self._take_touched())
+            for row in rows:
+                cur = db.execute(
+                    "INSERT OR IGNORE INTO embeddings (key, vec, size, last_access) VALUES (?, ?, ?, ?)",
+                    row,
+                )
+                # 新しく入った分だけ合計サイズに足す（同じキーは無視される）
+                if cur.rowcount > 0:
+                    self._disk_bytes += row[2]
+            db.commit()
+            self._evict_disk()
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        return self.get_many(model, [text]).get(0)
+
+    def get_memory(self, model: str, text: str) -> np.ndarray | None:
+        """
+        メモリだけを見る（SQLite を開かないので、イベントループから直接呼べる）
+        見つからない場合、ディスクは get() で別スレッドから見る
+        """
+        with self._lock:
+            vec = self._memory_hit(cache_key(model, text))
+        return vec.copy() if vec is not None else None
+
+    def pending_touches(self) -> int:
+        """
+        ディスクの最終利用時刻をまだ更新していない（メモリでヒットした）キーの数
+        """
+        return len(self._touched)
+
+    def flush_touches(self) -> None:
+        """
+        メモリでヒットしたキーの、ディスクの最終利用時刻をまとめて更新する
+        """
+        touched = self._take_touched()
+        if not touched:
+            return
+        with self._db_lock:
+            db = self._db()
+            self._write_touched(db, touched)
+            db.commit()
+
+    def put(self, model: str, text: str, vector) -> None:
+        self.put_many(model, [text], [vector])
+
+    def stats(self) -> dict:
+        with self._db_lock, self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+# アプリ全体で共有するキャッシュ（無効化されている場合は None）
+embedding_cache: EmbeddingCache | None = (
+    EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MEMORY_ITEMS, EMBED_CACHE_MAX_BYTES)
+    if EMBED_CACHE_ENABLED
+    else None
+)
@@ -8,36 +8,209 @@
 
 from pypdf import PdfReader
 from openai import OpenAI
-import logging, json
-from app.core.clients import get_openai_client
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging, json, os
+import time
+from app.core.clients import call_upstream, get_openai_client
+from app.core.metrics import INGEST_STAGE_SECONDS, LLM_REQUEST_SECONDS, timed
+from app.core.tokens import estimate_tokens, truncate_to_tokens
+from app.analyzer.summary_cache import summary_cache, cache_key as summary_cache_key
+from app.analyzer.text_quality import split_pages_by_quality
 
+# 要約に使うモデル
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+# 1回のプロンプトに入れる本文の上限（トークン）。これを超える文書は map-reduce で要約する
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "12000"))
+# map で1回に送る本文の上限（トークン）
+SUMMARY_MAP_TOKENS = int(os.getenv("SUMMARY_MAP_TOKENS", "6000"))
+# map の同時実行数（1文書あたり）
+SUMMARY_MAP_WORKERS = int(os.getenv("SUMMARY_MAP_WORKERS", "4"))
+# 最終更新日の推定に使う、先頭・末尾それぞれのページ数
+SUMMARY_DATE_PAGES = int(os.getenv("SUMMARY_DATE_PAGES", "1"))
+# プロンプトを変えたら上げる（要約キャッシュが使われなくなる）
+SUMMARY_PROMPT_VERSION = 1
 
-def load_pdf(path: str) -> list[dict]:
-    try:
-        # PDFを開く
-        reader = PdfReader(path)
-
-        pages = []
-        page_text_list = []
-
-        # ページ単位で処理
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text()
-
-            # 文字が取得できたページのみ追加
-            if text:
-                pages.append({
-                    "page": i + 1,
-                    "text": text,
-                })
-                page_text_list.append(text)
-        full_text = "\n".join(page_text_list)
-
-        print(f"full_text: {full_text[:200]}")
-        # =====================
-        # OpenAI API による要約・更新日推定
-        # =====================
-        prompt = f"""
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    ファイル内容の SHA-256 を16進文字列で返す（差分取り込みの判定用）
+    大きなファイルでもメモリを使い過ぎないよう、少しずつ読み込む
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(chunk_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def extract_pages(path: str) -> list[dict]:
+    """
+    PDFからページ単位の文章を取り出す（CPU処理のみ、API呼び出しなし）
+
+    プロセスプールからも呼べるよう、引数・戻り値は pickle できる形にしている。
+    読み込みに失敗した場合は例外をそのまま投げる。
+    """
+    # PDFを開く
+    reader = PdfReader(path)
+
+    pages = []
+
+    # ページ単位で処理
+    for i, page in enumerate(reader.pages):
+        text = page.extract_text()
+
+        # 文字が取得できたページのみ追加
+        if text:
+            pages.append({
+                "page": i + 1,
+                "text": text,
+            })
+    return pages
+
+
+def _chat_json(prompt: str, fields: dict[str, str]) -> dict[str, str]:
+    """
+    OpenAI API にプロンプトを送り、JSON の回答のうち fields のフィールドを文字列にして返す（失敗した場合は例外）
+
+    fields は {フィールド名: 既定値}。回答に無い・null・空の場合は既定値にする
+    （null のまま返すと、キャッシュや DB の NOT NULL の列に入れられないため）
+    """
+    client = get_openai_client()
+
+    def request():
+        with timed(LLM_REQUEST_SECONDS, model=SUMMARY_MODEL, purpose="summary"):
+            return client.chat.completions.create(
+                model=SUMMARY_MODEL,  # 軽量・安価モデル想定
+                messages=[
+                    {"role": "system", "content": "あなたは文書解析アシスタントです。"},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.1,  # JSON安定化
+            )
+
+    # 利用枠の待ち・429 などの再試行は call_upstream で行う（出力は要約なので少なめに見積もる）
+    response = call_upstream("openai", request, estimate_tokens(prompt, SUMMARY_MODEL) + 512)
+    raw_content = response.choices[0].message.content
+
+    # =====================
+    # JSONとして安全にパース
+    # =====================
+    ai_result = json.loads(raw_content)
+    if not isinstance(ai_result, dict):
+        raise ValueError(f"AIの回答がJSONオブジェクトではありません: {type(ai_result).__name__}")
+    return {name: str(ai_result.get(name) or default) for name, default in fields.items()}
+
+
+def _split_by_tokens(pages: list[dict], max_tokens: int) -> list[str]:
+    """
+    ページの文章を、1つあたり max_tokens トークン以内のかたまりに分ける
+    （ページの途中では区切らない。1ページで上限を超える場合だけ、そのページを分ける）
+    """
+    parts: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for page in pages:
+        text = page["text"]
+        tokens = estimate_tokens(text, SUMMARY_MODEL)
+        if current and current_tokens + tokens > max_tokens:
+            parts.append("\n".join(current))
+            current, current_tokens = [], 0
+        while tokens > max_tokens:
+            head = truncate_to_tokens(text, max_tokens, SUMMARY_MODEL)
+            parts.append(head)
+            text = text[len(head):]
+            tokens = estimate_tokens(text, SUMMARY_MODEL)
+        if text:
+            current.append(text)
+            current_tokens += tokens
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+def _summarize_part(text: str) -> str:
+    """
+    map：文書の一部を要約する
+    """
+    prompt = f"""
+以下はPDF文書の一部です。
+
+次の条件を厳守して回答してください。
+
+- 出力は JSON形式のテキストのみ。マークダウン形式にはしないこと。
+- フィールドは summary だけ（この部分の要点。400文字以内、日本語）
+
+---- PDF本文（一部） ----
+{text}
+"""
+    return _chat_json(prompt, {"summary": ""})["summary"]
+
+
+def _reduce_summaries(summaries: list[str]) -> str:
+    """
+    reduce：部分ごとの要約から、文書全体の要約を作る
+    部分要約の合計が予算を超える場合は、かたまりごとに要約してから繰り返す
+    """
+    joined = "\n".join(f"- {s}" for s in summaries)
+    if len(summaries) > 1 and estimate_tokens(joined, SUMMARY_MODEL) > SUMMARY_TOKEN_BUDGET:
+        groups = _split_by_tokens([{"text": s} for s in summaries], SUMMARY_TOKEN_BUDGET)
+        return _reduce_summaries(_map_parallel(groups))
+
+    prompt = f"""
+以下はPDF文書を前から順に分けて、それぞれを要約したものです。
+
+次の条件を厳守して回答してください。
+
+- 出力は JSON形式のテキストのみ。マークダウン形式にはしないこと。
+- フィールドは summary だけ（文書全体の要約。200文字以内、日本語）
+
+---- 部分ごとの要約 ----
+{joined}
+"""
+    return _chat_json(prompt, {"summary": ""})["summary"]
+
+
+def _map_parallel(parts: list[str]) -> list[str]:
+    """
+    部分ごとの要約を並列に作る（1つでも失敗したら例外。一部が欠けた要約を保存しないため）
+    """
+    with ThreadPoolExecutor(max_workers=SUMMARY_MAP_WORKERS, thread_name_prefix="summary-map") as pool:
+        futures = [pool.submit(_summarize_part, part) for part in parts]
+    return [future.result() for future in futures]
+
+
+def _estimate_timestamp(pages: list[dict]) -> str:
+    """
+    先頭・末尾のページだけを送って最終更新日を推定する（日付は表紙や末尾に書かれることが多いため）
+    """
+    n = SUMMARY_DATE_PAGES
+    selected = pages if len(pages) <= n * 2 else pages[:n] + pages[-n:]
+    per_page = max(SUMMARY_TOKEN_BUDGET // max(len(selected), 1), 1)
+    text = "\n".join(
+        f"[{p['page']}ページ]\n{truncate_to_tokens(p['text'], per_page, SUMMARY_MODEL)}" for p in selected
+    )
+    prompt = f"""
+以下はPDF文書の先頭と末尾のページです。
+
+次の条件を厳守して回答してください。
+
+- 出力は JSON形式のテキストのみ。マークダウン形式にはしないこと。
+- フィールドは estimated_timestamp だけ（本文から推定される最終更新日）
+  - ISO形式（YYYY-MM-DD）
+  - 推定できない場合は "unknown"
+
+---- PDF本文（先頭・末尾） ----
+{text}
+"""
+    return _chat_json(prompt, {"estimated_timestamp": "unknown"})["estimated_timestamp"]
+
+
+def _summarize_whole(full_text: str) -> dict:
+    """
+    本文が予算に収まる場合：1回の呼び出しで要約と最終更新日を得る
+    """
+    prompt = f"""
 以下はPDF文書の全文です。
 
 次の条件を厳守して回答してください。
@@ -53,36 +226,84 @@ def load_pdf(path: str) -> list[dict]:
 ---- PDF本文 ----
 {full_text}
 """
-        client = get_openai_client()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # 軽量・安価モデル想定
-            messages=[
-                {"role": "system", "content": "あなたは文書解析アシスタントです。"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.1,  # JSON安定化
-        )
-        raw_content = response.choices[0].message.content
+    return _chat_json(prompt, {"summary": "", "estimated_timestamp": "unknown"})
+
+
+def _summarize_long(pages: list[dict]) -> dict:
+    """
+    本文が予算を超える場合：map-reduce で要約し、最終更新日は先頭・末尾のページから推定する
+    （日付の推定と部分要約は同時に進める）
+    """
+    parts = _split_by_tokens(pages, SUMMARY_MAP_TOKENS)
+    logging.info(f"長い文書のため分割して要約します (部分数: {len(parts)})")
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary-date") as pool:
+        date_future = pool.submit(_estimate_timestamp, pages)
+        summary = _reduce_summaries(_map_parallel(parts))
+        estimated_timestamp = date_future.result()
+    return {"summary": summary, "estimated_timestamp": estimated_timestamp}
+
+
+def summarize_pages(pages: list[dict], path: str = "", sha256: str | None = None) -> dict:
+    """
+    ページの文章から、OpenAI API で要約と最終更新日を推定する
+
+    - 本文が SUMMARY_TOKEN_BUDGET トークン以内なら、全文を1回で送る
+    - 超える場合は、分割して並列に要約（map）→ まとめて要約（reduce）し、
+      最終更新日は先頭・末尾のページだけから推定する
+    - sha256（ファイル内容のハッシュ）を渡すと、結果をキャッシュして次回から API を呼ばない
+
+    失敗した場合（JSON として読めない・JSON オブジェクトでない応答を含む）は例外を投げる（キャッシュはしない）
+    空の要約を返すと、その内容で登録されて次回以降の取り込みで再試行されないため
+    処理時間は outcome = ok / cached / error で記録する
+    """
+    start = time.perf_counter()
+    key = None
+    if sha256 and summary_cache is not None:
+        key = summary_cache_key(sha256, SUMMARY_MODEL, SUMMARY_PROMPT_VERSION)
+        if (cached := summary_cache.get(key)) is not None:
+            INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="summarize", outcome="cached")
+            return cached
+
+    try:
+        full_text = "\n".join(p["text"] for p in pages)
 
         # =====================
-        # JSONとして安全にパース
+        # OpenAI API による要約・更新日推定
         # =====================
-        print("AI raw response repr:", (raw_content))
-        ai_result = json.loads(raw_content)
+        if estimate_tokens(full_text, SUMMARY_MODEL) <= SUMMARY_TOKEN_BUDGET:
+            result = _summarize_whole(full_text)
+        else:
+            result = _summarize_long(pages)
 
-        return {
-            "pages": pages,
-            "summary": ai_result.get("summary", ""),
-            "estimated_timestamp": ai_result.get("estimated_timestamp", "unknown"),
-        }
+        if key is not None:
+            summary_cache.put(key, result)
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="summarize", outcome="ok")
+        return result
+
+    except Exception as e:
+        if isinstance(e, json.JSONDecodeError):
+            logging.error(f"AIのJSONパースに失敗しました: {path} エラー: {e}")
+        else:
+            logging.error(f"PDFの要約に失敗しました: {path} エラー: {e}")
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - start, stage="summarize", outcome="error")
+        raise
 
-    except json.JSONDecodeError as e:
-        logging.error(f"AIのJSONパースに失敗しました: {e}")
+
+def load_pdf(path: str) -> dict:
+    """
+    PDFを読み込み、ページ単位の文章と要約・推定更新日を返す
+    （extract_pages と summarize_pages を順に呼ぶ。品質の低いページは skipped_pages に入れて除く）
+    読み込みに失敗した場合は空の結果を返し、要約に失敗した場合は例外を投げる
+    """
+    try:
+        pages, skipped_pages = split_pages_by_quality(extract_pages(path))
     except Exception as e:
         logging.error(f"PDFの読み込みに失敗しました: {path} エラー: {e}")
+        return {
+            "pages": [],
+            "skipped_pages": [],
+            "summary": "",
+            "estimated_timestamp": "unknown",
+        }
 
-    return {
-        "pages": [],
-        "summary": "",
-        "estimated_timestamp": "unknown",
-    }
\ No newline at end of file
+    return {"pages": pages, "skipped_pages": skipped_pages, **summarize_pages(pages, path, file_sha256(path))}
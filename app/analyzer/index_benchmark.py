@@ -0,0 +1,181 @@
+"""
+index の種類ごとの recall@k と検索レイテンシを測るツール
+
+保存済みスナップショットのベクトル（＝実際の文書のベクトル）を使い、
+flat（総当たり）の結果を正解として ivf / hnsw の精度と速さを比べる。
+
+例:
+    python -m app.analyzer.index_benchmark
+    python -m app.analyzer.index_benchmark --k 10 --nprobe 4 8 16 32 --ef 32 64 128
+    python -m app.analyzer.index_benchmark --synthetic 200000 --dim 768 --json result.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from app.analyzer.index_types import (
+    IVF_NLIST, HNSW_M, HNSW_EF_CONSTRUCTION,
+    base_index, build_ivf, reconstruct_all,
+)
+
+
+def load_snapshot_vectors(index_dir: Path) -> np.ndarray:
+    """
+    最新スナップショットの index から全ベクトルを取り出す
+    """
+    current = index_dir / "CURRENT"
+    if not current.exists():
+        raise FileNotFoundError(f"スナップショットがありません: {index_dir}")
+    snapshot_dir = index_dir / current.read_text(encoding="utf-8").strip()
+    index = faiss.read_index(str(snapshot_dir / "index.faiss"))
+    return np.ascontiguousarray(reconstruct_all(index), dtype="float32")
+
+
+def synthetic_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """
+    クラスタ構造を持つ正規化済みの乱数ベクトル（実データが無いとき用）
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(n // 100, 1), dim)).astype("float32")
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def _measure(index: faiss.Index, queries: np.ndarray, k: int) -> tuple[np.ndarray, dict]:
+    """
+    クエリを1件ずつ検索してレイテンシを測る（APIの使われ方に合わせる）
+    """
+    latencies = []
+    results = []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    lat = np.array(latencies)
+    return np.vstack(results), {
+        "latency_ms_p50": round(float(np.percentile(lat, 50)), 4),
+        "latency_ms_p99": round(float(np.percentile(lat, 99)), 4),
+        "latency_ms_mean": round(float(lat.mean()), 4),
+    }
+
+
+def run_benchmark(
+    vectors: np.ndarray,
+    k: int = 10,
+    n_queries: int = 200,
+    nlist: int = IVF_NLIST,
+    nprobes: list[int] = (1, 4, 16, 64),
+    hnsw_m: int = HNSW_M,
+    ef_searches: list[int] = (16, 32, 64, 128),
+    seed: int = 0,
+) -> list[dict]:
+    """
+    flat を正解として、ivf（nprobe ごと）・hnsw（efSearch ごと）の recall@k とレイテンシを返す
+    """
+    rng = np.random.default_rng(seed)
+    n, dim = vectors.shape
+    # 登録済みベクトルに少しノイズを加えたものを質問の代わりに使う
+    queries = vectors[rng.choice(n, size=min(n_queries, n), replace=False)].copy()
+    queries += 0.05 * rng.standard_normal(queries.shape).astype("float32")
+    faiss.normalize_L2(queries)
+
+    results = []
+
+    start = time.perf_counter()
+    flat = faiss.IndexFlatIP(dim)
+    flat.add(vectors)
+    build_s = time.perf_counter() - start
+    truth, stats = _measure(flat, queries, k)
+    results.append({"index": "flat", "params": {}, "build_s": round(build_s, 3), f"recall@{k}": 1.0, **stats})
+
+    # IVF（学習には nlist の数十倍の件数が必要）
+    nlist = min(nlist, max(n // 39, 1))
+    start = time.perf_counter()
+    ivf = build_ivf(vectors, nlist=nlist)
+    build_s = time.perf_counter() - start
+    for nprobe in nprobes:
+        base_index(ivf).nprobe = nprobe
+        found, stats = _measure(ivf, queries, k)
+        results.append({
+            "index": "ivf",
+            "params": {"nlist": nlist, "nprobe": nprobe},
+            "build_s": round(build_s, 3),
+            f"recall@{k}": round(_recall(found, truth), 4),
+            **stats,
+        })
+
+    # HNSW
+    start = time.perf_counter()
+    hnsw = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    hnsw.add(vectors)
+    build_s = time.perf_counter() - start
+    for ef in ef_searches:
+        hnsw.hnsw.efSearch = ef
+        found, stats = _measure(hnsw, queries, k)
+        results.append({
+            "index": "hnsw",
+            "params": {"M": hnsw_m, "efSearch": ef},
+            "build_s": round(build_s, 3),
+            f"recall@{k}": round(_recall(found, truth), 4),
+            **stats,
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS index の recall@k とレイテンシを比較する")
+    parser.add_argument("--index-dir", default="data/index", help="スナップショットの保存先")
+    parser.add_argument("--synthetic", type=int, default=0, help="スナップショットの代わりに乱数ベクトルをN件使う")
+    parser.add_argument("--dim", type=int, default=3072, help="--synthetic 時の次元数")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--hnsw-m", type=int, default=HNSW_M)
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic, args.dim)
+    else:
+        vectors = load_snapshot_vectors(Path(args.index_dir))
+    print(f"ベクトル数: {len(vectors)}, 次元数: {vectors.shape[1]}")
+
+    results = run_benchmark(
+        vectors, k=args.k, n_queries=args.queries, nlist=args.nlist,
+        nprobes=args.nprobe, hnsw_m=args.hnsw_m, ef_searches=args.ef,
+    )
+
+    recall_key = f"recall@{args.k}"
+    print(f"{'index':<6} {'params':<28} {recall_key:>10} {'p50(ms)':>9} {'p99(ms)':>9} {'build(s)':>9}")
+    for r in results:
+        params = ",".join(f"{k}={v}" for k, v in r["params"].items())
+        print(f"{r['index']:<6} {params:<28} {r[recall_key]:>10.4f} {r['latency_ms_p50']:>9.3f} {r['latency_ms_p99']:>9.3f} {r['build_s']:>9.3f}")
+
+    if args.json:
+        Path(args.json).write_text(
+            json.dumps({"n": len(vectors), "dim": int(vectors.shape[1]), "k": args.k, "results": results}, ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+
+
+if __name__ == "__main__":
+    main()
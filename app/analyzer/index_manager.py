@@ -5,33 +5,170 @@ FAISSのインデックス管理を行うモジュール
 - ベクトル検索用の FAISS index を初期化する
 - ベクトルと一緒に保持するメタ情報（文章・ページ番号など）を管理する
 - analyzer 側・finder 側の両方から利用される
+- index とメタ情報をスナップショットとしてディスクに保存・読み込みする
+
+各チャンクには追加順に増えるチャンクID（64bit）を振り、FAISS にもそのIDで登録する。
+IDは削除・差し替えをしても変わらないので、文書単位の削除・差し替えで
+index 全体を作り直す必要はない。
+
+重複したチャンク（定型文など）は1つだけ登録し、ほかの出現箇所は参照として持つ（chunk_dedup.py を参照）。
 """
 
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
 import faiss
-from app.analyzer.embedder import get_embedding
+import numpy as np
+from app.analyzer.meta_store import MetaStore
+from app.analyzer.lexical_index import LexicalIndex, term_counts
+from app.analyzer.chunk_dedup import ChunkDeduper, Fingerprint
+from app.analyzer.doc_filter import DocFilter
+from app.analyzer.index_types import (
+    create_index, configure_search, index_type_of, maybe_train_ivf,
+    dump_vectors, search_parameters, supports_remove,
+)
+from app.core.metrics import (
+    INDEX_ADD_SECONDS, INDEX_ADD_VECTORS_TOTAL, INDEX_DOCUMENTS, INDEX_META_BYTES, INDEX_NTOTAL,
+    INDEX_VECTOR_BYTES, INDEX_VECTORS, SEARCH_SECONDS, timed,
+)
 
 # ----------------------------------------
 # 1. FAISSインデックスの初期化
 # ----------------------------------------
 
 # FAISSは「ベクトルの次元数」を最初に決める必要があるため、
-# ダミーの文章を1つEmbeddingして次元数を取得する
-_dummy_embedding = get_embedding("dummy text")
-EMBEDDING_DIM = len(_dummy_embedding)
+# 設定値から次元数を決める（gemini-embedding-001 の既定は 3072次元）
+# 保存済みのスナップショットを読み込んだ場合は、その次元数が優先される
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "3072"))
 
-# 内積（cos類似度用）で検索するシンプルなIndex
-# 初級者向けには IndexFlatIP が一番分かりやすい
-index = faiss.IndexFlatIP(EMBEDDING_DIM)
+# index の種類は INDEX_TYPE（flat / ivf / hnsw）で切り替える（index_types.py を参照）
+index = create_index(EMBEDDING_DIM)
 
 # ----------------------------------------
-# 2. メタデータ格納用リスト
+# 2. メタデータ格納用ストア
 # ----------------------------------------
 
 # FAISSは「ベクトル」しか覚えないため、
 # 元の文章やページ番号などは自分で管理する必要がある
 #
-# index に追加した順番と meta_data の順番を一致させる
-meta_data: list[dict] = []
+# index とはチャンクIDで対応させる
+# （チャンク数が多くてもメモリを食わないよう、列ごとの配列で持つ。meta_store.py を参照）
+meta_data = MetaStore()
+
+# チャンク本文の bigram 転置インデックス（キーワード検索用。lexical_index.py を参照）
+# index・meta_data と同じチャンクIDで、同じタイミングで更新する
+lexical = LexicalIndex()
+
+# 重複チャンクの指紋と参照（代表チャンクのIDは index と同じチャンクID）
+deduper = ChunkDeduper()
+
+# 次に振るチャンクID（一度使ったIDは、削除した後も使い回さない）
+next_chunk_uid = 0
+
+# 削除済み行の割合がこれを超えたら compact() で詰め直す
+INDEX_COMPACT_RATIO = float(os.getenv("INDEX_COMPACT_RATIO", "0.2"))
+
+# 登録済み文書の台帳（差分取り込み用）
+# {doc_id: {"sha256": ..., "pipeline_version": ..., "path": ..., 絞り込み用の属性（doc_filter.py）...}}
+doc_manifest: dict[str, dict] = {}
+
+# バックグラウンドの取り込みと検索が同時に index を触らないようにするためのロック
+index_lock = threading.RLock()
+
+# index の内容が変わるたびに1つ増える番号（回答キャッシュの無効化に使う）
+generation = 0
+
+
+def _bump_generation() -> None:
+    global generation
+    generation += 1
+
+
+# メモリマップで読み込んだスナップショットのパス
+# （メモリマップのままでは書き込めないため、
+#   最初に書き込むときに通常の読み込みに切り替える）
+_mmap_path: Path | None = None
+
+
+def _ensure_writable() -> None:
+    global index, _mmap_path
+    if _mmap_path is not None:
+        index = faiss.read_index(str(_mmap_path))
+        configure_search(index)
+        _mmap_path = None
+
+def _train_if_needed() -> None:
+    global index
+    index = maybe_train_ivf(index)
+
+
+# hnsw で削除済み（index には残っている）チャンクIDを検索から除くための selector
+# 削除のたびに作り直すと重いので、必要になったときに作ってキャッシュする
+_tombstone_selector = None
+_tombstone_generation = -1
+
+
+def _search_params():
+    global _tombstone_selector, _tombstone_generation
+    if supports_remove(index) or meta_data.dead_rows == 0:
+        return None
+    if _tombstone_generation != generation:
+        dead = meta_data.deleted_ids()
+        # IDSelectorBatch は配列をコピーするので、dead は使い捨てでよい
+        _tombstone_selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(dead))
+        _tombstone_generation = generation
+    return faiss.SearchParameters(sel=_tombstone_selector)
+
+
+# 絞り込み検索で、対象のチャンクがこれ以下なら index を使わずに総当たりで計算する
+# （ivf / hnsw は対象が少ないと k 件に満たないことがあるため。flat は IDSelector でも正確に探せる）
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "2048"))
+
+# 絞り込み条件ごとの対象（index が変わるまで使い回す）
+# {DocFilter: (generation, 対象の doc_id, 対象のチャンクID（昇順）, IDSelector)}
+_filter_cache: dict[DocFilter, tuple] = {}
+_FILTER_CACHE_SIZE = 64
+
+
+def _filter_target(doc_filter: DocFilter) -> tuple[set[str], np.ndarray, object]:
+    """
+    条件に合う文書と、検索の対象にするチャンクID・IDSelector を返す
+
+    重複チャンクは、代表チャンクの文書が条件に合わなくても、
+    参照している文書のどれかが条件に合えば対象にする
+    """
+    cached = _filter_cache.get(doc_filter)
+    if cached is not None and cached[0] == generation:
+        return cached[1:]
+
+    names = set(meta_data.doc_ids) | set(doc_manifest)
+    docs = {doc_id for doc_id in names if doc_filter.matches(doc_id, doc_manifest.get(doc_id, {}))}
+    ids = np.union1d(meta_data.ids_of_docs(docs), deduper.ids_referenced_by(docs)).astype("int64")
+    # IDSelectorBatch は配列をコピーするので、ids はそのまま持っていてよい
+    selector = faiss.IDSelectorBatch(ids) if len(ids) else None
+
+    if len(_filter_cache) >= _FILTER_CACHE_SIZE:
+        _filter_cache.clear()
+    _filter_cache[doc_filter] = (generation, docs, ids, selector)
+    return docs, ids, selector
+
+
+def _search_exact(queries: np.ndarray, ids: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    ids のベクトルだけを取り出して総当たりで検索する（結果は index.search と同じ形のID行列）
+    """
+    vectors = index.reconstruct_batch(ids)
+    scores = queries @ vectors.T
+    k = min(top_k, len(ids))
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+    found = np.full((len(queries), top_k), -1, dtype="int64")
+    found[:, :k] = ids[np.take_along_axis(best, order, axis=1)]
+    return found
 
 # ----------------------------------------
 # 3. ベクトルをインデックスに追加する関数
@@ -54,11 +191,576 @@ def add_vector(embedding, meta: dict):
         }
     """
 
-    # cos類似度検索のため、L2正規化を行う
-    faiss.normalize_L2(embedding.reshape(1, -1))
+    add_vectors(embedding.reshape(1, -1), [meta])
+
+
+def add_vectors(embeddings, metas: list[dict]):
+    """
+    複数のベクトルとメタ情報をまとめてFAISSに登録する
+
+    Parameters
+    ----------
+    embeddings : np.ndarray
+        shape = (件数, 次元数) のEmbedding行列（float32）
+    metas : list[dict]
+        embeddings の各行に対応するメタ情報（add_vector と同じ形式）
+    """
+    if len(embeddings) != len(metas):
+        raise ValueError(f"ベクトル数とメタ情報数が一致しません: {len(embeddings)} != {len(metas)}")
+    if len(metas) == 0:
+        return
+
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if embeddings.shape[1] != index.d:
+        raise ValueError(f"Embeddingの次元数が index と一致しません: {embeddings.shape[1]} != {index.d}")
+
+    # cos類似度検索のため、まとめてL2正規化を行う
+    faiss.normalize_L2(embeddings)
+    # キーワード検索用の bigram への分解はロックの外で行う
+    counts = term_counts([meta["text"] for meta in metas])
+
+    with index_lock:
+        _add_locked(embeddings, metas, counts)
+        _bump_generation()
+
+
+def _add_locked(embeddings: np.ndarray, metas: list[dict], counts: list | None = None) -> np.ndarray:
+    """
+    正規化済みの embeddings に新しいチャンクIDを振って登録する（index_lock を持って呼ぶ）
+
+    counts は各チャンクの term_counts()（渡さない場合はここで計算する）
+
+    Returns
+    -------
+    np.ndarray
+        振ったチャンクID
+    """
+    global next_chunk_uid
+
+    index_type = index_type_of(index)
+    with timed(INDEX_ADD_SECONDS, index_type=index_type):
+        _ensure_writable()
+
+        ids = np.arange(next_chunk_uid, next_chunk_uid + len(metas), dtype="int64")
+
+        # 1回の add_with_ids でまとめて登録
+        index.add_with_ids(embeddings, ids)
+
+        # 同じIDでメタ情報・キーワード検索用の索引も保存
+        meta_data.extend(ids, metas)
+        lexical.add(ids, [meta["text"] for meta in metas], counts)
+        next_chunk_uid += len(metas)
+
+        # INDEX_TYPE=ivf の場合、件数がそろったら学習して載せ替える
+        _train_if_needed()
+    INDEX_ADD_VECTORS_TOTAL.inc(len(ids), index_type=index_type)
+    return ids
+
+
+def _remove_locked(doc_ids) -> int:
+    """
+    文書のチャンクを削除する（index_lock を持って呼ぶ）
+
+    flat / ivf は index からIDで削除する。hnsw は削除できないので
+    メタ情報を削除済みにするだけにして、検索時に除外する（compact() で実際に消える）
+
+    ほかの文書から参照されている代表チャンクは、参照のどれかを新しい代表チャンクにして
+    同じベクトルで登録し直す（Embedding はやり直さない）
+    """
+    ids = meta_data.ids_of_docs(doc_ids)
+    deduper.remove_refs_of_docs(doc_ids)
+    orphans = deduper.unregister(ids)
+    promoted = []
+    for uid, (fp, refs) in orphans.items():
+        doc_id, page, chunk_id = refs[0]
+        text = meta_data.get_by_id(uid)["text"]
+        vector = index.reconstruct(uid)
+        promoted.append((vector, {"doc_id": doc_id, "page": page, "chunk_id": chunk_id, "text": text}, fp, refs[1:]))
+
+    if len(ids):
+        if supports_remove(index):
+            _ensure_writable()
+            # ivf の direct map（ハッシュ表）は IDSelectorArray でしか削除できない
+            index.remove_ids(faiss.IDSelectorArray(ids))
+        meta_data.mark_deleted(ids)
+        lexical.remove(ids)
+    for doc_id in doc_ids:
+        doc_manifest.pop(doc_id, None)
+
+    if promoted:
+        new_ids = _add_locked(np.vstack([p[0] for p in promoted]), [p[1] for p in promoted])
+        for uid, (_, _, fp, refs) in zip(new_ids, promoted):
+            uid = int(uid)
+            deduper.register(uid, fp)
+            for ref in refs:
+                deduper.add_ref(uid, *ref)
+    return len(ids)
+
+
+def remove_document(doc_id: str) -> int:
+    """
+    1文書のベクトルとメタ情報を削除する
+
+    Returns
+    -------
+    int
+        削除したベクトル数
+    """
+    return remove_documents([doc_id])
+
+
+def remove_documents(doc_ids) -> int:
+    """
+    指定した文書のベクトルとメタ情報を削除する
+
+    処理量は削除する文書のチャンク数に比例する（index 全体は作り直さない）
+
+    Returns
+    -------
+    int
+        削除したベクトル数
+    """
+    doc_ids = set(doc_ids)
+    with index_lock:
+        removed = _remove_locked(doc_ids)
+        if removed:
+            _bump_generation()
+        compact()
+    return removed
+
+
+def find_duplicates(doc_id: str, fingerprints: list[Fingerprint]) -> list[int | None]:
+    """
+    登録済みの代表チャンクと重複しているかを調べる（Embedding する前に呼ぶ）
+
+    doc_id 自身の代表チャンクは、差し替えで消えるので候補にしない
+
+    Returns
+    -------
+    list[int | None]
+        fingerprints の各要素について、重複する代表チャンクのID（無ければ None）
+    """
+    with index_lock:
+        if len(deduper) == 0:
+            return [None] * len(fingerprints)
+        own = set(meta_data.ids_of_docs([doc_id]).tolist())
+        return [deduper.find(fp, exclude=own) for fp in fingerprints]
+
+
+def replace_document(
+    doc_id: str,
+    embeddings,
+    metas: list[dict],
+    fingerprints: list[Fingerprint] | None = None,
+    duplicates: list[tuple[dict, Fingerprint]] | None = None,
+) -> int:
+    """
+    文書の古いベクトルを削除し、新しいベクトルを登録する
+
+    削除と登録は1回のロックの中で行うので、検索から古い版と新しい版が
+    混ざって見えることはない。doc_manifest の更新は呼び出し側で行う。
+
+    Parameters
+    ----------
+    fingerprints : list[Fingerprint] | None
+        metas の各チャンクの指紋（渡した場合は代表チャンクとして登録する。
+        その間にほかの文書が同じチャンクを登録していた場合は、そちらの参照にする）
+    duplicates : list[tuple[dict, Fingerprint]] | None
+        Embedding しなかった重複チャンクの (メタ情報, 指紋)。代表チャンクの参照として登録する
+
+    Returns
+    -------
+    int
+        削除した（古い版の）ベクトル数
+    """
+    duplicates = duplicates or []
+    if len(embeddings) != len(metas):
+        raise ValueError(f"ベクトル数とメタ情報数が一致しません: {len(embeddings)} != {len(metas)}")
+    if fingerprints is not None and len(fingerprints) != len(metas):
+        raise ValueError(f"指紋の数とメタ情報数が一致しません: {len(fingerprints)} != {len(metas)}")
+    if any(meta["doc_id"] != doc_id for meta in metas) or any(meta["doc_id"] != doc_id for meta, _ in duplicates):
+        raise ValueError(f"doc_id が一致しないメタ情報が含まれています: {doc_id}")
+
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if len(metas) and embeddings.shape[1] != index.d:
+        raise ValueError(f"Embeddingの次元数が index と一致しません: {embeddings.shape[1]} != {index.d}")
+    if len(metas):
+        faiss.normalize_L2(embeddings)
+    counts = term_counts([meta["text"] for meta in metas])
+
+    with index_lock:
+        if duplicates:
+            # 参照先が見つからない重複チャンクがあれば、何も変えずに失敗させる（次回の取り込みでやり直す）
+            own = set(meta_data.ids_of_docs([doc_id]).tolist())
+            new_fps = ChunkDeduper()
+            for i, fp in enumerate(fingerprints or []):
+                new_fps.register(i, fp)
+            missing = [meta for meta, fp in duplicates if deduper.find(fp, exclude=own) is None and new_fps.find(fp) is None]
+            if missing:
+                raise ValueError(f"重複チャンクの参照先が見つかりません: {doc_id} ({len(missing)}件)")
+
+        removed = _remove_locked([doc_id])
+
+        if fingerprints is not None:
+            # 取り込みの途中でほかの文書が同じチャンクを登録していたら、そちらの参照にする
+            folded = [(i, deduper.find(fp)) for i, fp in enumerate(fingerprints)]
+            folded = {i: uid for i, uid in folded if uid is not None}
+            for i, uid in folded.items():
+                deduper.add_ref(uid, doc_id, metas[i]["page"], metas[i]["chunk_id"])
+            if folded:
+                keep = [i for i in range(len(metas)) if i not in folded]
+                embeddings = embeddings[keep]
+                metas = [metas[i] for i in keep]
+                counts = [counts[i] for i in keep]
+                fingerprints = [fingerprints[i] for i in keep]
+
+        if len(metas):
+            ids = _add_locked(embeddings, metas, counts)
+            for uid, fp in zip(ids, fingerprints or []):
+                deduper.register(int(uid), fp)
+
+        for meta, fp in duplicates:
+            uid = deduper.find(fp)
+            deduper.add_ref(uid, doc_id, meta["page"], meta["chunk_id"])
+
+        if removed or len(metas) or duplicates:
+            _bump_generation()
+        compact()
+    return removed
+
+
+def update_manifest(doc_id: str, entry: dict) -> None:
+    """
+    doc_manifest の文書の情報を差し替える（絞り込み検索の対象も変わるので generation を上げる）
+    """
+    with index_lock:
+        doc_manifest[doc_id] = entry
+        _bump_generation()
+
+
+def compact(force: bool = False) -> bool:
+    """
+    削除済みの行を詰め直す
+
+    - メタ情報：削除済みの行と本文を取り除く
+    - hnsw：削除済みのIDを除いて index を作り直す（flat / ivf は削除時に消えている）
+
+    削除済みの行の割合が INDEX_COMPACT_RATIO 以下なら何もしない（force=True で必ず行う）
+
+    Returns
+    -------
+    bool
+        詰め直した場合は True
+    """
+    global index, meta_data, _mmap_path
+
+    with index_lock:
+        dead = meta_data.dead_rows
+        if dead == 0 or (not force and dead <= meta_data.total_rows * INDEX_COMPACT_RATIO):
+            return False
+
+        if not supports_remove(index):
+            vectors, ids = dump_vectors(index)
+            keep = ~np.isin(ids, meta_data.deleted_ids())
+            rebuilt = create_index(index.d, index_type_of(index))
+            if keep.any():
+                rebuilt.add_with_ids(vectors[keep], ids[keep])
+            index = rebuilt
+            _mmap_path = None
+            _bump_generation()
+
+        # チャンクIDは変わらないので、flat / ivf の index はそのまま使える
+        meta_data = meta_data.compact()
+        lexical.compact()
+    print(f"削除済みのチャンクを詰め直しました (削除済み: {dead}, 残り: {len(meta_data)})")
+    return True
+
+def _meta_of(uid: int, docs: set[str] | None = None) -> dict | None:
+    """
+    チャンクIDのメタ情報（重複チャンクの場合は、ほかの出現箇所を "duplicates" に入れる）
+
+    docs（絞り込みで対象になった文書）を渡した場合は、その文書の出現箇所だけを返す
+    （代表チャンクの文書が対象外なら、対象の文書の出現箇所を代わりに表に出す）
+    """
+    meta = meta_data.get_by_id(uid)
+    if meta is None:
+        return None
+    refs = deduper.refs(uid)
+    if refs:
+        occurrences = [(meta["doc_id"], meta["page"], meta["chunk_id"]), *refs]
+        if docs is not None:
+            occurrences = [o for o in occurrences if o[0] in docs]
+        if not occurrences:
+            return None
+        meta["doc_id"], meta["page"], meta["chunk_id"] = occurrences[0]
+        if len(occurrences) > 1:
+            meta["duplicates"] = [{"doc_id": d, "page": p, "chunk_id": c} for d, p, c in occurrences[1:]]
+    return meta
+
+
+def search(queries, top_k: int, doc_filter: DocFilter | None = None) -> list[list[dict]]:
+    """
+    正規化済みのクエリベクトルで検索し、ヒットしたメタ情報を返す
+
+    Parameters
+    ----------
+    queries : np.ndarray
+        shape = (クエリ数, 次元数) のクエリ行列（L2正規化済み）
+    top_k : int
+        1クエリあたりの取得件数
+    doc_filter : DocFilter | None
+        文書の絞り込み条件（条件に合うチャンクだけを対象に検索するので、件数は top_k 件そろう）
+
+    Returns
+    -------
+    list[list[dict]]
+        クエリごとのメタ情報のリスト（類似度の高い順）
+    """
+    # 処理時間にはロックの待ち時間も含める（取り込み中に検索が遅くなる分も見えるように）
+    with timed(SEARCH_SECONDS, backend="faiss", filtered=str(doc_filter is not None).lower()), index_lock:
+        if len(meta_data) == 0:
+            return [[] for _ in range(len(queries))]
+
+        docs = None
+        if doc_filter is None:
+            _, ids = index.search(queries, top_k, params=_search_params())
+        else:
+            # 削除済みのチャンクは対象のIDに含まれないので、hnsw のトゥームストーンも同時に除かれる
+            docs, allowed, selector = _filter_target(doc_filter)
+            if len(allowed) == 0:
+                return [[] for _ in range(len(queries))]
+            if index_type_of(index) != "flat" and len(allowed) <= FILTER_EXACT_MAX:
+                ids = _search_exact(queries, allowed, top_k)
+            else:
+                _, ids = index.search(queries, top_k, params=search_parameters(index, selector, top_k))
+
+        # 件数が top_k に満たない場合は -1 が返るので除外する
+        # dict を組み立てるのはヒットした上位 top_k 件だけ
+        results = []
+        for row in ids:
+            metas = (_meta_of(int(i), docs) for i in row if i >= 0)
+            results.append([m for m in metas if m is not None])
+        return results
+
+
+def search_lexical(query: str, top_k: int, doc_filter: DocFilter | None = None) -> list[dict]:
+    """
+    質問文のキーワード（文字 bigram）で BM25 検索し、ヒットしたメタ情報を返す
+    Embedding を使わないので、Embedding API を呼ばずに検索できる
+    doc_filter を渡した場合は、条件に合うチャンクだけを対象にする
+
+    Returns
+    -------
+    list[dict]
+        メタ情報のリスト（スコアの高い順）
+    """
+    with timed(SEARCH_SECONDS, backend="lexical", filtered=str(doc_filter is not None).lower()), index_lock:
+        docs, allowed = None, None
+        if doc_filter is not None:
+            docs, allowed, _ = _filter_target(doc_filter)
+            if len(allowed) == 0:
+                return []
+        hits = lexical.search(query, top_k, allowed)
+        metas = (_meta_of(uid, docs) for uid, _ in hits)
+        return [m for m in metas if m is not None]
+
+
+# index の大きさ・メモリ使用量のゲージ（/metrics を出力するたびに計算する。ロックは取らない）
+# ベクトル本体は float32 × 次元数 × 件数（hnsw のグラフ・ivf の割り当て表などは含めない）
+INDEX_VECTORS.set_function(lambda: len(meta_data))
+INDEX_NTOTAL.set_function(lambda: index.ntotal)
+INDEX_DOCUMENTS.set_function(lambda: len(doc_manifest))
+INDEX_VECTOR_BYTES.set_function(lambda: index.ntotal * index.d * 4)
+INDEX_META_BYTES.set_function(lambda: meta_data.nbytes())
+
+
+# ----------------------------------------
+# 4. スナップショットの保存・読み込み
+# ----------------------------------------
+
+# スナップショットの保存先
+# INDEX_DIR/
+#   CURRENT                 ← 最新スナップショットのディレクトリ名
+#   snapshot-000001/
+#     index.faiss           ← FAISS index 本体
+#     meta_rows.npy         ← メタ情報の整数列（チャンクIDの昇順）
+#     meta_docs.json        ← doc_id の一覧（meta_rows.npy からは番号で参照）
+#     meta_text.bin         ← チャンク本文をつないだバイト列
+#     lexical.npz           ← キーワード検索用の転置インデックス
+#     lexical_terms.json    ← 転置インデックスの単語（bigram）一覧
+#     dedup.npz             ← 重複チャンクの指紋と参照
+#     documents.json        ← 登録済み文書の台帳（doc_manifest）
+#     manifest.json         ← フォーマットのバージョンや件数
+INDEX_DIR = Path(os.getenv("INDEX_DIR", "data/index"))
+
+# 残しておく過去スナップショットの数（読み込み中のプロセスを壊さないため）
+SNAPSHOT_KEEP = int(os.getenv("INDEX_SNAPSHOT_KEEP", "2"))
+
+# スナップショットの形式を変えたら上げる
+SNAPSHOT_FORMAT_VERSION = 6
+
+_CURRENT_FILE = "CURRENT"
+_SNAPSHOT_PREFIX = "snapshot-"
+
+# FAISS index をメモリマップで開くフラグ
+# IO_FLAG_MMAP は IVF の転置リストしかメモリマップしない（flat は全体をメモリに読み込んでしまう）ため、
+# ベクトル本体（flat / IVF / hnsw のベクトル）をメモリマップする IO_FLAG_MMAP_IFC を使う
+# （hnsw のグラフ、IndexIDMap2 の逆引き表はメモリに読み込まれる）
+_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+# このプロセスの index がどのスナップショットの内容か（複数ワーカーで新しいものを検知するのに使う）
+loaded_snapshot: str | None = None
+
+
+def _current_snapshot(index_dir: Path) -> Path | None:
+    """
+    CURRENT が指しているスナップショットのディレクトリを返す（無ければ None）
+    """
+    current = index_dir / _CURRENT_FILE
+    if not current.exists():
+        return None
+    snapshot_dir = index_dir / current.read_text(encoding="utf-8").strip()
+    return snapshot_dir if snapshot_dir.is_dir() else None
+
+
+def current_snapshot_name(index_dir: str | Path = INDEX_DIR) -> str | None:
+    """
+    CURRENT が指しているスナップショットの名前（無ければ None）
+    """
+    snapshot_dir = _current_snapshot(Path(index_dir))
+    return snapshot_dir.name if snapshot_dir is not None else None
+
+
+def _next_snapshot_name(index_dir: Path) -> str:
+    versions = [
+        int(p.name[len(_SNAPSHOT_PREFIX):])
+        for p in index_dir.glob(f"{_SNAPSHOT_PREFIX}*")
+        if p.is_dir() and p.name[len(_SNAPSHOT_PREFIX):].isdigit()
+    ]
+    return f"{_SNAPSHOT_PREFIX}{max(versions, default=0) + 1:06d}"
+
+
+def _cleanup_snapshots(index_dir: Path, keep: int) -> None:
+    """
+    古いスナップショットを削除する（新しい順に keep 個残す）
+    """
+    snapshots = sorted(
+        p for p in index_dir.glob(f"{_SNAPSHOT_PREFIX}*")
+        if p.is_dir() and p.name[len(_SNAPSHOT_PREFIX):].isdigit()
+    )
+    for old in snapshots[:-keep] if keep > 0 else []:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def save_index(index_dir: str | Path = INDEX_DIR) -> Path:
+    """
+    現在の index と meta_data を新しいバージョンのスナップショットとして保存する
+
+    一時ディレクトリに書き出してから rename し、最後に CURRENT を
+    差し替えるので、途中で落ちても前のスナップショットは壊れない。
+
+    Returns
+    -------
+    Path
+        保存したスナップショットのディレクトリ
+    """
+    global loaded_snapshot
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    name = _next_snapshot_name(index_dir)
+    tmp_dir = index_dir / f"{name}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+
+    # 書き出し中に index とメタ情報がずれないようにロックする
+    with index_lock:
+        faiss.write_index(index, str(tmp_dir / "index.faiss"))
+
+        meta_data.save(tmp_dir)
+        lexical.save(tmp_dir)
+        deduper.save(tmp_dir)
+
+        (tmp_dir / "documents.json").write_text(
+            json.dumps(doc_manifest, ensure_ascii=False, separators=(",", ":")), encoding="utf-8"
+        )
+
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "embedding_dim": index.d,
+            "ntotal": index.ntotal,
+            "next_chunk_uid": next_chunk_uid,
+            "created_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z"),
+        }
+    (tmp_dir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    snapshot_dir = index_dir / name
+    os.replace(tmp_dir, snapshot_dir)
+
+    # CURRENT を原子的に差し替える
+    current_tmp = index_dir / f"{_CURRENT_FILE}.tmp"
+    current_tmp.write_text(name, encoding="utf-8")
+    os.replace(current_tmp, index_dir / _CURRENT_FILE)
+    loaded_snapshot = name
+
+    _cleanup_snapshots(index_dir, SNAPSHOT_KEEP)
+    print(f"FAISSスナップショットを保存しました: {snapshot_dir} (ベクトル数: {index.ntotal})")
+    return snapshot_dir
+
+
+def load_index(index_dir: str | Path = INDEX_DIR) -> bool:
+    """
+    最新のスナップショットを読み込み、index と meta_data を置き換える
+
+    FAISS index のベクトル本体とメタ情報（行配列・本文）はメモリマップで開くため、
+    大きな index でもすぐに使える（実データは必要になった分だけ OS が読み込む）。
+    hnsw のグラフはメモリマップできないので、通常どおりメモリに読み込む。
+
+    Returns
+    -------
+    bool
+        読み込めた場合は True、スナップショットが無い・壊れている場合は False
+    """
+    global index, meta_data, lexical, deduper, doc_manifest, next_chunk_uid, EMBEDDING_DIM, _mmap_path, loaded_snapshot
+
+    snapshot_dir = _current_snapshot(Path(index_dir))
+    if snapshot_dir is None:
+        return False
+
+    try:
+        manifest = json.loads((snapshot_dir / "manifest.json").read_text(encoding="utf-8"))
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            print(f"[WARN] index_manager: スナップショットの形式が異なるため読み込みません: {snapshot_dir}")
+            return False
+
+        loaded_index = faiss.read_index(str(snapshot_dir / "index.faiss"), _MMAP_FLAG)
+        loaded_meta = MetaStore.load(snapshot_dir)
+        loaded_lexical = LexicalIndex.load(snapshot_dir)
+        loaded_deduper = ChunkDeduper.load(snapshot_dir)
+        loaded_manifest = json.loads((snapshot_dir / "documents.json").read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"[ERROR] index_manager: スナップショットの読み込みに失敗しました: {snapshot_dir} エラー: {e}")
+        return False
 
-    # FAISSインデックスへ追加
-    index.add(embedding.reshape(1, -1))
+    # hnsw は削除済みのベクトルも index に残っている
+    expected = len(loaded_meta) if supports_remove(loaded_index) else loaded_meta.total_rows
+    if loaded_index.ntotal != expected:
+        print(f"[ERROR] index_manager: ベクトル数とメタ情報数が一致しません: {snapshot_dir}")
+        return False
+    if loaded_index.d != EMBEDDING_DIM:
+        print(f"[WARN] index_manager: 設定と次元数が異なるため、スナップショットの次元数を使います: {loaded_index.d} != {EMBEDDING_DIM}")
 
-    # 同じ順番でメタ情報も保存
-    meta_data.append(meta)
+    with index_lock:
+        index = loaded_index
+        meta_data = loaded_meta
+        lexical = loaded_lexical
+        deduper = loaded_deduper
+        doc_manifest = loaded_manifest
+        next_chunk_uid = max(int(manifest.get("next_chunk_uid", 0)), loaded_meta.last_id + 1)
+        EMBEDDING_DIM = loaded_index.d
+        _mmap_path = snapshot_dir / "index.faiss"
+        loaded_snapshot = snapshot_dir.name
+        configure_search(index)
+        _bump_generation()
+    print(f"FAISSスナップショットを読み込みました: {snapshot_dir} (ベクトル数: {index.ntotal})")
+    return True
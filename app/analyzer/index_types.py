@@ -0,0 +1,177 @@
+"""
+FAISS index の種類を切り替えるためのモジュール
+
+INDEX_TYPE（環境変数）で選ぶ：
+- flat : IndexFlatIP（全件を総当たり。正確だが件数に比例して遅くなる）
+- ivf  : IndexIVFFlat（クラスタに分けて nprobe 個だけ探す。学習が必要）
+- hnsw : IndexHNSWFlat（グラフ探索。efSearch で速さと精度を調整）
+
+どの種類も内積（cos類似度用）で検索し、チャンクID（64bit）を付けて登録する。
+- flat / hnsw は IndexIDMap2 で包んでIDを付ける
+- ivf はそれ自体がIDを持てるので、そのまま add_with_ids する
+ivf は学習用のベクトルが IVF_TRAIN_MIN 件たまるまでは flat のまま動かし、
+件数がそろった時点で学習して ivf に載せ替える。
+hnsw はベクトルを削除できないので、削除は検索時の除外（トゥームストーン）で扱う。
+"""
+
+from __future__ import annotations
+
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+
+# IVF の設定
+IVF_NLIST = int(os.getenv("IVF_NLIST", "1024"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+# 学習に必要な件数（FAISS の目安は nlist の 39倍以上）
+IVF_TRAIN_MIN = int(os.getenv("IVF_TRAIN_MIN", str(IVF_NLIST * 39)))
+
+# HNSW の設定
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+
+
+def create_index(dim: int, index_type: str = INDEX_TYPE) -> faiss.Index:
+    """
+    空の index を作る
+
+    ivf は学習前に使えないので、最初は flat を返す（maybe_train_ivf で載せ替える）
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"INDEX_TYPE が不正です: {index_type}（{INDEX_TYPES} のいずれか）")
+
+    if index_type == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index = faiss.IndexIDMap2(inner)
+        configure_search(index)
+        return index
+
+    # 内積（cos類似度用）で検索するシンプルなIndex
+    # 初級者向けには IndexFlatIP が一番分かりやすい
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+
+def base_index(index: faiss.Index) -> faiss.Index:
+    """
+    IndexIDMap などで包まれている場合は、中身の index を返す
+    """
+    index = faiss.downcast_index(index)
+    while hasattr(index, "id_map") and hasattr(index, "index"):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def index_type_of(index: faiss.Index) -> str:
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def configure_search(index: faiss.Index, nprobe: int = IVF_NPROBE, ef_search: int = HNSW_EF_SEARCH) -> None:
+    """
+    検索時のパラメータ（nprobe / efSearch）を設定する
+    スナップショットを読み込んだ後にも呼び、現在の設定値を反映させる
+    """
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+
+def search_parameters(index: faiss.Index, sel: faiss.IDSelector, k: int = 0) -> faiss.SearchParameters:
+    """
+    IDSelector 付きの検索パラメータを作る（nprobe / efSearch は index の設定値を引き継ぐ）
+
+    hnsw は対象が絞られるほど候補が足りなくなりやすいので、efSearch を k 以上にする
+    """
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=max(inner.hnsw.efSearch, k))
+    return faiss.SearchParameters(sel=sel)
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    """
+    remove_ids でベクトルを物理的に削除できるか（hnsw はできない）
+    """
+    return index_type_of(index) != "hnsw"
+
+
+def dump_vectors(index: faiss.Index) -> tuple[np.ndarray, np.ndarray]:
+    """
+    index に登録されている全ベクトルとそのIDを取り出す（載せ替え・再構築用）
+
+    Returns
+    -------
+    (vectors, ids) : shape = (件数, 次元数) の float32 行列と int64 のID配列
+    """
+    inner = base_index(index)
+    if index.ntotal == 0:
+        return np.empty((0, index.d), dtype="float32"), np.empty(0, dtype="int64")
+
+    if isinstance(inner, faiss.IndexIVFFlat):
+        # 転置リストごとに、IDとベクトル（IVFFlat はベクトルをそのまま持つ）を取り出す
+        invlists = inner.invlists
+        vectors, ids = [], []
+        for list_no in range(inner.nlist):
+            size = invlists.list_size(list_no)
+            if size == 0:
+                continue
+            ids.append(faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy())
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * inner.code_size).copy()
+            vectors.append(codes.view("float32").reshape(size, inner.d))
+        return np.vstack(vectors), np.concatenate(ids).astype("int64")
+
+    # IndexIDMap2：中身は登録順に並び、id_map がその順番のIDを持つ
+    ids = faiss.vector_to_array(index.id_map).astype("int64")
+    return inner.reconstruct_n(0, inner.ntotal), ids
+
+
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    """
+    index に登録されている全ベクトルを取り出す（IDが不要な場合用）
+    """
+    return dump_vectors(index)[0]
+
+
+def build_ivf(vectors: np.ndarray, ids: np.ndarray | None = None, nlist: int = IVF_NLIST) -> faiss.Index:
+    """
+    vectors で学習した IVF index を作り、vectors を ids 付きで登録して返す
+    """
+    dim = vectors.shape[1]
+    if ids is None:
+        ids = np.arange(len(vectors), dtype="int64")
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    # ID → ベクトルの取り出し・削除ができるようにしておく
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    index.add_with_ids(vectors, ids)
+    configure_search(index)
+    return index
+
+
+def maybe_train_ivf(index: faiss.Index, index_type: str = INDEX_TYPE) -> faiss.Index:
+    """
+    INDEX_TYPE=ivf で、まだ flat のまま・学習に十分な件数がたまっていれば、
+    学習して IVF に載せ替えた index を返す（それ以外はそのまま返す）
+    """
+    if index_type != "ivf" or index_type_of(index) != "flat" or index.ntotal < IVF_TRAIN_MIN:
+        return index
+
+    print(f"IVF index を学習します (ベクトル数: {index.ntotal}, nlist: {IVF_NLIST})")
+    vectors, ids = dump_vectors(index)
+    return build_ivf(vectors, ids)
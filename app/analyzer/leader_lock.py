@@ -0,0 +1,54 @@
+"""
+複数ワーカー（uvicorn --workers N）で、取り込みを行うワーカー（リーダー）を1つに決めるためのファイルロック
+
+INDEX_DIR/leader.lock の排他ロックを取れたワーカーがリーダーになる。
+ロックはプロセスが終わると OS が外すので、リーダーが落ちた場合はほかのワーカーが引き継げる。
+"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows にはないので、常にリーダーとして動く（複数ワーカーでは使えない）
+    fcntl = None
+
+_LOCK_FILE = "leader.lock"
+
+# 取得したロックのファイル（プロセスが終わるまで閉じない）
+_lock_file = None
+
+
+def try_acquire(index_dir: str | Path) -> bool:
+    """
+    リーダーのロックを取る（待たない）。取れた・既に持っている場合は True
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    if fcntl is None:
+        print("[WARN] leader_lock: ファイルロックが使えない環境のため、リーダーとして動きます")
+        _lock_file = True
+        return True
+
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    f = open(index_dir / _LOCK_FILE, "a+")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    # どのプロセスがリーダーかを分かるようにしておく
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _lock_file = f
+    return True
+
+
+def is_leader() -> bool:
+    return _lock_file is not None
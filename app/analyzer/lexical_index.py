@@ -0,0 +1,389 @@
+"""
+チャンク本文の文字 bigram による転置インデックス（BM25）
+
+日本語の形態素解析器を使わずに、規程番号・様式名・製品コードのような
+「そのままの文字列」に一致するチャンクを探すためのモジュール。
+Embedding を使わないので、Embedding API が遅い・使えないときの検索にも使う。
+
+【持ち方】
+- 本文を正規化（NFKC・小文字・空白をつめる）し、2文字ずつ区切った bigram を単語とみなす
+- チャンクには登録順の行番号（0, 1, 2, ...）を振り、転置インデックスにはチャンクIDではなく行番号を入れる
+  （チャンクIDは文書の入れ替えのたびに増えていくので、検索時に ID を添字にした配列を作らないため。
+  行番号は compact() のたびに、残っているチャンクのID順に振り直す）
+- スナップショットから読み込んだ分は、単語ごとの（行番号, 出現回数）を
+  CSR 形式の numpy 配列で持つ（件数が多くても読み込みが速い。ファイルにはチャンクIDで保存する）
+- その後に追加した分は dict に持ち、保存時（または LEXICAL_DELTA_MAX_DOCS を超えたとき）にまとめて配列に統合する
+- 削除したチャンクはすぐには消さず、検索時に除外する（保存・compact() で実際に消える）
+- 文書長（bigram 数）は行番号の順に持つ
+- 検索では、多くのチャンクに出てくる bigram（「する」「して」など）を使わず、
+  出てくるチャンクが少ない bigram から LEXICAL_MAX_QUERY_TERMS 個までを使う
+
+index_manager と同じチャンクIDを使い、index_manager のロックの中で更新・検索する。
+bigram への分解（term_counts）は時間がかかるので、ロックを取る前に行う。
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 検索に使う bigram の数の上限（出てくるチャンクが少ないものから使う）
+LEXICAL_MAX_QUERY_TERMS = int(os.getenv("LEXICAL_MAX_QUERY_TERMS", "16"))
+# この割合より多くのチャンクに出てくる bigram は検索に使わない
+# （クエリの bigram がすべて該当する場合は、上限の数までそのまま使う）
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", "0.2"))
+# 追加分のチャンク数がこれを超えたら（かつ読み込み済みの分の 1/4 以上なら）配列に統合する
+LEXICAL_DELTA_MAX_DOCS = int(os.getenv("LEXICAL_DELTA_MAX_DOCS", "10000"))
+
+_FILE = "lexical.npz"
+_TERMS_FILE = "lexical_terms.json"
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text).lower()).strip()
+
+
+def bigrams(text: str) -> list[str]:
+    """
+    正規化した文字列の bigram（空白をまたぐものは除く。1文字だけの場合はその1文字）
+    """
+    text = normalize_text(text)
+    if len(text) == 1:
+        return [text]
+    return [a + b for a, b in zip(text, text[1:]) if a != " " and b != " "]
+
+
+def term_counts(texts: list[str]) -> list[Counter]:
+    """
+    各チャンクの bigram の出現回数（LexicalIndex.add に渡す。ロックの外で計算しておく）
+    """
+    return [Counter(bigrams(text)) for text in texts]
+
+
+class LexicalIndex:
+    """
+    チャンクIDで引ける bigram の転置インデックス
+    """
+
+    def __init__(self):
+        # スナップショットから読み込んだ分（CSR 形式。_rows は行番号）
+        self._terms: dict[str, int] = {}
+        self._indptr = np.zeros(1, dtype="int64")
+        self._rows = np.empty(0, dtype="int64")
+        self._tfs = np.empty(0, dtype="int32")
+        # 行ごとのチャンクIDと文書長（bigram 数）。チャンクIDの昇順
+        self._doc_uids = np.empty(0, dtype="int64")
+        self._doc_lens = np.empty(0, dtype="int32")
+
+        # その後に追加した分 {単語: ([行番号...], [出現回数...])}
+        self._delta: dict[str, tuple[list[int], list[int]]] = {}
+        # 追加した分の行（行番号は len(_doc_uids) から順に振る）と、チャンクIDから引く文書長
+        self._delta_doc_uids: list[int] = []
+        self._delta_doc_lens: list[int] = []
+        self._delta_lens: dict[int, int] = {}
+        # 追加分を検索で使うために配列にしたもの（その単語に追加があったら作り直す）
+        self._delta_arrays: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        # 全行のチャンクIDと文書長の配列（追加があったら作り直す）
+        self._row_arrays: tuple[np.ndarray, np.ndarray] | None = None
+
+        # 削除済み（まだ取り除いていない）チャンクIDと、行ごとの削除済みの印（追加・削除があったら作り直す）
+        self._dead: set[int] = set()
+        self._dead_rows: np.ndarray | None = None
+
+        self._n_docs = 0
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return self._n_docs
+
+    # ------------------------------
+    # 更新
+    # ------------------------------
+
+    def add(self, uids, texts: list[str] | None = None, counts: list[Counter] | None = None) -> None:
+        """
+        チャンクを追加する（counts に term_counts(texts) を渡した場合は texts は使わない）
+        """
+        if counts is None:
+            counts = term_counts(texts)
+        for uid, tf_of in zip(uids, counts):
+            uid = int(uid)
+            row = len(self._doc_uids) + len(self._delta_doc_uids)
+            for term, tf in tf_of.items():
+                self._delta_arrays.pop(term, None)
+                posting = self._delta.get(term)
+                if posting is None:
+                    posting = self._delta[term] = ([], [])
+                posting[0].append(row)
+                posting[1].append(tf)
+            length = sum(tf_of.values())
+            self._delta_doc_uids.append(uid)
+            self._delta_doc_lens.append(length)
+            self._delta_lens[uid] = length
+            self._n_docs += 1
+            self._total_len += length
+        self._row_arrays = None
+        self._dead_rows = None
+
+        if len(self._delta_doc_uids) > max(LEXICAL_DELTA_MAX_DOCS, len(self._doc_uids) // 4):
+            self.compact()
+
+    def _doc_len(self, uid: int) -> int | None:
+        length = self._delta_lens.get(uid)
+        if length is not None:
+            return length
+        pos = int(np.searchsorted(self._doc_uids, uid))
+        if pos < len(self._doc_uids) and self._doc_uids[pos] == uid:
+            return int(self._doc_lens[pos])
+        return None
+
+    def remove(self, uids) -> None:
+        for uid in uids:
+            uid = int(uid)
+            if uid in self._dead:
+                continue
+            length = self._doc_len(uid)
+            if length is None:
+                continue
+            self._dead.add(uid)
+            self._n_docs -= 1
+            self._total_len -= length
+        self._dead_rows = None
+
+    def _rows_of(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        行番号を添字にした (チャンクID, 文書長) の配列
+        """
+        if self._row_arrays is None:
+            self._row_arrays = (
+                np.concatenate([self._doc_uids, np.asarray(self._delta_doc_uids, dtype="int64")]),
+                np.concatenate([self._doc_lens, np.asarray(self._delta_doc_lens, dtype="int32")]),
+            )
+        return self._row_arrays
+
+    def compact(self) -> None:
+        """
+        追加分を配列に統合し、削除済みのチャンクを取り除く（行番号はチャンクIDの順に振り直す）
+        """
+        if not self._delta_doc_uids and not self._dead:
+            return
+
+        terms = list(self._terms)
+        term_ids = dict(self._terms)
+
+        # 読み込み済みの分を（単語番号, 行番号, 出現回数）の列に展開する
+        base_terms = np.repeat(np.arange(len(terms), dtype="int64"), np.diff(self._indptr))
+        parts_t, parts_r, parts_f = [base_terms], [self._rows], [self._tfs]
+
+        # 追加分
+        for term, (rows, tfs) in self._delta.items():
+            tid = term_ids.get(term)
+            if tid is None:
+                tid = term_ids[term] = len(terms)
+                terms.append(term)
+            parts_t.append(np.full(len(rows), tid, dtype="int64"))
+            parts_r.append(np.asarray(rows, dtype="int64"))
+            parts_f.append(np.asarray(tfs, dtype="int32"))
+
+        all_t = np.concatenate(parts_t)
+        all_r = np.concatenate(parts_r)
+        all_f = np.concatenate(parts_f)
+        doc_uids, doc_lens = self._rows_of()
+
+        if self._dead:
+            dead = np.fromiter(self._dead, dtype="int64", count=len(self._dead))
+            live = ~np.isin(doc_uids, dead)
+            keep = live[all_r]
+            all_t, all_r, all_f = all_t[keep], all_r[keep], all_f[keep]
+        else:
+            live = np.ones(len(doc_uids), dtype=bool)
+
+        # 残っている行をチャンクIDの順に並べ、行番号を振り直す
+        order = np.flatnonzero(live)
+        order = order[np.argsort(doc_uids[order], kind="stable")]
+        new_row = np.full(len(doc_uids), -1, dtype="int64")
+        new_row[order] = np.arange(len(order), dtype="int64")
+
+        # 単語番号の順に並べ、CSR にする
+        by_term = np.argsort(all_t, kind="stable")
+        self._rows = new_row[all_r[by_term]]
+        self._tfs = all_f[by_term]
+        self._indptr = np.concatenate(([0], np.cumsum(np.bincount(all_t, minlength=len(terms))))).astype("int64")
+        self._terms = term_ids
+
+        self._doc_uids = doc_uids[order]
+        self._doc_lens = doc_lens[order]
+
+        self._delta = {}
+        self._delta_doc_uids = []
+        self._delta_doc_lens = []
+        self._delta_lens = {}
+        self._delta_arrays = {}
+        self._row_arrays = None
+        self._dead = set()
+        self._dead_rows = None
+
+    # ------------------------------
+    # 検索
+    # ------------------------------
+
+    def _df(self, term: str) -> int:
+        """
+        term が出てくるチャンク数（削除済みのチャンクも含む。検索に使う単語を選ぶ順番に使う）
+        """
+        df = 0
+        row = self._terms.get(term)
+        if row is not None:
+            df += int(self._indptr[row + 1] - self._indptr[row])
+        delta = self._delta.get(term)
+        if delta is not None:
+            df += len(delta[0])
+        return df
+
+    def _dead_row_mask(self) -> np.ndarray | None:
+        """
+        行番号を添字にした、削除済みかどうかの配列（削除済みが無ければ None）
+        """
+        if not self._dead:
+            return None
+        if self._dead_rows is None:
+            dead = np.fromiter(self._dead, dtype="int64", count=len(self._dead))
+            self._dead_rows = np.isin(self._rows_of()[0], dead)
+        return self._dead_rows
+
+    def _query_postings(self, query: str) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        検索に使う bigram の、削除済みを除いた (行番号, 出現回数) の配列
+
+        出てくるチャンクが少ない bigram から LEXICAL_MAX_QUERY_TERMS 個まで使い、
+        LEXICAL_MAX_DF_RATIO より多くのチャンクに出てくるものは使わない（すべて該当する場合は、それらを使う）
+        削除済みのチャンクは先に除く（削除済みのチャンクにしか出てこない bigram を選んでしまわないため。
+        compact() の前後で結果も変わらない）
+        """
+        terms = sorted((df, term) for term in set(bigrams(query)) if (df := self._df(term)) > 0)
+        dead = self._dead_row_mask()
+        max_df = max(LEXICAL_MAX_DF_RATIO * self._n_docs, 1)
+        rare, frequent = [], []
+        for _, term in terms:
+            rows, tfs = self._postings(term)
+            if dead is not None:
+                live = ~dead[rows]
+                rows, tfs = rows[live], tfs[live]
+            if len(rows) == 0:
+                continue
+            if len(rows) <= max_df:
+                rare.append((rows, tfs))
+                if len(rare) == LEXICAL_MAX_QUERY_TERMS:
+                    break
+            elif len(frequent) < LEXICAL_MAX_QUERY_TERMS:
+                frequent.append((rows, tfs))
+        return rare or frequent
+
+    def _postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        term の (行番号, 出現回数) の配列
+        """
+        rows, tfs = [], []
+        i = self._terms.get(term)
+        if i is not None:
+            start, end = self._indptr[i], self._indptr[i + 1]
+            rows.append(self._rows[start:end])
+            tfs.append(self._tfs[start:end])
+        delta = self._delta_arrays.get(term)
+        if delta is None and term in self._delta:
+            delta = self._delta_arrays[term] = (
+                np.asarray(self._delta[term][0], dtype="int64"), np.asarray(self._delta[term][1], dtype="int32")
+            )
+        if delta is not None:
+            rows.append(delta[0])
+            tfs.append(delta[1])
+        if not rows:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="int32")
+        return np.concatenate(rows), np.concatenate(tfs)
+
+    def search(self, query: str, top_k: int, allowed: np.ndarray | None = None) -> list[tuple[int, float]]:
+        """
+        BM25 のスコアが高い順に (チャンクID, スコア) を返す
+
+        allowed（昇順のチャンクID）を渡した場合は、そのチャンクだけを対象にする
+        """
+        if self._n_docs == 0:
+            return []
+        avgdl = self._total_len / self._n_docs if self._total_len else 1.0
+        row_uids, row_lens = self._rows_of()
+
+        all_rows, all_scores = [], []
+        for rows, tfs in self._query_postings(query):
+            df = len(rows)
+            idf = math.log(1 + (self._n_docs - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype("float32")
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * row_lens[rows] / avgdl)
+            all_rows.append(rows)
+            all_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not all_rows:
+            return []
+
+        # 行番号を添字にしてスコアを足し合わせる（配列の長さは行数＝チャンク数で、チャンクIDの大きさによらない）
+        scores = np.bincount(np.concatenate(all_rows), weights=np.concatenate(all_scores), minlength=len(row_uids))
+        rows = np.flatnonzero(scores)
+        scores = scores[rows]
+        uids = row_uids[rows]
+        if allowed is not None:
+            pos = np.minimum(np.searchsorted(allowed, uids), max(len(allowed) - 1, 0))
+            outside = allowed[pos] != uids if len(allowed) else np.ones(len(uids), dtype=bool)
+            scores[outside] = -np.inf
+        if len(uids) == 0:
+            return []
+
+        k = min(top_k, len(uids))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(uids[i]), float(scores[i])) for i in best if np.isfinite(scores[i])]
+
+    # ------------------------------
+    # 保存・読み込み
+    # ------------------------------
+
+    def save(self, directory: Path) -> None:
+        """
+        追加分・削除分を統合してから directory に書き出す（転置インデックスはチャンクIDで保存する）
+        """
+        self.compact()
+        directory = Path(directory)
+        np.savez(
+            directory / _FILE,
+            indptr=self._indptr, uids=self._doc_uids[self._rows], tfs=self._tfs,
+            doc_uids=self._doc_uids, doc_lens=self._doc_lens,
+        )
+        (directory / _TERMS_FILE).write_text(
+            json.dumps(list(self._terms), ensure_ascii=False, separators=(",", ":")), encoding="utf-8"
+        )
+
+    @classmethod
+    def load(cls, directory: Path) -> "LexicalIndex":
+        directory = Path(directory)
+        store = cls()
+        with np.load(directory / _FILE) as data:
+            store._indptr = data["indptr"]
+            store._tfs = data["tfs"]
+            store._doc_uids = data["doc_uids"]
+            store._doc_lens = data["doc_lens"]
+            store._rows = np.searchsorted(store._doc_uids, data["uids"]).astype("int64")
+        terms = json.loads((directory / _TERMS_FILE).read_text(encoding="utf-8"))
+        store._terms = {term: i for i, term in enumerate(terms)}
+        store._n_docs = len(store._doc_uids)
+        store._total_len = int(store._doc_lens.sum())
+        return store
@@ -0,0 +1,317 @@
+"""
+チャンクのメタ情報を列ごとの配列で持つストア
+
+list[dict] で持つと、1チャンクごとに dict と文字列オブジェクトが作られ、
+チャンク数が数百万になると本文よりもオブジェクトの管理領域の方が大きくなる。
+そこで次のように持つ：
+
+- 整数の列（チャンクID / doc / page / chunk_id / 本文の位置・長さ / 生存フラグ）は
+  numpy の構造化配列1本
+- doc_id は文字列のリストに1回だけ持ち、行には番号だけを入れる（インターン）
+- 本文は UTF-8 でつないだ1つのバイト列（スナップショットからはメモリマップで開く）
+
+チャンクID（64bit）は追加順に増える番号で、一度振ったら変わらない。
+行はチャンクIDの昇順に並ぶので、ID → 行 は二分探索で引ける。
+削除した行はすぐには詰めず、生存フラグを落とす（トゥームストーン）。
+削除済みの行が増えたら compact() で詰め直す。
+
+dict が必要なのは検索結果の上位k件だけなので、get_by_id() でその都度組み立てる。
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+from pathlib import Path
+
+import numpy as np
+
+ROW_DTYPE = np.dtype([
+    ("id", "<i8"),         # チャンクID（FAISS に登録するID）
+    ("doc", "<i4"),        # doc_ids の番号
+    ("page", "<i4"),
+    ("chunk_id", "<i4"),
+    ("text_offset", "<i8"),
+    ("text_len", "<i4"),
+    ("alive", "u1"),       # 0 = 削除済み
+])
+
+_ROWS_FILE = "meta_rows.npy"
+_DOCS_FILE = "meta_docs.json"
+_TEXT_FILE = "meta_text.bin"
+
+
+class MetaStore:
+    """
+    チャンクIDに対応するメタ情報を返すストア
+    """
+
+    def __init__(self):
+        self._rows = np.zeros(0, dtype=ROW_DTYPE)
+        self._n = 0
+        self._dead = 0
+        self.doc_ids: list[str] = []
+        self._doc_index: dict[str, int] = {}
+
+        # 文書ごとの行の範囲 [(開始, 終了), ...]
+        # 1文書のチャンクはまとめて追加されるので、範囲の数は文書数程度に収まる
+        self._doc_ranges: dict[int, list[tuple[int, int]]] = {}
+
+        # 本文：スナップショットの部分（メモリマップ）＋ その後に追加した部分
+        self._text_base: mmap.mmap | bytes = b""
+        self._text_base_len = 0
+        self._text_tail = bytearray()
+
+    # ------------------------------
+    # 内部処理
+    # ------------------------------
+
+    def _intern(self, doc_id: str) -> int:
+        idx = self._doc_index.get(doc_id)
+        if idx is None:
+            idx = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self._doc_index[doc_id] = idx
+        return idx
+
+    def _reserve(self, n: int) -> None:
+        """
+        n 行追加できるよう配列を広げる（倍々で広げて、コピー回数を抑える）
+        メモリマップで読み込んだ配列は書き込めないので、ここでメモリ上にコピーする
+        """
+        need = self._n + n
+        if need <= len(self._rows) and self._rows.flags.writeable:
+            return
+        capacity = max(need, len(self._rows) * 2, 1024)
+        rows = np.zeros(capacity, dtype=ROW_DTYPE)
+        rows[:self._n] = self._rows[:self._n]
+        self._rows = rows
+
+    def _text_bytes(self, offset: int, length: int) -> bytes:
+        if offset >= self._text_base_len:
+            start = offset - self._text_base_len
+            return bytes(self._text_tail[start:start + length])
+        return bytes(self._text_base[offset:offset + length])
+
+    def _add_range(self, code: int, start: int, end: int) -> None:
+        ranges = self._doc_ranges.setdefault(code, [])
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    def _build_doc_ranges(self) -> None:
+        """
+        doc 列から文書ごとの行の範囲を作り直す（読み込み・詰め直しの後に呼ぶ）
+        """
+        self._doc_ranges = {}
+        docs = self._rows["doc"][:self._n]
+        if self._n == 0:
+            return
+        # doc が切り替わる位置で区切る
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(docs)) + 1, [self._n]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self._add_range(int(docs[start]), int(start), int(end))
+
+    def _row_of_id(self, chunk_uid: int) -> int | None:
+        ids = self._rows["id"][:self._n]
+        row = int(np.searchsorted(ids, chunk_uid))
+        if row < self._n and ids[row] == chunk_uid:
+            return row
+        return None
+
+    # ------------------------------
+    # 公開API
+    # ------------------------------
+
+    def __len__(self) -> int:
+        """
+        生きている（削除されていない）行の数
+        """
+        return self._n - self._dead
+
+    @property
+    def total_rows(self) -> int:
+        """
+        削除済みを含めた行の数
+        """
+        return self._n
+
+    @property
+    def dead_rows(self) -> int:
+        return self._dead
+
+    @property
+    def last_id(self) -> int:
+        """
+        最後に追加したチャンクID（行が無ければ -1）
+        """
+        return int(self._rows["id"][self._n - 1]) if self._n else -1
+
+    def extend(self, ids, metas: list[dict]) -> None:
+        """
+        チャンクID と メタ情報（{"doc_id", "page", "chunk_id", "text"}）を末尾に追加する
+        チャンクIDは既存の行よりも大きい昇順の値であること
+        """
+        if not metas:
+            return
+        ids = np.asarray(ids, dtype="<i8")
+        if len(ids) != len(metas):
+            raise ValueError(f"IDの数とメタ情報の数が一致しません: {len(ids)} != {len(metas)}")
+        if ids[0] <= self.last_id or np.any(np.diff(ids) <= 0):
+            raise ValueError("チャンクIDは昇順で、既存のIDより大きい必要があります")
+        self._reserve(len(metas))
+
+        encoded = [meta["text"].encode("utf-8") for meta in metas]
+        lengths = np.array([len(e) for e in encoded], dtype="<i8")
+        start = self._text_base_len + len(self._text_tail)
+        codes = [self._intern(meta["doc_id"]) for meta in metas]
+
+        first = self._n
+        rows = self._rows[first:first + len(metas)]
+        rows["id"] = ids
+        rows["doc"] = codes
+        rows["page"] = [meta["page"] for meta in metas]
+        rows["chunk_id"] = [meta["chunk_id"] for meta in metas]
+        rows["text_offset"] = start + np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        rows["text_len"] = lengths
+        rows["alive"] = 1
+
+        self._text_tail += b"".join(encoded)
+        self._n += len(metas)
+
+        # 文書ごとの行の範囲を更新
+        run_start = 0
+        for j in range(1, len(codes) + 1):
+            if j == len(codes) or codes[j] != codes[run_start]:
+                self._add_range(codes[run_start], first + run_start, first + j)
+                run_start = j
+
+    def get_by_id(self, chunk_uid: int) -> dict | None:
+        """
+        チャンクIDのメタ情報を dict にして返す（無い・削除済みの場合は None）
+        """
+        row = self._row_of_id(chunk_uid)
+        if row is None or not self._rows["alive"][row]:
+            return None
+        r = self._rows[row]
+        return {
+            "doc_id": self.doc_ids[int(r["doc"])],
+            "page": int(r["page"]),
+            "chunk_id": int(r["chunk_id"]),
+            "text": self._text_bytes(int(r["text_offset"]), int(r["text_len"])).decode("utf-8"),
+        }
+
+    def ids_of_docs(self, doc_ids) -> np.ndarray:
+        """
+        指定した文書の、生きているチャンクのIDを返す（文書のチャンク数に比例する処理量）
+        """
+        parts = []
+        for doc_id in doc_ids:
+            code = self._doc_index.get(doc_id)
+            for start, end in self._doc_ranges.get(code, []):
+                rows = self._rows[start:end]
+                parts.append(rows["id"][rows["alive"] == 1])
+        return np.concatenate(parts).astype("int64") if parts else np.empty(0, dtype="int64")
+
+    def mark_deleted(self, chunk_uids) -> int:
+        """
+        チャンクIDの行を削除済みにする（行は残したまま。compact() で詰める）
+        """
+        uids = np.asarray(chunk_uids, dtype="<i8")
+        if len(uids) == 0:
+            return 0
+        # メモリマップのままだと書き込めないので、必要ならメモリ上にコピーする
+        self._reserve(0)
+        ids = self._rows["id"][:self._n]
+        rows = np.searchsorted(ids, uids)
+        found = rows < self._n
+        rows, uids = rows[found], uids[found]
+        rows = rows[ids[rows] == uids]
+        rows = rows[self._rows["alive"][rows] == 1]
+        self._rows["alive"][rows] = 0
+        self._dead += len(rows)
+        return len(rows)
+
+    def deleted_ids(self) -> np.ndarray:
+        """
+        削除済み（まだ詰めていない）行のチャンクID
+        """
+        rows = self._rows[:self._n]
+        return rows["id"][rows["alive"] == 0].astype("int64")
+
+    def compact(self) -> "MetaStore":
+        """
+        削除済みの行を取り除いた新しいストアを返す
+        本文も詰め直すので、削除した文書の分の領域は解放される（チャンクIDは変わらない）
+        """
+        store = MetaStore()
+        rows = self._rows[:self._n][self._rows["alive"][:self._n] == 1]
+        store._reserve(len(rows))
+
+        # doc_id は残った文書だけで振り直す
+        remap = np.full(max(len(self.doc_ids), 1), -1, dtype="<i4")
+        for code in np.unique(rows["doc"]):
+            remap[code] = store._intern(self.doc_ids[code])
+
+        text = bytearray()
+        offsets = np.empty(len(rows), dtype="<i8")
+        for j, row in enumerate(rows):
+            offsets[j] = len(text)
+            text += self._text_bytes(int(row["text_offset"]), int(row["text_len"]))
+
+        store._rows[:len(rows)] = rows
+        store._rows["doc"][:len(rows)] = remap[rows["doc"]]
+        store._rows["text_offset"][:len(rows)] = offsets
+        store._n = len(rows)
+        store._text_tail = text
+        store._build_doc_ranges()
+        return store
+
+    def nbytes(self) -> int:
+        """
+        おおよそのメモリ使用量（本文のメモリマップ部分は含めない）
+        """
+        return self._rows.nbytes + len(self._text_tail) + sum(len(d) for d in self.doc_ids)
+
+    # ------------------------------
+    # 保存・読み込み
+    # ------------------------------
+
+    def save(self, directory: Path) -> None:
+        """
+        directory に行配列・doc_id 一覧・本文バイト列を書き出す
+        """
+        directory = Path(directory)
+        np.save(directory / _ROWS_FILE, self._rows[:self._n])
+        (directory / _DOCS_FILE).write_text(
+            json.dumps(self.doc_ids, ensure_ascii=False, separators=(",", ":")), encoding="utf-8"
+        )
+        with open(directory / _TEXT_FILE, "wb") as f:
+            # 大きな本文を一度にコピーしないよう、少しずつ書き出す
+            step = 64 * 1024 * 1024
+            for start in range(0, self._text_base_len, step):
+                f.write(self._text_base[start:min(start + step, self._text_base_len)])
+            f.write(self._text_tail)
+
+    @classmethod
+    def load(cls, directory: Path) -> "MetaStore":
+        """
+        save() で書き出したストアを読み込む
+        行配列と本文はメモリマップで開くので、件数が多くてもすぐに開ける
+        """
+        directory = Path(directory)
+        store = cls()
+        store._rows = np.load(directory / _ROWS_FILE, mmap_mode="r")
+        store._n = len(store._rows)
+        store._dead = int(store._n - np.count_nonzero(store._rows["alive"]))
+        store.doc_ids = json.loads((directory / _DOCS_FILE).read_text(encoding="utf-8"))
+        store._doc_index = {d: i for i, d in enumerate(store.doc_ids)}
+        store._build_doc_ranges()
+
+        text_path = directory / _TEXT_FILE
+        if text_path.stat().st_size > 0:
+            with open(text_path, "rb") as f:
+                store._text_base = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            store._text_base_len = len(store._text_base)
+        return store
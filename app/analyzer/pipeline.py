@@ -0,0 +1,314 @@
+"""
+PDF取り込みを段階（ステージ）ごとに並列実行するパイプライン
+
+  [抽出]  プロセスプール（pypdf のCPU処理・品質の低いページの除外）
+     ↓  有界キュー
+  [要約]  スレッドプール（OpenAI API の待ち時間）
+     ↓  有界キュー
+  [分割・Embedding]  スレッドプール（Gemini API の待ち時間）
+     ↓  有界キュー
+  [登録]  呼び出し元スレッド1本（FAISS・documents.json への書き込み）
+
+キューに上限を設けているので、前段が速くても後段が詰まれば前段が待つ
+（メモリ上に抽出済みのPDFが溜まり続けない）。
+1件のPDFで例外が起きても、そのPDFだけが失敗扱いになり、ほかは処理を続ける。
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+
+from app.analyzer.file_loader import extract_pages, summarize_pages
+from app.analyzer.text_splitter import split_text_with_overlap
+from app.analyzer.embedder import get_embeddings
+from app.analyzer.text_quality import is_quality_chunk, split_pages_by_quality
+from app.analyzer.chunk_dedup import CHUNK_DEDUP_ENABLED, ChunkDeduper, Fingerprint, fingerprint
+from app.analyzer.index_manager import find_duplicates
+from app.core.metrics import INGEST_CHUNKS_TOTAL, INGEST_PAGES_TOTAL, INGEST_STAGE_SECONDS, timed
+
+# ステージごとの並列数・キューの長さ（環境変数で調整）
+# 抽出を 0 にするとプロセスプールを使わずスレッドで抽出する
+EXTRACT_WORKERS = int(os.getenv("INGEST_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+SUMMARY_WORKERS = int(os.getenv("INGEST_SUMMARY_WORKERS", "4"))
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+
+# キューの終端を表す目印
+_DONE = object()
+
+
+@dataclass
+class IngestJob:
+    """
+    パイプラインを流れるPDF1件分のデータ
+    """
+    pdf_path: str
+    doc_id: str
+    sha256: str
+    is_update: bool = False
+    pages: list[dict] = field(default_factory=list)
+    # 品質が低いため飛ばしたページ [{"page", "score", "reason"}] とチャンク数（text_quality.py）
+    skipped_pages: list[dict] = field(default_factory=list)
+    skipped_chunks: int = 0
+    summary: str = ""
+    estimated_timestamp: str = "unknown"
+    texts: list[str] = field(default_factory=list)
+    metas: list[dict] = field(default_factory=list)
+    embeddings: np.ndarray | None = None
+    fingerprints: list[Fingerprint] | None = None
+    # Embedding しなかった重複チャンクの (メタ情報, 指紋)
+    duplicates: list[tuple[dict, Fingerprint]] = field(default_factory=list)
+    error: Exception | None = None
+
+
+def _stage(
+    in_q: queue.Queue,
+    out_q: queue.Queue,
+    fn: Callable[[IngestJob], None],
+    workers: int,
+    name: str,
+) -> list[threading.Thread]:
+    """
+    in_q から取り出した job に fn を適用して out_q に流すワーカーを起動する
+
+    全ワーカーが終わったら out_q に終端の目印を1つだけ流す。
+    エラーになった job は fn を通さずにそのまま下流へ流す（登録ステージで失敗として数える）。
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            job = in_q.get()
+            if job is _DONE:
+                # ほかのワーカーにも終端を伝える
+                in_q.put(_DONE)
+                break
+            if job.error is None:
+                try:
+                    fn(job)
+                except Exception as e:
+                    job.error = e
+            out_q.put(job)
+
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                out_q.put(_DONE)
+
+    threads = [
+        threading.Thread(target=worker, name=f"ingest-{name}-{i}", daemon=True)
+        for i in range(workers)
+    ]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def _extract(path: str) -> tuple[list[dict], list[dict], float]:
+    """
+    ページを抽出し、品質の低いページを除く（プロセスプールで動かすので、トップレベルの関数にする）
+
+    メトリクスは別プロセスからは見えないので、処理時間も返して呼び出し元で記録する
+    （失敗した場合は例外の extract_seconds に入れる）
+    """
+    start = time.perf_counter()
+    try:
+        kept, skipped = split_pages_by_quality(extract_pages(path))
+    except Exception as e:
+        e.extract_seconds = time.perf_counter() - start
+        raise
+    return kept, skipped, time.perf_counter() - start
+
+
+def _summarize(job: IngestJob) -> None:
+    result = summarize_pages(job.pages, job.pdf_path, job.sha256)
+    job.summary = result["summary"]
+    job.estimated_timestamp = result["estimated_timestamp"]
+
+
+def _chunk_and_embed(job: IngestJob) -> None:
+    with timed(INGEST_STAGE_SECONDS, stage="chunk"):
+        texts, metas, unique, fps, dups = _chunk(job)
+    INGEST_CHUNKS_TOTAL.inc(job.skipped_chunks, status="skipped")
+    with timed(INGEST_STAGE_SECONDS, stage="embed"):
+        ok_ids = _embed(job, texts, metas, unique)
+
+    INGEST_CHUNKS_TOTAL.inc(len(ok_ids), status="embedded")
+    if fps is None:
+        return
+
+    job.fingerprints = [fps[unique[i]] for i in ok_ids]
+    job.duplicates = [(metas[i], fps[i]) for i, _ in dups]
+    INGEST_CHUNKS_TOTAL.inc(len(job.duplicates), status="duplicate")
+
+
+def _chunk(job: IngestJob) -> tuple[list[str], list[dict], list[int], list[Fingerprint] | None, list[tuple[int, int | None]]]:
+    """
+    ページをチャンクに分割し、Embedding するチャンクを選ぶ
+
+    Returns
+    -------
+    (texts, metas, unique, fps, dups)
+        unique : Embedding するチャンクの番号
+        fps    : チャンクごとの指紋（重複検出を使わない場合は None）
+        dups   : (重複チャンクの番号, 同じ文書内の代表チャンクの番号。登録済みのチャンクと重複する場合は None)
+    """
+    # PDF内の全チャンクを集めてから、まとめてEmbeddingする
+    texts: list[str] = []
+    metas: list[dict] = []
+    for page in job.pages:
+        # ページ文章をチャンク分割
+        chunks = split_text_with_overlap(page["text"])
+
+        for i, chunk in enumerate(chunks):
+            # 記号ばかり・文字化けなどのチャンクは Embedding しない（chunk_id は元の番号のまま）
+            if not is_quality_chunk(chunk):
+                job.skipped_chunks += 1
+                continue
+            texts.append(chunk)
+            metas.append({
+                "doc_id": job.doc_id,
+                "page": page["page"],
+                "chunk_id": i,
+                "text": chunk,
+            })
+
+    if not CHUNK_DEDUP_ENABLED:
+        return texts, metas, list(range(len(texts))), None, []
+
+    # 登録済みのチャンク・この文書の前の方のチャンクと重複するものは Embedding しない
+    fps = [fingerprint(t) for t in texts]
+    existing = find_duplicates(job.doc_id, fps)
+    local = ChunkDeduper()
+    unique: list[int] = []
+    dups: list[tuple[int, int | None]] = []
+    for i, fp in enumerate(fps):
+        if existing[i] is not None:
+            dups.append((i, None))
+            continue
+        first = local.find(fp)
+        if first is not None:
+            dups.append((i, first))
+            continue
+        local.register(i, fp)
+        unique.append(i)
+    return texts, metas, unique, fps, dups
+
+
+def _embed(job: IngestJob, texts: list[str], metas: list[dict], targets: list[int]) -> list[int]:
+    """
+    texts のうち targets の番号のチャンクをバッチでEmbeddingし、job に入れる
+
+    1件でも失敗したら、その PDF は失敗扱いにする（登録すると台帳に sha256 が残り、
+    次回以降の取り込みで欠けたチャンクが再試行されなくなるため）
+
+    Returns
+    -------
+    list[int]
+        Embedding に成功したチャンクの targets 内での番号
+    """
+    # チャンクをバッチでEmbedding（成功した分はキャッシュに入るので、次回の再試行では API を呼ばない）
+    embeddings, ok_ids = get_embeddings([texts[i] for i in targets])
+    if len(ok_ids) < len(targets):
+        INGEST_CHUNKS_TOTAL.inc(len(targets) - len(ok_ids), status="failed")
+        raise RuntimeError(f"Embeddingに失敗したチャンクがあります: {len(targets) - len(ok_ids)}/{len(targets)}")
+
+    job.texts = [texts[targets[i]] for i in ok_ids]
+    job.metas = [metas[targets[i]] for i in ok_ids]
+    job.embeddings = embeddings
+    return ok_ids
+
+
+def run_pipeline(
+    jobs: list[IngestJob],
+    on_done: Callable[[IngestJob], None],
+    extract_workers: int = EXTRACT_WORKERS,
+    summary_workers: int = SUMMARY_WORKERS,
+    embed_workers: int = EMBED_WORKERS,
+    queue_size: int = QUEUE_SIZE,
+) -> None:
+    """
+    jobs をパイプラインで処理し、完了した順に on_done(job) を呼ぶ
+
+    on_done は呼び出し元のスレッドで1件ずつ呼ばれるので、
+    index や documents.json への書き込みはロックなしで順番に行える。
+    失敗した job は job.error に例外が入った状態で渡される。
+    """
+    if not jobs:
+        return
+
+    extracted_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    summarized_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    embedded_q: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    extractor: Executor
+    if extract_workers > 0:
+        # uvicorn のプロセスはスレッド（取り込み・API クライアント・ロック）を持っているので fork せず、
+        # 新しいプロセスを起動する（fork するとロックが取られたままの状態で複製されることがある）
+        extractor = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        extractor = ThreadPoolExecutor(max_workers=1)
+
+    def feed():
+        # 抽出を投入し、結果待ちの Future ごと次段へ渡す
+        # キューが一杯なら put で待つので、抽出が先行し過ぎない
+        for job in jobs:
+            extracted_q.put((job, extractor.submit(_extract, job.pdf_path)))
+        extracted_q.put(_DONE)
+
+    def wait_extracted(item) -> IngestJob:
+        job, future = item
+        try:
+            job.pages, job.skipped_pages, seconds = future.result()
+        except Exception as e:
+            job.error = e
+            if (seconds := getattr(e, "extract_seconds", None)) is not None:
+                INGEST_STAGE_SECONDS.observe(seconds, stage="extract", outcome="error")
+            return job
+        INGEST_STAGE_SECONDS.observe(seconds, stage="extract", outcome="ok")
+        INGEST_PAGES_TOTAL.inc(len(job.pages), status="kept")
+        INGEST_PAGES_TOTAL.inc(len(job.skipped_pages), status="skipped")
+        return job
+
+    # 抽出結果の受け取りは要約ステージの入口で行う
+    extract_out_q: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    def unwrap():
+        while True:
+            item = extracted_q.get()
+            if item is _DONE:
+                extract_out_q.put(_DONE)
+                break
+            extract_out_q.put(wait_extracted(item))
+
+    try:
+        threads = [
+            threading.Thread(target=feed, name="ingest-feed", daemon=True),
+            threading.Thread(target=unwrap, name="ingest-extract", daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        threads += _stage(extract_out_q, summarized_q, _summarize, max(summary_workers, 1), "summary")
+        threads += _stage(summarized_q, embedded_q, _chunk_and_embed, max(embed_workers, 1), "embed")
+
+        # 登録ステージ（呼び出し元スレッド）
+        while True:
+            job = embedded_q.get()
+            if job is _DONE:
+                break
+            on_done(job)
+
+        for t in threads:
+            t.join()
+    finally:
+        extractor.shutdown(wait=True)
@@ -0,0 +1,86 @@
+"""
+文書要約のキャッシュ
+
+同じ内容のPDF（同じ sha256）の要約・推定更新日を、二度 API に問い合わせないためのモジュール。
+再取り込み（PIPELINE_VERSION を上げた場合・スナップショットを消した場合など）で効く。
+
+- キー : sha256(ファイルの sha256 + モデル名 + プロンプトのバージョン)
+- 保存先 : SQLite（件数は文書数程度なので、メモリ上のキャッシュは持たない）
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SUMMARY_CACHE_ENABLED = os.getenv("SUMMARY_CACHE_ENABLED", "true").lower() == "true"
+SUMMARY_CACHE_PATH = Path(os.getenv("SUMMARY_CACHE_PATH", "data/cache/summaries.sqlite3"))
+
+
+def cache_key(file_sha256: str, model: str, prompt_version: int) -> str:
+    return hashlib.sha256(f"{file_sha256}\0{model}\0{prompt_version}".encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    SQLite に保存する要約キャッシュ（スレッドセーフ）
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        """
+        初回アクセス時に SQLite を開く（import 時にファイルを作らないため）
+        """
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " key TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL,"
+                " estimated_timestamp TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT summary, estimated_timestamp FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {"summary": row[0], "estimated_timestamp": row[1]}
+
+    def put(self, key: str, result: dict) -> None:
+        with self._lock:
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, summary, estimated_timestamp, created_at) VALUES (?, ?, ?, ?)",
+                (key, result["summary"], result["estimated_timestamp"], time.time()),
+            )
+            conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+# アプリ全体で共有するキャッシュ（無効化されている場合は None）
+summary_cache: SummaryCache | None = SummaryCache(SUMMARY_CACHE_PATH) if SUMMARY_CACHE_ENABLED else None
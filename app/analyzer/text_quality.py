@@ -0,0 +1,105 @@
+"""
+抽出した文章の品質を、API を使わずにローカルで採点するモジュール
+
+スキャンPDF（文字が無い・文字化けしたテキスト層）や表ばかりのページからは、
+記号や1文字ずつの断片のような文章が取り出される。
+これをそのまま Embedding すると、API 呼び出しと index の容量が無駄になり、検索の邪魔にもなる。
+
+採点（0〜1）は次の4つの掛け算で、一番低かった項目を理由として返す：
+- short    : 空白を除いた文字数が少ない
+- symbols  : 文字（かな・漢字・英字）の割合が低い（数字は半分だけ文字として数える）
+- repeated : 同じ2文字の並びばかり（罫線・「・・・・」・同じ語の繰り返しなど）
+- garbled  : 文字化け（U+FFFD・私用領域・制御文字）が多い
+
+しきい値未満のページ・チャンクは Embedding せずに飛ばし、文書レコードに記録する。
+"""
+
+from __future__ import annotations
+
+import os
+import unicodedata
+
+# 品質による除外を行うか
+TEXT_QUALITY_ENABLED = os.getenv("TEXT_QUALITY_ENABLED", "true").lower() == "true"
+
+# これ未満のページは要約・チャンク分割の対象にしない
+TEXT_QUALITY_MIN_PAGE = float(os.getenv("TEXT_QUALITY_MIN_PAGE", "0.3"))
+
+# これ未満のチャンクは Embedding しない
+TEXT_QUALITY_MIN_CHUNK = float(os.getenv("TEXT_QUALITY_MIN_CHUNK", "0.3"))
+
+# 採点の目安（この値以上なら、その項目は満点）
+_FULL_CHARS = 20            # 空白を除いた文字数（表紙・見出しだけのページも残る程度）
+_FULL_LETTER_RATIO = 0.5    # 文字の割合
+_FULL_BIGRAM_RATIO = 0.3    # 異なる2文字の並びの割合
+_GARBLED_PENALTY = 10       # 文字化けの割合 × この値 だけ減点
+
+_GARBLED_CATEGORIES = {"Co", "Cn", "Cc", "Cs"}
+
+
+def score_text(text: str) -> tuple[float, str]:
+    """
+    文章の品質を採点する
+
+    Returns
+    -------
+    (score, reason) : 0〜1 の点数と、一番低かった項目の名前（問題が無ければ "ok"）
+    """
+    chars = "".join(text.split())
+    n = len(chars)
+    if n == 0:
+        return 0.0, "short"
+
+    letters = digits = garbled = 0
+    for ch in chars:
+        category = unicodedata.category(ch)
+        if category[0] == "L":
+            letters += 1
+        elif category == "Nd":
+            digits += 1
+        elif ch == "\ufffd" or category in _GARBLED_CATEGORIES:
+            garbled += 1
+
+    bigrams = n - 1
+    diversity = len({chars[i:i + 2] for i in range(bigrams)}) / bigrams if bigrams >= 20 else 1.0
+
+    components = {
+        "short": min(n / _FULL_CHARS, 1.0),
+        "symbols": min((letters + 0.5 * digits) / n / _FULL_LETTER_RATIO, 1.0),
+        "repeated": min(diversity / _FULL_BIGRAM_RATIO, 1.0),
+        "garbled": max(1.0 - garbled / n * _GARBLED_PENALTY, 0.0),
+    }
+    score = 1.0
+    for value in components.values():
+        score *= value
+    reason = min(components, key=components.get)
+    return round(score, 4), reason if components[reason] < 1.0 else "ok"
+
+
+def split_pages_by_quality(pages: list[dict], min_score: float = TEXT_QUALITY_MIN_PAGE) -> tuple[list[dict], list[dict]]:
+    """
+    ページを品質で振り分ける
+
+    Returns
+    -------
+    (kept, skipped)
+        kept    : しきい値以上のページ（extract_pages と同じ形）
+        skipped : 飛ばしたページ [{"page", "score", "reason"}, ...]
+    """
+    if not TEXT_QUALITY_ENABLED:
+        return pages, []
+    kept, skipped = [], []
+    for page in pages:
+        score, reason = score_text(page["text"])
+        if score < min_score:
+            skipped.append({"page": page["page"], "score": score, "reason": reason})
+        else:
+            kept.append(page)
+    return kept, skipped
+
+
+def is_quality_chunk(text: str, min_score: float = TEXT_QUALITY_MIN_CHUNK) -> bool:
+    """
+    チャンクを Embedding する価値があるか
+    """
+    return not TEXT_QUALITY_ENABLED or score_text(text)[0] >= min_score
@@ -2,10 +2,16 @@
 文章をEmbedding用のサイズに分割するモジュール
 """
 
+# チャンクの文字数と、隣のチャンクと重ねる文字数
+# （chunk_id が i のチャンクは、ページ本文の i * (CHUNK_SIZE - CHUNK_OVERLAP) 文字目から始まる）
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 80
+
+
 def split_text_with_overlap(
     text: str,
-    chunk_size: int = 400,
-    overlap: int = 80,
+    chunk_size: int = CHUNK_SIZE,
+    overlap: int = CHUNK_OVERLAP,
 ) -> list[str]:
 
     chunks = []
@@ -0,0 +1,162 @@
+"""
+ベンチマーク用の合成PDFコーパスを作るモジュール
+
+外部のライブラリを使わず、pypdf で文字を取り出せる最小限のPDFを書き出す。
+（標準フォントの Helvetica を使うので、本文は英数字だけ）
+
+- 文書ごとに「話題」の単語を決め、本文はその単語を多めに使った文で作る
+  （質問に話題の単語を入れると、その話題の文書が検索上位に来る）
+- 各ページには定型のヘッダー・フッターを入れる（重複チャンクの検出の負荷も含めて測るため）
+- 内容は seed で決まる
+"""
+
+from __future__ import annotations
+
+import random
+from pathlib import Path
+
+_SYLLABLES = [
+    "ka", "ki", "ku", "ke", "ko", "sa", "shi", "su", "se", "so", "ta", "chi", "tsu", "te", "to",
+    "na", "ni", "nu", "ne", "no", "ha", "hi", "fu", "he", "ho", "ma", "mi", "mu", "me", "mo",
+    "ra", "ri", "ru", "re", "ro", "ya", "yu", "yo", "wa", "n",
+]
+
+_HEADER = "ACME Corporation internal document. Do not distribute outside the company without approval."
+_FOOTER = "This document is managed by the general affairs department. Confidential."
+
+# 1ページあたりの文字数・1行の文字数
+PAGE_CHARS = 1500
+_LINE_CHARS = 90
+
+
+def vocabulary(size: int, seed: int = 0) -> list[str]:
+    """
+    重複のない疑似単語を size 個作る
+    """
+    rng = random.Random(seed)
+    words: set[str] = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def _sentence(rng: random.Random, topic: list[str], common: list[str]) -> str:
+    words = [rng.choice(topic) if rng.random() < 0.4 else rng.choice(common) for _ in range(rng.randint(6, 14))]
+    return " ".join(words).capitalize() + "."
+
+
+def page_texts(doc_no: int, pages: int, topic: list[str], common: list[str], seed: int = 0) -> list[str]:
+    """
+    文書1件分のページ本文
+    """
+    rng = random.Random(seed * 1_000_003 + doc_no)
+    texts = []
+    for page in range(1, pages + 1):
+        body = []
+        length = 0
+        while length < PAGE_CHARS:
+            sentence = _sentence(rng, topic, common)
+            body.append(sentence)
+            length += len(sentence) + 1
+        texts.append(f"{_HEADER}\nDocument {doc_no} page {page}\n{' '.join(body)}\n{_FOOTER}")
+    return texts
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str | Path, pages: list[str]) -> None:
+    """
+    ページごとの本文（英数字）を、文字を取り出せるPDFとして書き出す
+    """
+    objects: list[bytes] = [
+        b"<</Type/Catalog/Pages 2 0 R>>",
+        ("<</Type/Pages/Kids[" + " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages))) + f"]/Count {len(pages)}>>").encode(),
+        b"<</Type/Font/Subtype/Type1/BaseFont/Helvetica>>",
+    ]
+    for i, text in enumerate(pages):
+        lines = []
+        for paragraph in text.split("\n"):
+            lines += [paragraph[j:j + _LINE_CHARS] for j in range(0, len(paragraph), _LINE_CHARS)] or [""]
+        stream = "BT /F1 8 Tf 10 TL 20 770 Td " + " ".join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        data = stream.encode("latin-1", errors="replace")
+        objects.append(
+            f"<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Resources<</Font<</F1 3 0 R>>>>/Contents {5 + 2 * i} 0 R>>".encode()
+        )
+        objects.append(f"<</Length {len(data)}>>stream\n".encode() + data + b"\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj".encode() + body + b"endobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer<</Size {len(objects) + 1}/Root 1 0 R>>\nstartxref\n{xref}\n%%EOF".encode()
+    Path(path).write_bytes(bytes(out))
+
+
+class SyntheticCorpus:
+    """
+    合成コーパス（文書ごとの話題の単語を覚えておき、質問文を作れるようにする）
+    """
+
+    def __init__(self, n_topics: int = 20, topic_words: int = 30, common_words: int = 400, seed: int = 0):
+        words = vocabulary(n_topics * topic_words + common_words, seed)
+        rng = random.Random(seed)
+        rng.shuffle(words)
+        self.common = words[:common_words]
+        self.topics = [
+            words[common_words + i * topic_words: common_words + (i + 1) * topic_words] for i in range(n_topics)
+        ]
+        self.seed = seed
+
+    def topic_of(self, doc_no: int) -> list[str]:
+        return self.topics[doc_no % len(self.topics)]
+
+    def write(self, out_dir: str | Path, n_docs: int, pages: int) -> list[Path]:
+        """
+        out_dir に doc00000.pdf ... を書き出す
+
+        Returns
+        -------
+        list[Path]
+            書き出したPDFのパス
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for doc_no in range(n_docs):
+            path = out_dir / f"doc{doc_no:05d}.pdf"
+            write_pdf(path, page_texts(doc_no, pages, self.topic_of(doc_no), self.common, self.seed))
+            paths.append(path)
+        return paths
+
+    def chunks(self, n: int, start: int = 0, chars: int = 500) -> list[str]:
+        """
+        PDFを経由せずに、チャンク相当の文章を n 件作る（検索のベンチマークで index を大きくする用）
+        """
+        texts = []
+        for i in range(start, start + n):
+            rng = random.Random(self.seed * 1_000_003 + i)
+            topic = self.topic_of(i)
+            parts: list[str] = []
+            while sum(len(p) + 1 for p in parts) < chars:
+                parts.append(_sentence(rng, topic, self.common))
+            texts.append(" ".join(parts))
+        return texts
+
+    def questions(self, n: int, seed: int = 1) -> list[str]:
+        """
+        話題の単語を含む質問文を n 件作る
+        """
+        rng = random.Random(self.seed * 7919 + seed)
+        questions = []
+        for _ in range(n):
+            topic = rng.choice(self.topics)
+            words = rng.sample(topic, 3) + rng.sample(self.common, 2)
+            questions.append(f"What does the policy say about {' '.join(words)}?")
+        return questions
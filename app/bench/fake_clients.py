@@ -0,0 +1,293 @@
+"""
+ベンチマーク用の偽の Gemini / OpenAI クライアント
+
+API の利用枠を使わずに性能を測るため、本物のクライアントと同じ呼び出し方
+（models.embed_content / chat.completions.create）で、決まった結果を返す。
+app/core/clients.py の set_clients() で差し替えて使う（install() を参照）。
+
+- Embedding : 単語ごとのハッシュを足し合わせたベクトル（同じ単語を含む文章ほど近くなる）
+- 回答生成  : プロンプトに "JSON" を含む場合は要約の JSON、それ以外は決まった回答文
+- 待ち時間  : 1回あたりの固定時間 ＋ 件数・文字数に比例する時間（± ばらつき）
+- エラー    : 指定した割合で FakeUpstreamError（429 / 500 など）を投げる
+
+結果・エラーの出方は seed で決まるので、コミット間で同じ条件で比べられる。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import types
+from dataclasses import dataclass
+
+import numpy as np
+
+_WORD = re.compile(r"\w+")
+
+
+@dataclass
+class FakeLatency:
+    """
+    1回の呼び出しにかける待ち時間（ミリ秒）
+    """
+    base_ms: float = 0.0        # 1回あたり
+    per_item_ms: float = 0.0    # Embedding の文章1件あたり
+    per_kchar_ms: float = 0.0   # 入力1000文字あたり
+    jitter: float = 0.0         # ばらつき（0.2 なら ±20%）
+
+    def seconds(self, rng: random.Random, items: int = 1, chars: int = 0) -> float:
+        ms = self.base_ms + self.per_item_ms * items + self.per_kchar_ms * chars / 1000
+        if self.jitter:
+            ms *= 1 + rng.uniform(-self.jitter, self.jitter)
+        return max(ms, 0.0) / 1000
+
+
+class FakeUpstreamError(Exception):
+    """
+    偽の API エラー（本物の SDK の例外と同じく、ステータスコードと応答ヘッダーを持つ）
+    """
+
+    def __init__(self, status_code: int, retry_after: float | None = None):
+        super().__init__(f"fake upstream error: {status_code}")
+        self.status_code = status_code
+        self.code = status_code
+        self.headers = {} if retry_after is None else {"retry-after": str(retry_after)}
+
+
+class _Behavior:
+    """
+    待ち時間とエラーの出方（乱数はスレッド間で共有するのでロックを取る）
+    """
+
+    def __init__(self, latency: FakeLatency, error_rate: float, error_status: int, retry_after: float | None, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def plan(self, items: int = 1, chars: int = 0) -> tuple[float, FakeUpstreamError | None]:
+        """
+        この呼び出しの (待ち時間, 投げるエラー) を決める
+        """
+        with self._lock:
+            self.calls += 1
+            delay = self.latency.seconds(self._rng, items, chars)
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.errors += 1
+                return delay, FakeUpstreamError(self.error_status, self.retry_after)
+        return delay, None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors}
+
+
+# ----------------------------------------
+# Gemini（Embedding）
+# ----------------------------------------
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    """
+    単語ごとに決まった位置・符号を足し合わせたベクトル（L2正規化済み）
+    """
+    vec = np.zeros(dim, dtype="float32")
+    for word in _WORD.findall(text.lower()):
+        h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        vec[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = float(np.linalg.norm(vec))
+    if norm == 0:
+        vec[0] = 1.0
+        return vec
+    return vec / norm
+
+
+class _FakeGeminiModels:
+    def __init__(self, behavior: _Behavior, dim: int):
+        self._behavior = behavior
+        self._dim = dim
+
+    def _respond(self, contents) -> types.SimpleNamespace:
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        return types.SimpleNamespace(embeddings=[
+            types.SimpleNamespace(values=fake_embedding(t, self._dim).tolist()) for t in texts
+        ])
+
+    def _plan(self, contents) -> tuple[float, FakeUpstreamError | None]:
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        return self._behavior.plan(items=len(texts), chars=sum(len(t) for t in texts))
+
+    def embed_content(self, model: str, contents, config=None):
+        delay, error = self._plan(contents)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return self._respond(contents)
+
+
+class _FakeGeminiAsyncModels:
+    def __init__(self, models: _FakeGeminiModels):
+        self._models = models
+
+    async def embed_content(self, model: str, contents, config=None):
+        delay, error = self._models._plan(contents)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return self._models._respond(contents)
+
+
+class FakeGeminiClient:
+    """
+    genai.Client の代わり（models.embed_content と aio.models.embed_content だけを持つ）
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        latency: FakeLatency | None = None,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float | None = None,
+        seed: int = 0,
+    ):
+        self.behavior = _Behavior(latency or FakeLatency(), error_rate, error_status, retry_after, seed)
+        self.models = _FakeGeminiModels(self.behavior, dim)
+        self.aio = types.SimpleNamespace(models=_FakeGeminiAsyncModels(self.models))
+
+
+# ----------------------------------------
+# OpenAI（回答生成・要約）
+# ----------------------------------------
+
+FAKE_SUMMARY = {"summary": "ベンチマーク用の要約です。", "estimated_timestamp": "2024-01-01"}
+FAKE_ANSWER = "ベンチマーク用の回答です。資料の内容に基づいて回答しています。"
+
+
+def _prompt_of(messages: list[dict]) -> str:
+    return "\n".join(str(m.get("content", "")) for m in messages)
+
+
+def _reply(prompt: str) -> str:
+    return json.dumps(FAKE_SUMMARY, ensure_ascii=False) if "JSON" in prompt else FAKE_ANSWER
+
+
+def _completion(content: str) -> types.SimpleNamespace:
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class _FakeCompletions:
+    def __init__(self, behavior: _Behavior):
+        self._behavior = behavior
+
+    def create(self, model: str, messages: list[dict], **kwargs):
+        prompt = _prompt_of(messages)
+        delay, error = self._behavior.plan(chars=len(prompt))
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return _completion(_reply(prompt))
+
+
+class _FakeStream:
+    """
+    ストリーミングの応答（回答を数文字ずつ返す。待ち時間は最初の断片までと断片ごとに分ける）
+    """
+
+    def __init__(self, content: str, first_delay: float, piece_delay: float, piece_chars: int = 4):
+        self._pieces = [content[i:i + piece_chars] for i in range(0, len(content), piece_chars)]
+        self._first_delay = first_delay
+        self._piece_delay = piece_delay
+
+    async def _iterate(self):
+        await asyncio.sleep(self._first_delay)
+        for piece in self._pieces:
+            delta = types.SimpleNamespace(content=piece)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+            await asyncio.sleep(self._piece_delay)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def close(self) -> None:
+        return None
+
+
+class _FakeAsyncCompletions:
+    def __init__(self, behavior: _Behavior):
+        self._behavior = behavior
+
+    async def create(self, model: str, messages: list[dict], stream: bool = False, **kwargs):
+        prompt = _prompt_of(messages)
+        delay, error = self._behavior.plan(chars=len(prompt))
+        if error is not None:
+            await asyncio.sleep(delay)
+            raise error
+        content = _reply(prompt)
+        if stream:
+            # 待ち時間の半分を最初の断片まで、残りを断片に均等に割り振る
+            pieces = max((len(content) + 3) // 4, 1)
+            return _FakeStream(content, delay / 2, delay / 2 / pieces)
+        await asyncio.sleep(delay)
+        return _completion(content)
+
+
+class FakeOpenAIClient:
+    """
+    OpenAI の代わり（chat.completions.create だけを持つ）
+    """
+
+    def __init__(
+        self,
+        latency: FakeLatency | None = None,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float | None = None,
+        seed: int = 0,
+    ):
+        self.behavior = _Behavior(latency or FakeLatency(), error_rate, error_status, retry_after, seed)
+        self.chat = types.SimpleNamespace(completions=_FakeCompletions(self.behavior))
+
+
+class FakeAsyncOpenAIClient:
+    """
+    AsyncOpenAI の代わり（待ち時間・エラーの出方は同期版と共有する）
+    """
+
+    def __init__(self, sync_client: FakeOpenAIClient):
+        self.behavior = sync_client.behavior
+        self.chat = types.SimpleNamespace(completions=_FakeAsyncCompletions(self.behavior))
+
+
+def install(
+    dim: int,
+    embed_latency: FakeLatency | None = None,
+    chat_latency: FakeLatency | None = None,
+    error_rate: float = 0.0,
+    error_status: int = 429,
+    retry_after: float | None = None,
+    seed: int = 0,
+) -> tuple[FakeGeminiClient, FakeOpenAIClient]:
+    """
+    偽のクライアントを app/core/clients.py に登録する
+
+    Returns
+    -------
+    (gemini, openai)
+        呼び出し回数・エラー回数は .behavior.stats() で取れる
+    """
+    from app.core.clients import set_clients
+
+    gemini = FakeGeminiClient(dim, embed_latency, error_rate, error_status, retry_after, seed)
+    openai = FakeOpenAIClient(chat_latency, error_rate, error_status, retry_after, seed + 1)
+    set_clients(gemini=gemini, openai=openai, async_openai=FakeAsyncOpenAIClient(openai))
+    return gemini, openai
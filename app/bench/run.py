@@ -0,0 +1,357 @@
+"""
+API を呼ばずに取り込み・検索・/ask の性能を測るベンチマーク
+
+Gemini / OpenAI の代わりに偽のクライアント（fake_clients.py）を使い、
+合成PDF（corpus.py）を取り込んで次の値を測る。結果は JSON で保存できるので、コミット間で比べられる。
+
+- ingest : analyze_files() の文書数/秒・チャンク数/秒
+- search : search_chunks() の p50 / p99（index の件数ごと。合成チャンクを足して大きくする）
+- ask    : /ask の p50 / p99 とスループット（同時リクエスト数ごと）
+- workers: スナップショットを複数のプロセスで開いたときのメモリ使用量（INDEX_SHARED=true の複数ワーカー相当。Linux のみ）
+
+作業用のディレクトリ（index・文書レコード）は一時ディレクトリに作り、各種キャッシュは使わない。
+index の種類などは普段どおり環境変数（INDEX_TYPE / SEARCH_MODE など）で切り替える。
+
+例:
+    python -m app.bench.run
+    python -m app.bench.run --docs 200 --sizes 10000 100000 --concurrency 1 16 64 --json bench.json
+    python -m app.bench.run --chat-latency-ms 800 --embed-latency-ms 120 --error-rate 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from app.bench.corpus import SyntheticCorpus
+from app.bench.fake_clients import FakeLatency, fake_embedding, install
+
+
+def _configure_env(work_dir: Path, dim: int) -> None:
+    """
+    作業用ディレクトリ・次元数・キャッシュの設定（app のモジュールを import する前に呼ぶ）
+    """
+    loaded = [m for m in ("app.analyzer.index_manager", "app.db.documents_store") if m in sys.modules]
+    if loaded:
+        print(f"[WARN] bench: 設定の前に読み込まれたモジュールがあります: {loaded}")
+    os.environ["DOCUMENT_STORE"] = "json"
+    os.environ["DOCUMENTS_JSON_PATH"] = str(work_dir / "documents.json")
+    os.environ["DOCUMENTS_LOG_PATH"] = str(work_dir / "documents.jsonl")
+    os.environ["INDEX_DIR"] = str(work_dir / "index")
+    os.environ["EMBEDDING_DIM"] = str(dim)
+    os.environ["EMBED_CACHE_ENABLED"] = "false"
+    os.environ["SUMMARY_CACHE_ENABLED"] = "false"
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+
+
+def _latency_stats(seconds: list[float]) -> dict:
+    lat = np.array(seconds) * 1000
+    return {
+        "latency_ms_p50": round(float(np.percentile(lat, 50)), 4),
+        "latency_ms_p99": round(float(np.percentile(lat, 99)), 4),
+        "latency_ms_mean": round(float(lat.mean()), 4),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------------------------------------
+# 各ベンチマーク
+# ----------------------------------------
+
+def bench_ingest(corpus: SyntheticCorpus, pdf_dir: Path, n_docs: int, pages: int) -> dict:
+    """
+    合成PDFを書き出し、analyze_files() で取り込む速さを測る
+    """
+    from app.analyzer.analyzer import analyze_files
+
+    corpus.write(pdf_dir, n_docs, pages)
+    start = time.perf_counter()
+    stats = analyze_files(str(pdf_dir))
+    elapsed = time.perf_counter() - start
+    docs = stats["added"] + stats["updated"]
+    return {
+        "docs": docs,
+        "pages": docs * pages,
+        "chunks": stats["chunks"],
+        "failed": stats["failed"],
+        "elapsed_s": round(elapsed, 3),
+        "docs_per_s": round(docs / elapsed, 3),
+        "chunks_per_s": round(stats["chunks"] / elapsed, 3),
+        "stats": stats,
+    }
+
+
+def _grow_index(corpus: SyntheticCorpus, size: int, dim: int, batch: int = 10000) -> None:
+    """
+    合成チャンクを足して、index の件数を size にする
+    """
+    from app.analyzer import index_manager
+
+    while (current := len(index_manager.meta_data)) < size:
+        n = min(batch, size - current)
+        texts = corpus.chunks(n, start=current)
+        embeddings = np.vstack([fake_embedding(t, dim) for t in texts])
+        metas = [
+            {"doc_id": f"synthetic{(current + i) // 50:06d}", "page": 1, "chunk_id": (current + i) % 50, "text": t}
+            for i, t in enumerate(texts)
+        ]
+        index_manager.add_vectors(embeddings, metas)
+
+
+def bench_search(corpus: SyntheticCorpus, sizes: list[int], dim: int, n_queries: int, top_k: int) -> list[dict]:
+    """
+    index の件数ごとに search_chunks() のレイテンシを測る（クエリは1件ずつ、/ask と同じ使われ方）
+    """
+    from app.analyzer import index_manager
+    from app.finder.search import SEARCH_MODE, search_chunks
+
+    questions = corpus.questions(n_queries)
+    results = []
+    for size in sorted(sizes):
+        _grow_index(corpus, size, dim)
+        # 初回だけ遅い処理（キャッシュの作成など）を除くため、数件を先に流す
+        for q in questions[:5]:
+            try:
+                search_chunks(q, top_k)
+            except Exception:
+                pass
+        latencies = []
+        errors = 0
+        for q in questions:
+            start = time.perf_counter()
+            try:
+                search_chunks(q, top_k)
+            except Exception:
+                # エラーを注入した場合、質問文の Embedding が失敗する
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        results.append({
+            "size": len(index_manager.meta_data),
+            "index_type": index_manager.index_type_of(index_manager.index),
+            "search_mode": SEARCH_MODE,
+            "queries": len(questions),
+            "errors": errors,
+            **(_latency_stats(latencies) if latencies else {}),
+        })
+    return results
+
+
+async def _ask_once(client, question: str, top_k: int) -> tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        response = await client.get("/ask", params={"q": question, "top_k": top_k})
+        ok = response.status_code == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+async def _bench_ask(questions: list[str], concurrency: int, top_k: int) -> dict:
+    import httpx
+    from app.main import app
+
+    # lifespan（起動時の取り込み）は動かさず、アプリにだけ直接つなぐ
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(question: str) -> tuple[float, bool]:
+            async with semaphore:
+                return await _ask_once(client, question, top_k)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(q) for q in questions))
+        elapsed = time.perf_counter() - start
+
+    latencies = [lat for lat, ok in results if ok]
+    return {
+        "concurrency": concurrency,
+        "requests": len(questions),
+        "errors": sum(1 for _, ok in results if not ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(questions) / elapsed, 3),
+        **(_latency_stats(latencies) if latencies else {}),
+    }
+
+
+def bench_ask(corpus: SyntheticCorpus, n_requests: int, concurrencies: list[int], top_k: int) -> list[dict]:
+    """
+    同時リクエスト数ごとに /ask のレイテンシとスループットを測る
+    """
+    questions = corpus.questions(n_requests, seed=2)
+
+    # 上流APIのセマフォはイベントループに結び付くので、ループは1つにする
+    async def run_all() -> list[dict]:
+        return [await _bench_ask(questions, c, top_k) for c in concurrencies]
+
+    return asyncio.run(run_all())
+
+
+def _read_until(proc: subprocess.Popen, predicate) -> str | None:
+    """
+    子プロセスの出力を、predicate に合う行まで読み飛ばす（load_index のログなどが混ざるため）
+    """
+    for line in proc.stdout:
+        if predicate(line.strip()):
+            return line.strip()
+    return None
+
+
+def bench_workers(corpus: SyntheticCorpus, size: int, dim: int, n_workers: int) -> dict:
+    """
+    size 件の index をスナップショットに保存し、n_workers 個のプロセスで同時に開いたときのメモリ使用量を測る
+
+    ワーカー間で共有できている分は pss（共有ページをプロセス数で割った値）に表れる。
+    共有できていない分（ワーカーごとのコピー）は anon に表れる。
+    """
+    from app.analyzer import index_manager
+
+    _grow_index(corpus, size, dim)
+    snapshot_dir = index_manager.save_index()
+    snapshot_mb = sum(p.stat().st_size for p in snapshot_dir.iterdir()) / 1024 / 1024
+
+    root = Path(__file__).resolve().parents[2]
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "app.bench.worker_memory"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=root,
+        )
+        for _ in range(n_workers)
+    ]
+    workers = []
+    try:
+        # 全ワーカーが index を開き終わってから、同時に測る
+        for proc in procs:
+            _read_until(proc, lambda line: line == "ready" or line.startswith("{"))
+        for proc in procs:
+            proc.stdin.write("\n")
+            proc.stdin.flush()
+        for proc in procs:
+            line = _read_until(proc, lambda line: line.startswith("{") or line == "null")
+            workers.append(json.loads(line) if line else None)
+    finally:
+        for proc in procs:
+            proc.wait(timeout=60)
+
+    measured = [w for w in workers if w and "pss_mb" in w]
+    return {
+        "size": len(index_manager.meta_data),
+        "index_type": index_manager.index_type_of(index_manager.index),
+        "workers": n_workers,
+        "snapshot_mb": round(snapshot_mb, 1),
+        "per_worker": workers,
+        "total_pss_mb": round(sum(w["pss_mb"] for w in measured), 1) if measured else None,
+        "total_rss_mb": round(sum(w["rss_mb"] for w in measured), 1) if measured else None,
+    }
+
+
+# ----------------------------------------
+# 実行
+# ----------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="偽のAPIクライアントで取り込み・検索・/ask の性能を測る")
+    parser.add_argument("--docs", type=int, default=50, help="取り込む合成PDFの数")
+    parser.add_argument("--pages", type=int, default=5, help="PDF 1件あたりのページ数")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="検索を測る index の件数")
+    parser.add_argument("--queries", type=int, default=200, help="index の件数ごとの検索回数")
+    parser.add_argument("--ask-requests", type=int, default=200, help="同時リクエスト数ごとの /ask の回数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="/ask の同時リクエスト数")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=768, help="Embedding の次元数")
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="Embedding API 1回あたりの待ち時間")
+    parser.add_argument("--embed-item-latency-ms", type=float, default=0.0, help="Embedding の文章1件あたりの待ち時間")
+    parser.add_argument("--chat-latency-ms", type=float, default=0.0, help="LLM API 1回あたりの待ち時間")
+    parser.add_argument("--chat-kchar-latency-ms", type=float, default=0.0, help="LLM の入力1000文字あたりの待ち時間")
+    parser.add_argument("--jitter", type=float, default=0.0, help="待ち時間のばらつき（0.2 なら ±20%%）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="API呼び出しがエラーになる割合")
+    parser.add_argument("--error-status", type=int, default=429, help="エラーのステータスコード")
+    parser.add_argument("--retry-after", type=float, default=None, help="エラーに付ける Retry-After（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4, help="メモリ使用量を測るワーカー（プロセス）の数")
+    parser.add_argument("--worker-index-size", type=int, default=None, help="ワーカーで開く index の件数（省略時は --sizes の最大）")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["ingest", "search", "ask", "workers"], help="測らない項目")
+    parser.add_argument("--work-dir", help="作業用ディレクトリ（省略時は一時ディレクトリを作って最後に消す）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="archivist-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    _configure_env(work_dir, args.dim)
+
+    gemini, openai = install(
+        args.dim,
+        embed_latency=FakeLatency(args.embed_latency_ms, args.embed_item_latency_ms, 0.0, args.jitter),
+        chat_latency=FakeLatency(args.chat_latency_ms, 0.0, args.chat_kchar_latency_ms, args.jitter),
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    corpus = SyntheticCorpus(seed=args.seed)
+
+    result = {
+        "git_commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "env": {name: os.getenv(name) for name in ("INDEX_TYPE", "SEARCH_MODE", "CHUNK_DEDUP_ENABLED", "TEXT_QUALITY_ENABLED")},
+        "config": vars(args),
+    }
+    try:
+        if "ingest" not in args.skip:
+            result["ingest"] = bench_ingest(corpus, work_dir / "pdf", args.docs, args.pages)
+            r = result["ingest"]
+            print(f"ingest: {r['docs']} docs, {r['chunks']} chunks, {r['elapsed_s']}s "
+                  f"({r['docs_per_s']} docs/s, {r['chunks_per_s']} chunks/s, failed={r['failed']})")
+        if "search" not in args.skip:
+            result["search"] = bench_search(corpus, args.sizes, args.dim, args.queries, args.top_k)
+            print(f"{'size':>8} {'index':<6} {'mode':<8} {'p50(ms)':>9} {'p99(ms)':>9}")
+            for r in result["search"]:
+                print(f"{r['size']:>8} {r['index_type']:<6} {r['search_mode']:<8} {r.get('latency_ms_p50', float('nan')):>9.3f} "
+                      f"{r.get('latency_ms_p99', float('nan')):>9.3f}")
+        if "ask" not in args.skip:
+            result["ask"] = bench_ask(corpus, args.ask_requests, args.concurrency, args.top_k)
+            print(f"{'conc':>5} {'rps':>9} {'p50(ms)':>9} {'p99(ms)':>9} {'errors':>7}")
+            for r in result["ask"]:
+                print(f"{r['concurrency']:>5} {r['throughput_rps']:>9.2f} {r.get('latency_ms_p50', float('nan')):>9.3f} "
+                      f"{r.get('latency_ms_p99', float('nan')):>9.3f} {r['errors']:>7}")
+        if "workers" not in args.skip:
+            size = args.worker_index_size or max(args.sizes)
+            result["workers"] = r = bench_workers(corpus, size, args.dim, args.workers)
+            print(f"workers: {r['workers']} x {r['size']} vectors ({r['index_type']}), snapshot {r['snapshot_mb']} MB, "
+                  f"total pss {r['total_pss_mb']} MB, total rss {r['total_rss_mb']} MB")
+            for w in r["per_worker"]:
+                print(f"  {w}")
+        result["upstream"] = {"gemini": gemini.behavior.stats(), "openai": openai.behavior.stats()}
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+複数ワーカーのメモリ使用量を測るための子プロセス（run.py の bench_workers から起動する）
+
+INDEX_DIR のスナップショットを load_index() で開き、検索でベクトル全体に触れてから
+"ready" を出力して待つ。全ワーカーがそろった時点で親から1行受け取り、
+/proc/self/smaps_rollup の値（MB）を JSON で1行出力して終了する。
+
+- rss  : 常駐メモリ（ほかのワーカーと共有しているページも含む）
+- pss  : 共有ページをワーカー数で割った値（全ワーカーの合計が実際に使っているメモリ）
+- anon : ファイルに対応しないメモリ（ワーカーごとに持つコピー）
+"""
+
+from __future__ import annotations
+
+import json
+import sys
+
+import numpy as np
+
+_FIELDS = {"Rss:": "rss_mb", "Pss:": "pss_mb", "Anonymous:": "anon_mb"}
+
+
+def memory_usage() -> dict | None:
+    """
+    このプロセスのメモリ使用量（Linux 以外は None）
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    usage = {}
+    for line in lines:
+        parts = line.split()
+        if parts and parts[0] in _FIELDS:
+            usage[_FIELDS[parts[0]]] = round(int(parts[1]) / 1024, 1)
+    return usage
+
+
+def main() -> None:
+    from app.analyzer import index_manager
+
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    if not index_manager.load_index():
+        print(json.dumps({"error": "スナップショットを読み込めませんでした"}), flush=True)
+        return
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((n_queries, index_manager.index.d)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    index_manager.search(queries, 3)
+
+    print("ready", flush=True)
+    sys.stdin.readline()
+    print(json.dumps(memory_usage()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,406 @@
 """
 APIクライアントをグローバル変数として管理するモジュール
+
+上流API（Gemini・OpenAI）の呼び出しは call_upstream() / call_upstream_async() を通す。
+- 提供元ごとのトークンバケット（1分あたりのリクエスト数・トークン数）で、利用枠を超えないように待つ
+- 429・5xx・接続エラーは、指数バックオフ（ジッター付き）で再試行する（Retry-After があればそれに従う）
+- 同時実行数は、成功すると少しずつ増やし、429 が返ると半分に減らす（AIMD）
 """
 
 from google import genai
-from openai import OpenAI
+from google.genai import types as genai_types
+from openai import AsyncOpenAI, OpenAI
+import asyncio
 import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, TypeVar
 from dotenv import load_dotenv
+from app.core.metrics import Counter, Gauge, Histogram
 _gemini_client = None
 _openai_client = None
+_async_openai_client = None
+
+# 上流API呼び出し（Embedding・LLM）の同時実行数の上限（提供元ごと。429 が返ると自動で下げる）
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_MIN_CONCURRENCY = int(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1"))
+
+# 再試行の回数と待ち時間（秒）。待ち時間は BASE × 2^回数 を上限とした乱数（full jitter）
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "6"))
+UPSTREAM_RETRY_BASE_SECONDS = float(os.getenv("UPSTREAM_RETRY_BASE_SECONDS", "0.5"))
+UPSTREAM_RETRY_MAX_SECONDS = float(os.getenv("UPSTREAM_RETRY_MAX_SECONDS", "60"))
+
+# 提供元ごとの利用枠（1分あたり。0 なら制限しない）
+UPSTREAM_LIMITS = {
+    "gemini": (int(os.getenv("GEMINI_RPM", "0")), int(os.getenv("GEMINI_TPM", "0"))),
+    "openai": (int(os.getenv("OPENAI_RPM", "0")), int(os.getenv("OPENAI_TPM", "0"))),
+}
+
+# 再試行する HTTP ステータス
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# ステータスを持たない通信エラーのうち、再試行するもの（SDK ごとに名前が違うので、クラス名で判定する）
+_RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "ConnectError", "ConnectTimeout",
+    "ReadTimeout", "ReadError", "RemoteProtocolError", "TimeoutException",
+}
+
+T = TypeVar("T")
 
 def get_gemini_client():
     global _gemini_client
     if _gemini_client is None:
-        _gemini_client = genai.Client()
+        # 再試行は call_upstream で行うので、SDK 側では再試行しない（二重の再試行・流量制御の迂回を防ぐ）
+        _gemini_client = genai.Client(
+            http_options=genai_types.HttpOptions(retry_options=genai_types.HttpRetryOptions(attempts=1))
+        )
     return _gemini_client
 
 def get_openai_client():
     global _openai_client
     if _openai_client is None:
-        _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # 再試行は call_upstream で行うので、SDK 側では再試行しない
+        _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
     return _openai_client
+
+def get_async_gemini_client():
+    # google-genai は同じクライアントの .aio から非同期APIを使う
+    return get_gemini_client().aio
+
+def get_async_openai_client():
+    global _async_openai_client
+    if _async_openai_client is None:
+        # 再試行は call_upstream で行うので、SDK 側では再試行しない
+        _async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _async_openai_client
+
+def set_clients(gemini=None, openai=None, async_openai=None):
+    """
+    使うクライアントを差し替える（ベンチマーク・動作確認で、本物の API の代わりに偽物を使う場合など）
+    None の項目は変更しない。async_openai を省略して openai だけ渡した場合も、非同期側は変更しない。
+    """
+    global _gemini_client, _openai_client, _async_openai_client
+    if gemini is not None:
+        _gemini_client = gemini
+    if openai is not None:
+        _openai_client = openai
+    if async_openai is not None:
+        _async_openai_client = async_openai
+
+
+
+# ----------------------------------------
+# 上流API呼び出しの流量制御と再試行
+# ----------------------------------------
+
+UPSTREAM_RETRIES_TOTAL = Counter(
+    "archivist_upstream_retries_total", "上流APIの再試行の回数（status はエラーのステータス。通信エラーは network）", ["provider", "status"]
+)
+UPSTREAM_WAIT_SECONDS = Histogram(
+    "archivist_upstream_wait_seconds", "利用枠（トークンバケット・Retry-After）による待ち時間", ["provider"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0),
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "archivist_upstream_concurrency_limit", "上流APIの同時実行数の現在の上限", ["provider"]
+)
+
+
+class TokenBucket:
+    """
+    1分あたり per_minute 個まで使えるトークンバケット（0 なら制限しない）
+
+    reserve() は先に予約して残りをマイナスにし、その分の待ち時間を返す
+    （同期・非同期のどちらからも、返った秒数だけ待てばよい）
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # 1回で枠を超える量は、枠いっぱいとして扱う（永遠に待たないように）
+            self._tokens -= min(amount, self.capacity)
+            return max(-self._tokens / self.rate, 0.0)
+
+
+class AdaptiveConcurrency:
+    """
+    同時実行数の上限を自動で調整するセマフォ（スレッド・asyncio の両方から使える）
+
+    成功するたびに上限を 1/上限 ずつ増やし、429 が返ると半分にする（AIMD）
+    """
+
+    def __init__(self, name: str, maximum: int, minimum: int = 1):
+        self.name = name
+        self.maximum = max(maximum, 1)
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_waiters: deque = deque()
+        # 同じ時期にまとめて返ってきた 429 で何度も半分にしないよう、前回下げた時刻を覚えておく
+        self._last_decrease = 0.0
+        UPSTREAM_CONCURRENCY_LIMIT.set(self.limit, provider=name)
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    else:
+                        # 起こされた後に取り消された場合は、空いた枠をほかの待ちに回す
+                        self._wake()
+                raise
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self) -> None:
+        """
+        空いた枠の数だけ待っている呼び出しを起こす（_lock を持って呼ぶ）
+        """
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self._cond.notify(free)
+        while free > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if waiter.done():
+                continue
+            loop.call_soon_threadsafe(_resolve, waiter)
+            free -= 1
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self.limit < self.maximum:
+                self.limit = min(self.limit + 1.0 / self.limit, float(self.maximum))
+                UPSTREAM_CONCURRENCY_LIMIT.set(self.limit, provider=self.name)
+                self._wake()
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < 1.0:
+                return
+            self._last_decrease = now
+            self.limit = max(self.limit / 2, float(self.minimum))
+            UPSTREAM_CONCURRENCY_LIMIT.set(self.limit, provider=self.name)
+
+
+def _resolve(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _Upstream:
+    """
+    提供元1つ分の流量制御（リクエスト数・トークン数のバケット、同時実行数、Retry-After による一時停止）
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveConcurrency(name, UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MIN_CONCURRENCY)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        """
+        1回分の利用枠を予約し、呼び出す前に待つ秒数を返す
+        """
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens) if tokens else 0.0)
+        with self._lock:
+            wait = max(wait, self._paused_until - time.monotonic())
+        if wait > 0:
+            UPSTREAM_WAIT_SECONDS.observe(wait, provider=self.name)
+        return max(wait, 0.0)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Retry-After の間、この提供元への呼び出しをすべて止める
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_upstreams: dict[str, _Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(provider: str) -> _Upstream:
+    with _upstreams_lock:
+        upstream = _upstreams.get(provider)
+        if upstream is None:
+            rpm, tpm = UPSTREAM_LIMITS.get(provider, (0, 0))
+            upstream = _upstreams[provider] = _Upstream(provider, rpm, tpm)
+        return upstream
+
+
+def status_of(error: Exception) -> int | None:
+    """
+    例外の HTTP ステータス（openai は status_code、google-genai は code）
+    """
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(error, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    status = status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error: Exception) -> float | None:
+    """
+    例外の応答ヘッダーの Retry-After（秒。retry-after-ms・日付の形式にも対応）
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        headers = {str(k).lower(): v for k, v in headers.items()}
+    except AttributeError:
+        return None
+    if (ms := headers.get("retry-after-ms")) is not None:
+        try:
+            return max(float(ms) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int, error: Exception) -> float:
+    """
+    次の再試行までの秒数（Retry-After があればそれを優先する）
+    """
+    after = retry_after(error)
+    if after is not None:
+        return min(after, UPSTREAM_RETRY_MAX_SECONDS)
+    return random.uniform(0, min(UPSTREAM_RETRY_BASE_SECONDS * 2 ** attempt, UPSTREAM_RETRY_MAX_SECONDS))
+
+
+def _on_error(upstream: _Upstream, error: Exception, attempt: int) -> float | None:
+    """
+    失敗した呼び出しの後始末。再試行する場合は待つ秒数、しない場合は None を返す
+    """
+    if attempt >= UPSTREAM_MAX_RETRIES or not is_retryable(error):
+        return None
+    status = status_of(error)
+    delay = _backoff(attempt, error)
+    if status == 429:
+        upstream.concurrency.on_throttle()
+        # 利用枠が回復するまで、ほかの呼び出しも待たせる
+        if retry_after(error) is not None:
+            upstream.pause(delay)
+    UPSTREAM_RETRIES_TOTAL.inc(provider=upstream.name, status=str(status or "network"))
+    print(f"[WARN] clients: {upstream.name} の呼び出しに失敗したため {delay:.2f}秒後に再試行します"
+          f"（{attempt + 1}/{UPSTREAM_MAX_RETRIES}） エラー: {error}")
+    return delay
+
+
+def call_upstream(provider: str, fn: Callable[[], T], tokens: int = 0) -> T:
+    """
+    上流APIを呼ぶ（利用枠の待ち・同時実行数の制限・再試行つき）
+
+    Parameters
+    ----------
+    provider : str
+        "gemini" / "openai"
+    fn : Callable[[], T]
+        API を1回呼ぶ関数（再試行のたびに呼び直す）
+    tokens : int
+        この呼び出しで使うおおよそのトークン数（1分あたりのトークン数の制限に使う）
+    """
+    upstream = get_upstream(provider)
+    attempt = 0
+    while True:
+        time.sleep(upstream.reserve(tokens))
+        upstream.concurrency.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            delay = _on_error(upstream, e, attempt)
+            if delay is None:
+                raise
+        else:
+            upstream.concurrency.on_success()
+            return result
+        finally:
+            upstream.concurrency.release()
+        time.sleep(delay)
+        attempt += 1
+
+
+async def call_upstream_async(provider: str, fn: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+    """
+    call_upstream の非同期版（fn はコルーチンを返す関数）
+    """
+    upstream = get_upstream(provider)
+    attempt = 0
+    while True:
+        await asyncio.sleep(upstream.reserve(tokens))
+        await upstream.concurrency.acquire_async()
+        try:
+            result = await fn()
+        except Exception as e:
+            delay = _on_error(upstream, e, attempt)
+            if delay is None:
+                raise
+        else:
+            upstream.concurrency.on_success()
+            return result
+        finally:
+            upstream.concurrency.release()
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,291 @@
+"""
+処理時間・件数のメトリクスを集め、Prometheus のテキスト形式で出力するモジュール
+
+/metrics から Prometheus でそのまま収集できる形式で返す（外部ライブラリは使わない）。
+
+- Counter   : 増えるだけの数（API呼び出し回数・処理件数など）
+- Histogram : 処理時間などの分布（バケットごとの件数・合計・件数）
+- Gauge     : その時点の値（index のベクトル数・メモリ使用量など）
+
+ラベル（model / outcome など）の組み合わせごとに値を持つ。どのメトリクスもスレッドセーフ。
+
+=================== 利用例 ===================
+from app.core.metrics import Histogram, timed
+
+SEARCH_SECONDS = Histogram("archivist_search_seconds", "検索の処理時間", ["outcome"])
+
+with timed(SEARCH_SECONDS):   # 例外が出たら outcome="error"、出なければ outcome="ok"
+    ...
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# 処理時間（秒）の既定のバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list["_Metric"] = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: dict[str, str] | None = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in (extra or {}).items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"ラベルが一致しません: {self.name} {sorted(labels)} != {sorted(self.labelnames)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        lines += self._samples()
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    増えるだけの数
+    """
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """
+    値の分布（le 以下のバケットの累積件数・合計・件数）
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # {ラベル: [バケットごとの件数..., +Inf の件数, 合計]}
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': _format_value(bound)})} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(cumulative)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    その時点の値（set() で入れるか、set_function() で出力のたびに計算する）
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        出力のたびに function() を呼んで値にする（ラベルの無いゲージ用）
+        """
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception as e:
+                print(f"[ERROR] metrics: ゲージの計算に失敗しました: {self.name} エラー: {e}")
+                return []
+            return [f"{self.name} {_format_value(value)}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels) -> Iterator[None]:
+    """
+    with の中の処理時間を histogram に記録する
+
+    histogram のラベルに outcome がある場合は、例外なら "error"、そうでなければ "ok" を入れる
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        if "outcome" in histogram.labelnames:
+            labels["outcome"] = outcome
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def render() -> str:
+    """
+    登録されているすべてのメトリクスを Prometheus のテキスト形式で返す
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# ----------------------------------------
+# アプリで使うメトリクス
+# ----------------------------------------
+
+# 取り込み（PDF 1件あたり）: stage = extract / summarize / chunk / embed / register
+INGEST_STAGE_SECONDS = Histogram(
+    "archivist_ingest_stage_seconds", "取り込みの各段階の処理時間（PDF 1件あたり）", ["stage", "outcome"]
+)
+INGEST_PAGES_TOTAL = Counter(
+    "archivist_ingest_pages_total", "取り込んだページ数（status = kept / skipped）", ["status"]
+)
+INGEST_CHUNKS_TOTAL = Counter(
+    "archivist_ingest_chunks_total", "分割したチャンク数（status = embedded / duplicate / skipped / failed）", ["status"]
+)
+
+# Embedding: API 1回あたり（kind = single / batch）と get_embeddings() 1回あたり
+EMBEDDING_REQUEST_SECONDS = Histogram(
+    "archivist_embedding_request_seconds", "Embedding API 1回あたりの処理時間", ["model", "kind", "outcome"]
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "archivist_embedding_batch_size", "Embedding API 1回に載せた文章の数", ["model"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+EMBEDDING_CALL_SECONDS = Histogram(
+    "archivist_embedding_call_seconds", "まとめてEmbeddingする処理（キャッシュ・分割・再試行を含む）の処理時間", ["model", "outcome"]
+)
+EMBEDDING_TEXTS_TOTAL = Counter(
+    "archivist_embedding_texts_total", "Embedding した文章の数（source = cache / api / failed）", ["model", "source"]
+)
+
+# index への登録
+INDEX_ADD_SECONDS = Histogram(
+    "archivist_index_add_seconds", "index へのベクトル登録の処理時間", ["index_type", "outcome"]
+)
+INDEX_ADD_VECTORS_TOTAL = Counter(
+    "archivist_index_add_vectors_total", "index に登録したベクトルの数", ["index_type"]
+)
+
+# 質問への回答: 質問文の Embedding → 検索（backend = faiss / lexical）→ プロンプト作成 → 回答生成
+QUERY_EMBEDDING_SECONDS = Histogram(
+    "archivist_query_embedding_seconds", "質問文のEmbeddingの処理時間", ["model", "outcome"]
+)
+SEARCH_SECONDS = Histogram(
+    "archivist_search_seconds", "検索の処理時間（絞り込みありは filtered=true）", ["backend", "filtered", "outcome"]
+)
+PROMPT_BUILD_SECONDS = Histogram(
+    "archivist_prompt_build_seconds", "RAG用プロンプトの作成時間", ["outcome"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+PROMPT_CONTEXT_TOKENS = Histogram(
+    "archivist_prompt_context_tokens", "プロンプトに入れた資料のトークン数（おおよそ）",
+    buckets=(100, 250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000),
+)
+
+# LLM: purpose = answer / summary
+LLM_REQUEST_SECONDS = Histogram(
+    "archivist_llm_request_seconds", "LLM API 1回あたりの処理時間（ストリーミングは最後の断片まで）", ["model", "purpose", "outcome"]
+)
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "archivist_llm_first_token_seconds", "ストリーミングで最初の断片が届くまでの時間", ["model"]
+)
+
+# index の大きさ・メモリ使用量（index_manager で値の計算方法を設定する）
+INDEX_VECTORS = Gauge("archivist_index_vectors", "検索対象のチャンク数（削除済みを除く）")
+INDEX_NTOTAL = Gauge("archivist_index_ntotal", "FAISS index に入っているベクトル数（削除済みの残りを含む）")
+INDEX_DOCUMENTS = Gauge("archivist_index_documents", "登録済みの文書数")
+INDEX_VECTOR_BYTES = Gauge("archivist_index_vector_bytes", "FAISS index のベクトル本体のおおよそのサイズ")
+INDEX_META_BYTES = Gauge("archivist_index_meta_bytes", "メタ情報のおおよそのメモリ使用量（メモリマップ部分を除く）")
+PROCESS_RESIDENT_MEMORY_BYTES = Gauge("process_resident_memory_bytes", "プロセスの常駐メモリ（RSS）")
+
+
+def _resident_memory_bytes() -> float:
+    """
+    プロセスの常駐メモリ（Linux は /proc、それ以外は最大常駐メモリで代用）
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS はバイト、Linux は KB
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+PROCESS_RESIDENT_MEMORY_BYTES.set_function(_resident_memory_bytes)
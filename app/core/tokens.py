@@ -0,0 +1,51 @@
+"""
+トークン数の見積もり
+
+tiktoken が入っていればそれで数え、無ければ文字の種類から概算する
+（日本語は1文字 ≒ 1トークン、英数字は4文字 ≒ 1トークン。多めに見積もる方に寄せている）
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # 無くても概算で動く
+    tiktoken = None
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def estimate_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """
+    text のおおよそのトークン数
+    """
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o-mini") -> str:
+    """
+    text をおおよそ max_tokens トークン以内に切り詰める（先頭から残す）
+    """
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    if tiktoken is not None:
+        enc = _encoding(model)
+        return enc.decode(enc.encode(text, disallowed_special=())[:max_tokens])
+    # 概算の場合は、文字数の比で切ってから微調整する
+    end = max(int(len(text) * max_tokens / estimate_tokens(text, model)), 0)
+    while end > 0 and estimate_tokens(text[:end], model) > max_tokens:
+        end = int(end * 0.9)
+    return text[:end]
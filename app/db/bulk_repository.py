@@ -0,0 +1,276 @@
+# app/db/bulk_repository.py
+"""
+MySQL にまとめて書き込むためのモジュール（取り込み用）
+
+crud.py は1件ごとに commit するので、大量の文書を登録すると commit の回数だけ時間がかかる。
+ここでは複数行の INSERT をまとめて実行し、トランザクションの数を減らす。
+
+- documents：sha256 で upsert（同じ内容のPDFは同じ行を更新する）
+- chunks   ：engine_chunks 側のDBに、複数行の INSERT で書き込む
+             1ファイル分の削除・追加は必ず同じトランザクションで行う
+
+=================== 利用例 ===================
+from app.db.connect_MySQL import engine_documents, engine_chunks
+from app.db.bulk_repository import BulkDocumentWriter
+
+writer = BulkDocumentWriter(engine_documents, engine_chunks, on_flushed=lambda doc_ids: ...)
+writer.add(record, doc_id, metas)   # documents_store.build_document_record() の形のレコード
+writer.close()                      # 書き込めなかった場合は例外（書き込めなかった文書は writer.pending_doc_ids()）
+"""
+
+from __future__ import annotations
+
+import os
+from datetime import datetime
+from typing import Any, Callable, Iterable, Sequence
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.engine import Connection, Engine
+
+from app.db.mymodels_MySQL import Chunk, Document
+
+# 1回の INSERT 文に入れる行数（max_allowed_packet を超えないように）
+MYSQL_BATCH_ROWS = int(os.getenv("MYSQL_BATCH_ROWS", "1000"))
+
+# 何ファイル分たまったら書き込むか（1回の書き込み = documents / chunks それぞれ1トランザクション）
+MYSQL_FLUSH_DOCUMENTS = int(os.getenv("MYSQL_FLUSH_DOCUMENTS", "500"))
+
+# upsert で上書きしない列
+_KEEP_ON_UPDATE = {"id", "sha256", "uploaded_at", "updated_at", "access_counter"}
+
+_DOCUMENT_COLUMNS = [c.name for c in Document.__table__.columns if c.name not in ("id", "uploaded_at", "updated_at")]
+
+
+def _batches(rows: Sequence[Any], size: int) -> Iterable[Sequence[Any]]:
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _parse_datetime(value: Any) -> datetime | None:
+    """
+    ISO8601 の文字列（"2024-01-01" / "2024-01-01T00:00:00Z" など）を datetime にする
+    "unknown" など読めない値は None
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def to_document_row(record: dict[str, Any]) -> dict[str, Any]:
+    """
+    documents_store のレコードを documents テーブルの列だけの dict にする
+    """
+    row = {name: record.get(name) for name in _DOCUMENT_COLUMNS}
+    row["os_modified_date"] = _parse_datetime(row["os_modified_date"])
+    row["estimated_timestamp"] = _parse_datetime(row["estimated_timestamp"])
+    if row["content_summary"] is None:
+        row["content_summary"] = record.get("doc_summary")
+    return row
+
+
+# ============================================================
+# documents
+# ============================================================
+
+def insert_documents(conn: Connection, records: Sequence[dict[str, Any]], batch_size: int = MYSQL_BATCH_ROWS) -> int:
+    """
+    documents に複数行をまとめて追加する（commit は呼び出し側のトランザクションで行う）
+    """
+    rows = [to_document_row(r) for r in records]
+    for batch in _batches(rows, batch_size):
+        conn.execute(Document.__table__.insert().values(list(batch)))
+    return len(rows)
+
+
+def upsert_documents(conn: Connection, records: Sequence[dict[str, Any]], batch_size: int = MYSQL_BATCH_ROWS) -> dict[str, int]:
+    """
+    documents に sha256 で upsert する（同じ sha256 の行があれば更新する）
+
+    同じパスで内容が変わった（sha256 が違う）古い行は is_latest = false にする
+
+    Returns
+    -------
+    dict[str, int]
+        {sha256: documents.id}
+    """
+    rows = [to_document_row(r) for r in records if r.get("sha256")]
+    if not rows:
+        return {}
+
+    for batch in _batches(rows, batch_size):
+        stmt = mysql_insert(Document.__table__).values(list(batch))
+        stmt = stmt.on_duplicate_key_update({
+            name: stmt.inserted[name] for name in _DOCUMENT_COLUMNS if name not in _KEEP_ON_UPDATE
+        })
+        conn.execute(stmt)
+
+        conn.execute(
+            update(Document)
+            .where(Document.local_path.in_([r["local_path"] for r in batch]))
+            .where(Document.sha256.not_in([r["sha256"] for r in batch]))
+            .values(is_latest=False)
+        )
+
+    return ids_by_sha256(conn, [r["sha256"] for r in rows], batch_size)
+
+
+def ids_by_sha256(conn: Connection, sha256s: Sequence[str], batch_size: int = MYSQL_BATCH_ROWS) -> dict[str, int]:
+    ids: dict[str, int] = {}
+    for batch in _batches(list(sha256s), batch_size):
+        result = conn.execute(select(Document.sha256, Document.id).where(Document.sha256.in_(batch)))
+        ids.update({sha: doc_id for sha, doc_id in result})
+    return ids
+
+
+def mark_not_latest(conn: Connection, local_paths: Sequence[str], batch_size: int = MYSQL_BATCH_ROWS) -> int:
+    """
+    フォルダから消えたPDFの行を is_latest = false にする（行は残す）
+    """
+    count = 0
+    for batch in _batches(list(local_paths), batch_size):
+        result = conn.execute(update(Document).where(Document.local_path.in_(batch)).values(is_latest=False))
+        count += result.rowcount
+    return count
+
+
+# ============================================================
+# chunks
+# ============================================================
+
+def delete_chunks(conn: Connection, doc_ids: Sequence[str], batch_size: int = MYSQL_BATCH_ROWS) -> int:
+    count = 0
+    for batch in _batches(list(doc_ids), batch_size):
+        result = conn.execute(delete(Chunk).where(Chunk.doc_id.in_(batch)))
+        count += result.rowcount
+    return count
+
+
+def insert_chunks(conn: Connection, rows: Sequence[dict[str, Any]], batch_size: int = MYSQL_BATCH_ROWS) -> int:
+    """
+    chunks に複数行の INSERT でまとめて追加する
+
+    rows: {"doc_id", "document_sha256", "page", "chunk_id", "text"} の dict
+    """
+    for batch in _batches(list(rows), batch_size):
+        conn.execute(Chunk.__table__.insert().values(list(batch)))
+    return len(rows)
+
+
+def chunk_rows(doc_id: str, sha256: str | None, metas: Sequence[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    チャンクのメタ情報（{"doc_id", "page", "chunk_id", "text"}）を chunks の行にする
+    """
+    return [
+        {
+            "doc_id": doc_id,
+            "document_sha256": sha256,
+            "page": meta["page"],
+            "chunk_id": meta["chunk_id"],
+            "text": meta["text"],
+        }
+        for meta in metas
+    ]
+
+
+def replace_chunks(conn: Connection, doc_id: str, sha256: str | None, metas: Sequence[dict[str, Any]], batch_size: int = MYSQL_BATCH_ROWS) -> int:
+    """
+    1文書のチャンクを入れ替える（呼び出し側の1トランザクションの中で呼ぶ）
+    """
+    delete_chunks(conn, [doc_id], batch_size)
+    return insert_chunks(conn, chunk_rows(doc_id, sha256, metas), batch_size)
+
+
+# ============================================================
+# 取り込み用のまとめ書き
+# ============================================================
+
+class BulkDocumentWriter:
+    """
+    取り込んだ文書とチャンクをためておき、まとめて MySQL に書き込む（スレッドセーフではない）
+
+    flush 1回につき documents・chunks それぞれ1トランザクションで書き込む。
+    1ファイル分のチャンクの削除・追加が別のトランザクションに分かれることはない。
+
+    ためた内容は、両方のトランザクションが commit できてから手放す（失敗したら次の flush で書き直す。
+    documents は upsert、chunks は削除してから追加なので、書き直しても同じ結果になる）。
+    書き込めた文書の doc_id は on_flushed に渡す（取り込み側は、そこで初めて台帳に登録済みと記録する）。
+    """
+
+    def __init__(
+        self,
+        engine_documents: Engine,
+        engine_chunks: Engine,
+        flush_documents: int = MYSQL_FLUSH_DOCUMENTS,
+        batch_rows: int = MYSQL_BATCH_ROWS,
+        on_flushed: Callable[[list[str]], None] | None = None,
+    ):
+        self.engine_documents = engine_documents
+        self.engine_chunks = engine_chunks
+        self.flush_documents = flush_documents
+        self.batch_rows = batch_rows
+        self.on_flushed = on_flushed
+
+        # {doc_id: (レコード, チャンクの行)}（同じ文書が2回来たら新しい方で上書き）
+        self._pending: dict[str, tuple[dict[str, Any], list[dict[str, Any]]]] = {}
+        # {doc_id: local_path}（フォルダから消えた文書）
+        self._removed: dict[str, str | None] = {}
+
+        self.transactions = 0
+
+    def add(self, record: dict[str, Any], doc_id: str, metas: Sequence[dict[str, Any]]) -> None:
+        self._removed.pop(doc_id, None)
+        self._pending[doc_id] = (record, chunk_rows(doc_id, record.get("sha256"), metas))
+        if len(self._pending) >= self.flush_documents:
+            try:
+                self.flush()
+            except Exception as e:
+                # ためた内容は残っているので、次の flush（最後は close）で書き直す
+                print(f"[ERROR] bulk_repository: MySQLへの書き込みに失敗しました（次の書き込みで再試行します） エラー: {e}")
+
+    def remove(self, doc_id: str, local_path: str | None) -> None:
+        self._pending.pop(doc_id, None)
+        self._removed[doc_id] = local_path
+
+    def pending_doc_ids(self) -> list[str]:
+        """
+        まだ書き込めていない文書の doc_id
+        """
+        return list(self._pending)
+
+    def flush(self) -> None:
+        """
+        ためた内容を書き込む（失敗した場合は例外を投げ、ためた内容はそのまま残す）
+        """
+        if not self._pending and not self._removed:
+            return
+        pending = dict(self._pending)
+        removed = dict(self._removed)
+
+        records = [record for record, _ in pending.values()]
+        with self.engine_documents.begin() as conn:
+            upsert_documents(conn, records, self.batch_rows)
+            mark_not_latest(conn, [p for p in removed.values() if p], self.batch_rows)
+        self.transactions += 1
+
+        # 古いチャンクの削除と新しいチャンクの追加を同じトランザクションで行う
+        with self.engine_chunks.begin() as conn:
+            delete_chunks(conn, list(pending) + list(removed), self.batch_rows)
+            insert_chunks(conn, [row for _, rows in pending.values() for row in rows], self.batch_rows)
+        self.transactions += 1
+
+        # 両方 commit できたので手放す
+        for doc_id in pending:
+            self._pending.pop(doc_id, None)
+        for doc_id in removed:
+            self._removed.pop(doc_id, None)
+        if self.on_flushed is not None:
+            self.on_flushed(list(pending))
+
+        print(f"MySQLに書き込みました (文書: {len(pending)}, 削除: {len(removed)}, チャンク: {sum(len(rows) for _, rows in pending.values())})")
+
+    def close(self) -> None:
+        self.flush()
@@ -3,11 +3,12 @@
 一回だけ実行してテーブルを作るスクリプト
 例: python -m app.db.create_tables
 """
-from app.db.connect_MySQL import engine
-from app.db.mymodels_MySQL import Base
+from app.db.connect_MySQL import engine_documents, engine_chunks
+from app.db.mymodels_MySQL import Base, ChunksBase
 
 def main():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=engine_documents)
+    ChunksBase.metadata.create_all(bind=engine_chunks)
     print("✅ tables created")
 
 if __name__ == "__main__":
@@ -1,84 +1,69 @@
 """
 documents_store.py
 
-documents.json を「簡易データベース」として使うためのモジュール。
-PoC（試作）用に、できるだけシンプルな実装にしている。
+文書レコードを「簡易データベース」として保存するためのモジュール。
+DBやORMは使わず、1行に1レコード（JSON）を追記していくファイル（JSONL）に保存する。
 
 【このモジュールの役割】
-- PDFファイル1つにつき、documents.json に1レコードを追加する
-- DBやORMは使わない
+- PDFファイル1つにつき、1レコードを保存する（同じパスのPDFは上書き＝同じ id のまま）
 - 「PDFを読み取った事実」を残すことが目的
 
-【以下は未実施】
-- 重複チェック
-- バージョン管理
-- 排他制御
-- 高速化
+【保存の仕組み】
+- ファイルへは追記だけを行う（レコード全体を読み直して書き戻すことはしない）
+  → 件数が増えても1件の追加にかかる時間は変わらない
+- 読み込んだレコードはメモリ上に id / パス で引ける形で持つ
+- 追加したレコードはまとめて（DOCUMENTS_FLUSH_BATCH 件ごと、または flush() で）書き出す
+  書き出しは1回の write で行い、途中で落ちて最終行が欠けた場合は読み込み時に無視する
+- 書き出し時はファイルロック（fcntl）を取り、他プロセスが追記した分を先に取り込む
+- 同じレコードの古い行がたまったら、最新の行だけのファイルに作り直す（compaction）
+
+【ファイルの形式】
+- 1行 = 1レコード（documents.json と同じ形）
+- 削除は {"id": ..., "_deleted": true} の行で表す
 """
 
 from __future__ import annotations
 
+import atexit
 import json
 import os
+import threading
 from pathlib import Path
 from datetime import datetime, timezone
 from typing import Any
 
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間のロックは行わない
+    fcntl = None
+
 
 # ============================================================
 # 保存先設定
 # ============================================================
 
-# documents.json の保存場所
+# 旧形式の documents.json の場所（ログが無い場合に、ここから一度だけ移行する）
 # 環境変数があればそちらを優先（将来切り替えしやすくするため）
 DOC_PATH = Path(
     os.getenv("DOCUMENTS_JSON_PATH", "data/db_data/documents.json")
 )
 
+# レコードを追記していくファイル（既定は documents.json と同じ場所の documents.jsonl）
+DOC_LOG_PATH = Path(
+    os.getenv("DOCUMENTS_LOG_PATH", str(DOC_PATH.with_suffix(".jsonl")))
+)
 
-# ============================================================
-# 内部ユーティリティ関数
-# ============================================================
-
-def _ensure_file() -> None:
-    """
-    documents.json が存在しない場合に作成する。
-    初回実行時でもエラーにならないようにするための処理。
-    
-    現在は毎回初期化する処理にしているため、追加にする場合はif文を復活させる。
-    """
-    DOC_PATH.parent.mkdir(parents=True, exist_ok=True)
-    # if not DOC_PATH.exists():
-    DOC_PATH.write_text("[]", encoding="utf-8")
-
-
-def _read_all() -> list[dict[str, Any]]:
-    """
-    documents.json を読み込み、Pythonのlistとして返す。
-    """
-    _ensure_file()
-    text = DOC_PATH.read_text(encoding="utf-8")
-    return json.loads(text) if text else []
-
+# 何件たまったらファイルに書き出すか
+DOCUMENTS_FLUSH_BATCH = int(os.getenv("DOCUMENTS_FLUSH_BATCH", "32"))
 
-def _write_all(items: list[dict[str, Any]]) -> None:
-    """
-    Pythonのlistを documents.json に書き戻す。
-    indent を入れて、人が見やすいJSONにする。
-    """
-    DOC_PATH.write_text(
-        json.dumps(items, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+# 行数がレコード数のこの倍数を超えたら作り直す（行数が少ないうちは作り直さない）
+DOCUMENTS_COMPACT_RATIO = float(os.getenv("DOCUMENTS_COMPACT_RATIO", "2.0"))
+DOCUMENTS_COMPACT_MIN_LINES = int(os.getenv("DOCUMENTS_COMPACT_MIN_LINES", "1000"))
 
 
-def _next_id(items: list[dict[str, Any]]) -> int:
-    """
-    次に使う id を決める。
-    DBの AUTO_INCREMENT の簡易版。
-    """
-    return max([x.get("id", 0) for x in items], default=0) + 1
-
+# ============================================================
+# 内部ユーティリティ関数
+# ============================================================
 
 def _mtime_iso(path: str) -> str | None:
     """
@@ -99,39 +84,335 @@ def _mtime_iso(path: str) -> str | None:
         return None
 
 
-# ============================================================
-# 外部から呼ぶ関数（公開API）
-# ============================================================
+def _dumps(record: dict[str, Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
 
-def add_document_record(pdf_path: str, pages_count: int, summary: str, estimated_timestamp: str) -> dict[str, Any]:
+
+class _FileLock:
     """
-    documents.json に1件レコードを追加する。
+    ログと同じ場所の .lock ファイルで取るプロセス間の排他ロック
 
-    【呼び出しタイミング】
-    - load_pdf() が正常に完了した直後
+    .lock ファイルには、ログに書き込むたびに増やす番号（書き込み番号）も入れる。
+    自分が最後に見た番号と違えば、他プロセスが書き込んだと分かる。
+    （作り直しの後はサイズや inode が偶然一致することがあるため、それらでは判定しない）
+    """
 
-    【引数】
-    - pdf_path: PDFファイルのパス
-    - pages_count: PDFのページ数
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int | None = None
 
-    【戻り値】
-    - 追加したレコード（dict）
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def read_seq(self) -> int:
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        data = os.read(self._fd, 32).strip()
+        return int(data) if data else 0
+
+    def write_seq(self, seq: int) -> None:
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, f"{seq:020d}".encode("ascii"))
+
+
+class DocumentStore:
+    """
+    追記型ファイルに保存する文書レコードのストア（スレッドセーフ）
     """
-    print("add_document_record called: pdf_path=", pdf_path, " pages_count=", pages_count) # デバッグ用出力
-    items = _read_all()
-    print("_read_all() returned ", items) # デバッグ用出力
 
+    def __init__(self, path: Path, legacy_path: Path | None = None, flush_batch: int = DOCUMENTS_FLUSH_BATCH):
+        self.path = Path(path)
+        self.legacy_path = legacy_path
+        self.flush_batch = flush_batch
+
+        self._records: dict[int, dict[str, Any]] = {}
+        self._by_path: dict[str, int] = {}
+        self._next_id = 1
+        self._pending: list[dict[str, Any]] = []   # まだ書き出していない行
+
+        # ファイルのどこまで読み込んだか・最後に見た書き込み番号（他プロセスの書き込みの検出用）
+        self._offset = 0
+        self._seq = 0
+        self._lines = 0
+
+        self._lock = threading.RLock()
+        self._file_lock = _FileLock(self.path.with_name(self.path.name + ".lock"))
+
+        with self._lock, self._file_lock:
+            self._seq = self._file_lock.read_seq()
+            self._migrate_legacy()
+            self._catch_up()
+
+    # ------------------------------
+    # 読み込み
+    # ------------------------------
+
+    def _apply(self, record: dict[str, Any]) -> None:
+        """
+        1行分を、メモリ上のレコードに反映する
+        """
+        rid = record["id"]
+        old = self._records.get(rid)
+        if old is not None and self._by_path.get(old.get("local_path")) == rid:
+            del self._by_path[old.get("local_path")]
+        if record.get("_deleted"):
+            self._records.pop(rid, None)
+        else:
+            self._records[rid] = record
+            self._by_path[record.get("local_path")] = rid
+        self._next_id = max(self._next_id, rid + 1)
+
+    def _catch_up(self) -> None:
+        """
+        ファイルの、まだ読み込んでいない部分を取り込む（ファイルロックを持って呼ぶ）
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # 最終行が欠けている（書き出し途中で落ちた）場合、その行は読まない
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+            except Exception as e:
+                print(f"[ERROR] documents_store: 壊れた行を読み飛ばします: {self.path} エラー: {e}")
+                continue
+            self._lines += 1
+        self._offset += end
+
+    def _migrate_legacy(self) -> None:
+        """
+        ログがまだ無く、旧形式の documents.json があれば、その内容でログを作る
+        """
+        if self.path.exists() or self.legacy_path is None or not self.legacy_path.exists():
+            return
+        try:
+            items = json.loads(self.legacy_path.read_text(encoding="utf-8") or "[]")
+        except Exception as e:
+            print(f"[ERROR] documents_store: 旧形式のファイルを読み込めません: {self.legacy_path} エラー: {e}")
+            return
+        if items:
+            self._write_atomic(items)
+            self._bump_seq()
+            print(f"documents.json をログ形式に移行しました: {self.path} (件数: {len(items)})")
+
+    # ------------------------------
+    # 書き出し
+    # ------------------------------
+
+    def _write_atomic(self, records: list[dict[str, Any]]) -> None:
+        """
+        records だけを含むファイルを一時ファイルに書き、置き換える（ファイルロックを持って呼ぶ）
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(_dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _bump_seq(self) -> None:
+        self._seq += 1
+        self._file_lock.write_seq(self._seq)
+
+    def _reload_with_pending(self) -> None:
+        """
+        他プロセスが書き込んでいた場合に、ファイルを読み直してから
+        まだ書き出していないレコードを載せ直す（ファイルロックを持って呼ぶ）
+
+        同じパスのレコードが他プロセスで追加されていれば、その id を使う
+        """
+        self._records.clear()
+        self._by_path.clear()
+        self._next_id = 1
+        self._offset = 0
+        self._lines = 0
+        self._catch_up()
+        self._seq = self._file_lock.read_seq()
+
+        pending, self._pending = self._pending, []
+        for record in pending:
+            rid = self._by_path.get(record.get("local_path"))
+            if record.get("_deleted"):
+                if rid is None:
+                    continue
+            elif rid is None:
+                rid = self._next_id
+            record["id"] = rid
+            self._apply(record)
+            self._pending.append(record)
+
+    def flush(self) -> None:
+        """
+        たまっているレコードをファイルに書き出す
+
+        書き込み・fsync に失敗した場合は例外を投げ、レコードは次の flush で書き直す
+        （途中まで書かれた行は、次の flush の最初に切り捨てる）
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            with self._file_lock:
+                if self._file_lock.read_seq() != self._seq:
+                    self._reload_with_pending()
+                if self.path.exists() and os.path.getsize(self.path) > self._offset:
+                    # 書き出し途中で落ちた行（改行で終わっていない行）を切り捨てる
+                    os.truncate(self.path, self._offset)
+
+                pending = list(self._pending)
+                data = "".join(_dumps(r) + "\n" for r in pending).encode("utf-8")
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                # O_APPEND の1回の write で書くので、他プロセスの行と混ざらない
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    written = os.write(fd, data)
+                    if written != len(data):
+                        raise OSError(f"書き込みが途中で終わりました: {written} / {len(data)} バイト")
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                # 書き出せたことを確認してから、たまっている分から外す
+                del self._pending[:len(pending)]
+                self._bump_seq()
+
+                # 書き出した分はメモリ上に反映済みなので、読んだ位置だけ進める
+                self._offset += len(data)
+                self._lines += len(pending)
+
+                if self._lines >= DOCUMENTS_COMPACT_MIN_LINES and self._lines > len(self._records) * DOCUMENTS_COMPACT_RATIO:
+                    self._compact_locked()
+
+    def _flush_or_retry_later(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:
+            # レコードは残っているので、次の flush（最後は取り込みの終わりの flush）で書き直す
+            print(f"[ERROR] documents_store: 書き出しに失敗しました（次の書き出しで再試行します）: {self.path} エラー: {e}")
+
+    def _compact_locked(self) -> None:
+        before = self._lines
+        self._write_atomic(sorted(self._records.values(), key=lambda r: r["id"]))
+        self._offset, self._lines = os.path.getsize(self.path), len(self._records)
+        self._bump_seq()
+        print(f"documents ログを作り直しました: {self.path} (行数: {before} → {self._lines})")
+
+    def compact(self) -> None:
+        """
+        最新のレコードだけのファイルに作り直す
+        """
+        with self._lock:
+            self.flush()
+            with self._file_lock:
+                if self._file_lock.read_seq() != self._seq:
+                    self._reload_with_pending()
+                self._compact_locked()
+
+    # ------------------------------
+    # 追加・削除・参照
+    # ------------------------------
+
+    def put(self, record: dict[str, Any]) -> dict[str, Any]:
+        """
+        レコードを保存する（同じ local_path のレコードがあれば、その id で上書きする）
+        """
+        with self._lock:
+            rid = self._by_path.get(record.get("local_path"))
+            if rid is None:
+                rid = self._next_id
+            record["id"] = rid
+            self._apply(record)
+            self._pending.append(record)
+            if len(self._pending) >= self.flush_batch:
+                self._flush_or_retry_later()
+        return record
+
+    def delete_by_path(self, local_path: str) -> bool:
+        with self._lock:
+            rid = self._by_path.get(local_path)
+            if rid is None:
+                return False
+            tombstone = {"id": rid, "local_path": local_path, "_deleted": True}
+            self._apply(tombstone)
+            self._pending.append(tombstone)
+            if len(self._pending) >= self.flush_batch:
+                self._flush_or_retry_later()
+            return True
+
+    def get(self, record_id: int) -> dict[str, Any] | None:
+        with self._lock:
+            return self._records.get(record_id)
+
+    def find_by_path(self, local_path: str) -> dict[str, Any] | None:
+        with self._lock:
+            rid = self._by_path.get(local_path)
+            return None if rid is None else self._records.get(rid)
+
+    def all(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return sorted(self._records.values(), key=lambda r: r["id"])
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+# アプリ全体で共有するストア（最初に使うときに読み込む）
+_store: DocumentStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> DocumentStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DocumentStore(DOC_LOG_PATH, legacy_path=DOC_PATH)
+            atexit.register(_store.flush)
+        return _store
 
 
-    # 新しく追加するレコード
-    record = {
+# ============================================================
+# 外部から呼ぶ関数（公開API）
+# ============================================================
+
+def build_document_record(
+    pdf_path: str,
+    pages_count: int,
+    summary: str,
+    estimated_timestamp: str,
+    sha256: str | None = None,
+    skipped_pages: list[dict] | None = None,
+    skipped_chunks: int = 0,
+) -> dict[str, Any]:
+    """
+    文書レコード（dict）を作る。保存はしない。
+    JSON・MySQL のどちらに保存する場合も、この形のレコードを使う。
+    skipped_pages / skipped_chunks は、品質が低いため取り込まなかったページ・チャンク（text_quality.py）
+    """
+    return {
         # 基本情報
-        "id": _next_id(items),
+        "id": None,             # put() で決める
         "original_filename": os.path.basename(pdf_path),
         "local_path": pdf_path,
         "os_modified_date": _mtime_iso(pdf_path),
         "mime_type": "application/pdf",
-        "doc_summary": summary, 
+        "sha256": sha256,
+        "doc_summary": summary,
 
         # 管理用（PoCでは最小限）
         "status": "completed",
@@ -140,6 +421,8 @@ def add_document_record(pdf_path: str, pages_count: int, summary: str, estimated
         "is_latest": True,      # 仮置き
         "version_label": None,
         "access_counter": 0,
+        "skipped_pages_json": skipped_pages or [],   # [{"page", "score", "reason"}, ...]
+        "skipped_chunks": skipped_chunks,
 
         # AI解析結果（後で埋める前提）
         "estimated_timestamp": estimated_timestamp,
@@ -162,10 +445,63 @@ def add_document_record(pdf_path: str, pages_count: int, summary: str, estimated
         "text_density": None,
         "technical_level": None,
     }
-    # print("New record to add: ", record) # デバッグ用出力
 
-    # 追記して保存
-    items.append(record)
-    _write_all(items)
 
-    return record
+def add_document_record(
+    pdf_path: str,
+    pages_count: int,
+    summary: str,
+    estimated_timestamp: str,
+    sha256: str | None = None,
+    skipped_pages: list[dict] | None = None,
+    skipped_chunks: int = 0,
+) -> dict[str, Any]:
+    """
+    文書レコードを1件保存する（同じパスのPDFが登録済みなら、同じ id のまま上書きする）。
+
+    【呼び出しタイミング】
+    - load_pdf() が正常に完了した直後
+
+    【引数】
+    - pdf_path: PDFファイルのパス
+    - pages_count: PDFのページ数
+    - sha256: PDFファイル内容のハッシュ（差分取り込みの判定に使用）
+    - skipped_pages / skipped_chunks: 品質が低いため取り込まなかったページ・チャンク数
+
+    【戻り値】
+    - 保存したレコード（dict）
+    ファイルへの書き出しはまとめて行うので、確実に書き出したい場合は flush() を呼ぶ
+    """
+    # 新しく追加するレコード
+    record = build_document_record(pdf_path, pages_count, summary, estimated_timestamp, sha256, skipped_pages, skipped_chunks)
+
+    return get_store().put(record)
+
+
+def delete_document_record(pdf_path: str) -> bool:
+    """
+    PDFのレコードを削除する（フォルダから消えたPDF用）
+    """
+    return get_store().delete_by_path(pdf_path)
+
+
+def get_document_record(record_id: int) -> dict[str, Any] | None:
+    return get_store().get(record_id)
+
+
+def find_document_record(pdf_path: str) -> dict[str, Any] | None:
+    return get_store().find_by_path(pdf_path)
+
+
+def list_document_records() -> list[dict[str, Any]]:
+    """
+    すべてのレコードを id 順に返す（documents.json の中身と同じ形）
+    """
+    return get_store().all()
+
+
+def flush() -> None:
+    """
+    たまっているレコードをファイルに書き出す（取り込みの最後に呼ぶ）
+    """
+    get_store().flush()
@@ -1,13 +1,16 @@
 # app/db/mymodels_MySQL.py
 from sqlalchemy import (
     Column, BigInteger, Integer, String, Text, DateTime, Boolean,
-    Enum, DECIMAL, CheckConstraint, func
+    Enum, DECIMAL, CheckConstraint, Index, func
 )
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.dialects.mysql import JSON
 
 Base = declarative_base()
 
+# チャンクは別のDB（engine_chunks）に置くので、テーブル定義も分けて持つ
+ChunksBase = declarative_base()
+
 STATUS_ENUM = ("processing", "completed", "failed")
 CONTENT_TYPE_ENUM = ("technical", "business", "rules", "contract", "minute", "email", "memo", "misc")
 SECURITY_ENUM = ("public", "internal", "confidential", "secret")
@@ -34,6 +37,8 @@ class Document(Base):
     family_key = Column(String(512), nullable=True)
     access_counter = Column(Integer, nullable=False, default=0)
     pages = Column(Integer, nullable=True)
+    skipped_pages_json = Column(JSON, nullable=True)  # 品質が低いため取り込まなかったページ [{"page", "score", "reason"}]
+    skipped_chunks = Column(Integer, nullable=False, default=0)  # 同じく取り込まなかったチャンク数
 
     # 解析結果
     estimated_timestamp = Column(DateTime, nullable=True)
@@ -70,3 +75,27 @@ class Document(Base):
         CheckConstraint("technical_level IS NULL OR (technical_level >= 0 AND technical_level <= 1)"),
         CheckConstraint("financial_scale IS NULL OR financial_scale >= 0"),
     )
+
+
+class Chunk(ChunksBase):
+    """
+    chunks テーブル（engine_chunks 側のDB）
+
+    documents とは別DBなので外部キーは張らず、doc_id（ファイル名）と sha256 で対応させる
+    """
+    __tablename__ = "chunks"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    doc_id = Column(String(512), nullable=False)
+    document_sha256 = Column(String(64), nullable=True)
+    page = Column(Integer, nullable=False)
+    chunk_id = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # 文書単位の削除・差し替えと、ページ順の取り出しに使う
+        Index("ix_chunks_doc_page", "doc_id", "page", "chunk_id"),
+        Index("ix_chunks_sha256", "document_sha256"),
+    )
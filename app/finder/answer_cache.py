@@ -0,0 +1,210 @@
+"""
+回答キャッシュ
+
+同じ質問・言い回しが少し違うだけの質問に、検索とLLM生成をやり直さずに答えるためのモジュール。
+
+【探し方】
+1. 質問文を正規化（全角半角・空白・大文字小文字・末尾の「？」など）して完全一致で探す
+2. 見つからなければ、質問文のEmbeddingの cos類似度が閾値以上のものを探す
+
+【無効化】
+- TTL（秒）を過ぎたものは使わない
+- 件数の上限を超えたら、使われていない順に捨てる
+- FAISS index が変わったら（index_manager.generation が変わったら）全件捨てる
+  → 新しい文書を取り込んだ後に古い回答を返さないため
+
+【類似質問の探し方】
+質問文のEmbeddingは、件数の上限分の行をあらかじめ確保した行列に入れておき（1件1行）、
+保存・削除のときに行を更新する。検索は行列とのかけ算1回で行う（毎回行列を作り直さない）
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from app.analyzer import index_manager
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_ITEMS = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+_TRAILING_PUNCT = re.compile(r"[\s?？!！。．.、,，]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """
+    完全一致で比べるための質問文の正規化
+    """
+    text = unicodedata.normalize("NFKC", question).lower().strip()
+    text = _SPACES.sub(" ", text)
+    return _TRAILING_PUNCT.sub("", text)
+
+
+@dataclass
+class _Entry:
+    result: dict
+    created_at: float
+    # Embedding を入れた行列の行（Embedding がない場合は None）
+    slot: int | None = None
+
+
+class AnswerCache:
+    """
+    完全一致 + 類似質問で引ける回答キャッシュ（スレッドセーフ）
+    """
+
+    def __init__(self, max_items: int, ttl_seconds: float, similarity: float):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+
+        self._entries: OrderedDict[tuple[str, int], _Entry] = OrderedDict()
+        self._generation = index_manager.generation
+        self._lock = threading.Lock()
+
+        # 質問文のEmbeddingの行列（最初の保存時に次元数が分かってから確保する）と、行ごとの情報
+        self._matrix: np.ndarray | None = None
+        self._slot_keys: list[tuple[str, int] | None] = [None] * max_items
+        self._slot_top_k = np.zeros(max_items, dtype="int64")
+        self._slot_created = np.zeros(max_items, dtype="float64")
+        self._slot_used = np.zeros(max_items, dtype=bool)
+        self._free_slots = list(range(max_items - 1, -1, -1))
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _check_generation(self) -> None:
+        # index が更新されていたら、古い回答はすべて捨てる
+        if self._generation != index_manager.generation:
+            self._clear_entries()
+            self._generation = index_manager.generation
+
+    def _clear_entries(self) -> None:
+        self._entries.clear()
+        self._slot_keys = [None] * self.max_items
+        self._slot_used[:] = False
+        self._free_slots = list(range(self.max_items - 1, -1, -1))
+
+    def _remove(self, key: tuple[str, int]) -> None:
+        entry = self._entries.pop(key)
+        self._release_slot(entry)
+
+    def _release_slot(self, entry: _Entry) -> None:
+        if entry.slot is not None:
+            self._slot_keys[entry.slot] = None
+            self._slot_used[entry.slot] = False
+            self._free_slots.append(entry.slot)
+            entry.slot = None
+
+    def _store_embedding(self, key: tuple[str, int], entry: _Entry, embedding: np.ndarray) -> None:
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_items, len(embedding)), dtype="float32")
+        if len(embedding) != self._matrix.shape[1] or not self._free_slots:
+            # 次元数が違うEmbedding（モデルを変えた場合など）は、類似質問の検索に使わない
+            return
+        slot = self._free_slots.pop()
+        self._matrix[slot] = embedding
+        self._slot_keys[slot] = key
+        self._slot_top_k[slot] = key[1]
+        self._slot_created[slot] = entry.created_at
+        self._slot_used[slot] = True
+        entry.slot = slot
+
+    def _is_alive(self, entry: _Entry, now: float) -> bool:
+        return now - entry.created_at <= self.ttl_seconds
+
+    def get_exact(self, question: str, top_k: int) -> dict | None:
+        """
+        正規化した質問文の完全一致で探す（Embeddingを作る前に呼ぶ）
+        """
+        key = (normalize_question(question), top_k)
+        now = time.time()
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._is_alive(entry, now):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry.result
+
+    def get_similar(self, query_embedding: np.ndarray, top_k: int) -> dict | None:
+        """
+        質問文のEmbedding（L2正規化済み）が近いものを探す
+        """
+        now = time.time()
+        query = np.asarray(query_embedding, dtype="float32").reshape(-1)
+        with self._lock:
+            self._check_generation()
+            if self._matrix is not None and len(query) == self._matrix.shape[1]:
+                candidates = (
+                    self._slot_used
+                    & (self._slot_top_k == top_k)
+                    & (now - self._slot_created <= self.ttl_seconds)
+                )
+                if candidates.any():
+                    scores = np.where(candidates, self._matrix @ query, -np.inf)
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.similarity:
+                        key = self._slot_keys[best]
+                        self._entries.move_to_end(key)
+                        self.semantic_hits += 1
+                        return self._entries[key].result
+            self.misses += 1
+            return None
+
+    def put(self, question: str, top_k: int, result: dict, query_embedding: np.ndarray | None, generation: int) -> None:
+        """
+        回答を保存する
+
+        generation には検索した時点の index_manager.generation を渡す
+        （生成中に index が更新された場合は、古い回答なので保存しない）
+        """
+        key = (normalize_question(question), top_k)
+        embedding = None if query_embedding is None else np.array(query_embedding, dtype="float32").reshape(-1)
+        with self._lock:
+            self._check_generation()
+            if generation != self._generation or self.max_items <= 0:
+                return
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and len(self._entries) >= self.max_items:
+                self._remove(next(iter(self._entries)))
+            entry = self._entries[key] = _Entry(result=result, created_at=time.time())
+            if embedding is not None:
+                self._store_embedding(key, entry, embedding)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear_entries()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "items": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+
+# アプリ全体で共有するキャッシュ（無効化されている場合は None）
+answer_cache: AnswerCache | None = (
+    AnswerCache(ANSWER_CACHE_MAX_ITEMS, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY)
+    if ANSWER_CACHE_ENABLED
+    else None
+)
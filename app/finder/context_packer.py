@@ -0,0 +1,128 @@
+"""
+検索結果のチャンクを、トークン数の上限に収まるようにまとめてプロンプト用の資料にするモジュール
+
+- 同じ文書・同じページで隣り合うチャンク（chunk_id が連続）は1つにつなぎ、
+  重なっている部分（CHUNK_OVERLAP 文字）を1回分だけにする
+- 同じチャンクが複数回ヒットした場合は1回だけ入れる
+- 関連度の高い順にチャンクを選び、CONTEXT_TOKEN_BUDGET を超えてしまうチャンクは入れない
+- 並びは文書ごと（関連度の高いチャンクを含む文書が先）→ ページ順 → ページ内の位置順
+
+=================== 利用例 ===================
+from app.finder.context_packer import pack_contexts
+
+context_text = pack_contexts(contexts)   # contexts は search_hybrid の結果（関連度の高い順）
+"""
+
+from __future__ import annotations
+
+import os
+
+from app.analyzer.text_splitter import CHUNK_OVERLAP
+from app.core.metrics import PROMPT_CONTEXT_TOKENS
+from app.core.tokens import estimate_tokens, truncate_to_tokens
+
+# プロンプトに入れる資料のトークン数の上限（おおよそ）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+
+# 同じページで離れているチャンクの間に入れる区切り
+_GAP = "\n…\n"
+
+
+def _header(doc_id: str, page) -> str:
+    return f"[{doc_id} p{page}]"
+
+
+def _overlap_len(left: str, right: str) -> int:
+    """
+    隣り合うチャンクで、left の末尾と right の先頭が重なっている文字数
+    （重複チャンクの代表の本文が入っているなど、一致しない場合は 0）
+    """
+    if len(right) >= CHUNK_OVERLAP and left.endswith(right[:CHUNK_OVERLAP]):
+        return CHUNK_OVERLAP
+    return 0
+
+
+def _join(chunks: dict[int, str]) -> str:
+    """
+    1ページ分のチャンク（{chunk_id: 本文}）を位置順につなぐ
+    """
+    parts: list[str] = []
+    prev_id = prev_text = None
+    for chunk_id in sorted(chunks):
+        text = chunks[chunk_id]
+        if prev_id is not None and chunk_id == prev_id + 1:
+            overlap = _overlap_len(prev_text, text)
+            parts.append(text[overlap:] if overlap else "\n" + text)
+        else:
+            if parts:
+                parts.append(_GAP)
+            parts.append(text)
+        prev_id, prev_text = chunk_id, text
+    return "".join(parts)
+
+
+def _added_text(chunks: dict[int, str], chunk_id: int, text: str) -> str:
+    """
+    選択済みのチャンク（同じページ）に text を足したときに、新しく増える部分
+    """
+    start, end = 0, len(text)
+    left = chunks.get(chunk_id - 1)
+    if left is not None:
+        start = _overlap_len(left, text)
+    right = chunks.get(chunk_id + 1)
+    if right is not None and _overlap_len(text, right):
+        end = len(text) - CHUNK_OVERLAP
+    return text[start:max(end, start)]
+
+
+def pack_contexts(contexts: list[dict], budget: int = CONTEXT_TOKEN_BUDGET, model: str = "gpt-4o-mini") -> str:
+    """
+    検索結果を、budget トークン以内の資料の文章にまとめる
+
+    Parameters
+    ----------
+    contexts : list[dict]
+        検索結果（doc_id / page / chunk_id / text を持つ。関連度の高い順）
+    budget : int
+        資料全体のトークン数の上限（最上位のチャンクだけで超える場合は、そのチャンクを切り詰めて入れる）
+    model : str
+        トークン数を数えるモデル
+
+    Returns
+    -------
+    str
+        「[doc_id pページ]」の見出しと本文を、文書・ページごとに並べた文章
+    """
+    # {doc_id: {page: {chunk_id: 本文}}}（文書は最初に選ばれた順）
+    selected: dict[str, dict[object, dict[int, str]]] = {}
+    used = 0
+    for c in contexts:
+        doc_id, page, chunk_id, text = c["doc_id"], c["page"], int(c["chunk_id"]), c["text"]
+        pages = selected.get(doc_id, {})
+        chunks = pages.get(page, {})
+        if chunk_id in chunks:
+            continue
+
+        # 見出しと区切りの分も数える
+        cost = estimate_tokens(_added_text(chunks, chunk_id, text), model) + 1
+        if not chunks:
+            cost += estimate_tokens(_header(doc_id, page), model) + 1
+        if used + cost > budget:
+            if used == 0:
+                text = truncate_to_tokens(text, max(budget - (cost - estimate_tokens(text, model)), 0), model)
+                cost = budget
+            else:
+                continue
+
+        chunks[chunk_id] = text
+        pages[page] = chunks
+        selected[doc_id] = pages
+        used += cost
+
+    blocks = [
+        f"{_header(doc_id, page)}\n{_join(pages[page])}"
+        for doc_id, pages in selected.items()
+        for page in sorted(pages)
+    ]
+    PROMPT_CONTEXT_TOKENS.observe(used)
+    return "\n\n".join(blocks)
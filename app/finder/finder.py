@@ -1,14 +1,79 @@
 """
 検索とRAGをまとめた窓口モジュール
+
+同じ・よく似た質問には回答キャッシュ（answer_cache.py）から答える
+検索方法（dense / hybrid / lexical）は search.py の SEARCH_MODE で切り替える
 """
 
-from app.finder.search import search_chunks
-from app.finder.rag import build_rag_prompt, generate_answer
+import asyncio
+import os
+from collections.abc import AsyncIterator
+
+from app.analyzer import index_manager
+from app.analyzer.doc_filter import DocFilter
+from app.finder.answer_cache import answer_cache
+from app.finder.search import (
+    SEARCH_MODE, embed_queries, embed_query, embed_query_async,
+    search_hybrid, search_hybrid_batch, uses_embedding,
+)
+from app.finder.rag import build_rag_prompt, generate_answer, generate_answer_async, stream_answer
+
+# /ask/batch で同時に回答を生成する数（上流全体の同時実行数は UPSTREAM_MAX_CONCURRENCY で別に制限される）
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+
+
+def _embed_question(question: str):
+    """
+    質問文をEmbeddingする（lexical の場合は None）
+    hybrid で Embedding に失敗した場合も None を返し、キーワード検索だけで答える
+    """
+    if not uses_embedding():
+        return None
+    try:
+        return embed_query(question)
+    except Exception as e:
+        if SEARCH_MODE != "hybrid":
+            raise
+        print(f"[ERROR] finder: Embeddingに失敗したため、キーワード検索のみで答えます エラー: {e}")
+        return None
+
+
+async def _embed_question_async(question: str):
+    """
+    _embed_question の非同期版
+    """
+    if not uses_embedding():
+        return None
+    try:
+        return await embed_query_async(question)
+    except Exception as e:
+        if SEARCH_MODE != "hybrid":
+            raise
+        print(f"[ERROR] finder: Embeddingに失敗したため、キーワード検索のみで答えます エラー: {e}")
+        return None
 
 
-def answer_query(question: str, top_k: int = 3) -> dict:
+def answer_query(question: str, top_k: int = 3, doc_filter: DocFilter | None = None) -> dict:
+    """
+    質問に答える
+
+    doc_filter（文書の絞り込み条件）を渡した場合は、条件に合う文書だけから検索する
+    （回答キャッシュは絞り込みなしの質問だけに使う）
+    """
+    cache = answer_cache if doc_filter is None else None
+
+    # 同じ質問（正規化後）の回答があれば、それを返す
+    if cache is not None and (cached := cache.get_exact(question, top_k)) is not None:
+        return cached
+
+    # 質問文をEmbeddingし、よく似た質問の回答があればそれを返す
+    generation = index_manager.generation
+    query_embedding = _embed_question(question)
+    if cache is not None and query_embedding is not None and (cached := cache.get_similar(query_embedding, top_k)) is not None:
+        return cached
+
     # 類似文章を検索
-    contexts = search_chunks(question, top_k)
+    contexts = search_hybrid(question, query_embedding, top_k, doc_filter)
 
     # RAG用プロンプト作成
     prompt = build_rag_prompt(question, contexts)
@@ -16,7 +81,187 @@ def answer_query(question: str, top_k: int = 3) -> dict:
     # 回答生成
     answer = generate_answer(prompt)
 
-    return {
+    result = {
+        "answer": answer,
+        "contexts": contexts,
+    }
+    if cache is not None:
+        cache.put(question, top_k, result, query_embedding, generation)
+    return result
+
+
+async def answer_query_async(question: str, top_k: int = 3, doc_filter: DocFilter | None = None) -> dict:
+    """
+    answer_query の非同期版（/ask から呼ばれる）
+    """
+    cache = answer_cache if doc_filter is None else None
+
+    # 同じ質問（正規化後）の回答があれば、それを返す
+    if cache is not None and (cached := cache.get_exact(question, top_k)) is not None:
+        return cached
+
+    # 質問文をEmbeddingし、よく似た質問の回答があればそれを返す
+    generation = index_manager.generation
+    query_embedding = await _embed_question_async(question)
+    if cache is not None and query_embedding is not None and (cached := cache.get_similar(query_embedding, top_k)) is not None:
+        return cached
+
+    # 類似文章を検索（CPU処理なので別スレッドで）
+    contexts = await asyncio.to_thread(search_hybrid, question, query_embedding, top_k, doc_filter)
+
+    # RAG用プロンプト作成
+    prompt = build_rag_prompt(question, contexts)
+
+    # 回答生成
+    answer = await generate_answer_async(prompt)
+
+    result = {
         "answer": answer,
         "contexts": contexts,
     }
+    if cache is not None:
+        cache.put(question, top_k, result, query_embedding, generation)
+    return result
+
+
+async def stream_answer_query(question: str, top_k: int = 3) -> AsyncIterator[tuple[str, object]]:
+    """
+    answer_query のストリーミング版
+
+    (イベント名, データ) を順に返す
+    - ("contexts", 検索結果)  … 検索が終わった時点ですぐに返す
+    - ("token", 回答の断片)   … 生成されたそばから返す（キャッシュ時は回答全体を1回で返す）
+    - ("done", None)          … 生成完了
+    """
+    cached = answer_cache.get_exact(question, top_k) if answer_cache is not None else None
+
+    query_embedding = None
+    generation = index_manager.generation
+    if cached is None:
+        query_embedding = await _embed_question_async(question)
+        if answer_cache is not None and query_embedding is not None:
+            cached = answer_cache.get_similar(query_embedding, top_k)
+
+    if cached is not None:
+        yield "contexts", cached["contexts"]
+        yield "token", cached["answer"]
+        yield "done", None
+        return
+
+    # 類似文章を検索
+    contexts = await asyncio.to_thread(search_hybrid, question, query_embedding, top_k)
+    yield "contexts", contexts
+
+    # RAG用プロンプト作成
+    prompt = build_rag_prompt(question, contexts)
+
+    # 回答生成（断片ごと）
+    tokens: list[str] = []
+    async for token in stream_answer(prompt):
+        tokens.append(token)
+        yield "token", token
+
+    # 最後まで生成できた場合だけキャッシュする
+    if answer_cache is not None:
+        answer_cache.put(question, top_k, {"answer": "".join(tokens), "contexts": contexts}, query_embedding, generation)
+
+    yield "done", None
+
+
+async def answer_queries_async(
+    questions: list[str],
+    top_k: int = 3,
+    retrieval_only: bool = False,
+    concurrency: int = ASK_BATCH_CONCURRENCY,
+) -> list[dict]:
+    """
+    複数の質問にまとめて答える（/ask/batch から呼ばれる）
+
+    - 質問文のEmbeddingはバッチでAPIに送り、FAISS 検索は複数行のクエリ行列で1回にまとめる
+    - 回答の生成は concurrency 件まで同時に行う
+    - retrieval_only=True の場合は回答を生成せず、検索結果だけを返す
+
+    Returns
+    -------
+    list[dict]
+        questions と同じ順の結果
+        成功 : {"question", "answer", "contexts"}（retrieval_only の場合は answer なし）
+        失敗 : {"question", "error"}（ほかの質問の処理は続ける）
+    """
+    results: list[dict | None] = [None] * len(questions)
+
+    def fail(i: int, message: str) -> None:
+        results[i] = {"question": questions[i], "error": message}
+
+    def done(i: int, result: dict) -> None:
+        item = {"question": questions[i], "contexts": result["contexts"]}
+        if not retrieval_only:
+            item["answer"] = result["answer"]
+        results[i] = item
+
+    # 同じ質問（正規化後）の回答があれば、それを返す
+    pending: list[int] = []
+    for i, question in enumerate(questions):
+        if not question or not question.strip():
+            fail(i, "No query message.")
+        elif answer_cache is not None and (cached := answer_cache.get_exact(question, top_k)) is not None:
+            done(i, cached)
+        else:
+            pending.append(i)
+
+    # 質問文をまとめてEmbeddingし、よく似た質問の回答があればそれを返す
+    generation = index_manager.generation
+    embeddings: dict[int, object] = {}
+    if pending and uses_embedding():
+        try:
+            batch = await asyncio.to_thread(embed_queries, [questions[i] for i in pending])
+        except Exception as e:
+            print(f"[ERROR] finder: 質問文のEmbeddingに失敗しました エラー: {e}")
+            batch = [None] * len(pending)
+        for i, embedding in zip(pending, batch):
+            if embedding is None and SEARCH_MODE != "hybrid":
+                fail(i, "Embeddingに失敗しました")
+                continue
+            embeddings[i] = embedding
+            if answer_cache is not None and embedding is not None and (cached := answer_cache.get_similar(embedding, top_k)) is not None:
+                done(i, cached)
+        pending = [i for i in pending if results[i] is None]
+
+    # 類似文章をまとめて検索（CPU処理なので別スレッドで）
+    contexts: dict[int, list[dict]] = {}
+    if pending:
+        try:
+            searched = await asyncio.to_thread(
+                search_hybrid_batch, [questions[i] for i in pending], [embeddings.get(i) for i in pending], top_k
+            )
+        except Exception as e:
+            print(f"[ERROR] finder: 検索に失敗しました エラー: {e}")
+            for i in pending:
+                fail(i, str(e))
+            pending, searched = [], []
+        contexts = dict(zip(pending, searched))
+
+    if retrieval_only:
+        for i in pending:
+            done(i, {"contexts": contexts[i]})
+        return results
+
+    # 回答を concurrency 件ずつ並行して生成
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def generate(i: int) -> None:
+        async with semaphore:
+            try:
+                prompt = build_rag_prompt(questions[i], contexts[i])
+                answer = await generate_answer_async(prompt)
+            except Exception as e:
+                print(f"[ERROR] finder: 回答の生成に失敗しました: {questions[i]} エラー: {e}")
+                fail(i, str(e))
+                return
+        result = {"answer": answer, "contexts": contexts[i]}
+        if answer_cache is not None:
+            answer_cache.put(questions[i], top_k, result, embeddings.get(i), generation)
+        done(i, result)
+
+    await asyncio.gather(*(generate(i) for i in pending))
+    return results
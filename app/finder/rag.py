@@ -3,16 +3,28 @@ RAG用のプロンプト作成と回答生成を行うモジュール
 """
 
 import os
+import time
+from collections.abc import AsyncIterator
 from openai import OpenAI
-from app.core.clients import get_gemini_client, get_openai_client
+from app.finder.context_packer import pack_contexts
+from app.core.clients import call_upstream, call_upstream_async, get_openai_client, get_async_openai_client
+from app.core.tokens import estimate_tokens
+from app.core.metrics import LLM_FIRST_TOKEN_SECONDS, LLM_REQUEST_SECONDS, PROMPT_BUILD_SECONDS, timed
+
+ANSWER_MODEL = "gpt-4o-mini"
+ANSWER_SYSTEM_PROMPT = "あなたは社内規定に詳しいアシスタントです。"
+ANSWER_MAX_TOKENS = 1024
 
 
 def build_rag_prompt(question: str, contexts: list[dict]) -> str:
+    with timed(PROMPT_BUILD_SECONDS):
+        return _build_rag_prompt(question, contexts)
+
+
+def _build_rag_prompt(question: str, contexts: list[dict]) -> str:
     # 検索結果を文章としてまとめる
-    context_text = "\n\n".join(
-        f"[p{c['page']}] {c['text']}"
-        for c in contexts
-    )
+    # （隣り合うチャンクはつないで重なりを除き、CONTEXT_TOKEN_BUDGET に収まる分だけ入れる）
+    context_text = pack_contexts(contexts)
 
     # RAG用プロンプト
     # 2026/1/3修正: 役割の記載が2重になっていたため削除
@@ -27,20 +39,93 @@ def build_rag_prompt(question: str, contexts: list[dict]) -> str:
 """
 
 
+def _messages(prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _request_tokens(prompt: str) -> int:
+    # 1分あたりのトークン数の制限には、入力と出力の上限の合計を使う
+    return estimate_tokens(ANSWER_SYSTEM_PROMPT + prompt, ANSWER_MODEL) + ANSWER_MAX_TOKENS
+
+
 def generate_answer(prompt: str) -> str:
     # GPTで回答生成
     # client = get_openai_client()
     # => 2026/1/3修正: クライアント呼び出しはcore/clients.pyに集約しています。
     #    もし新規にクライアントを生成する必要があれば修正してください。
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "あなたは社内規定に詳しいアシスタントです。"},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.2,
-        max_tokens=1024,
-    )
 
+    def request():
+        with timed(LLM_REQUEST_SECONDS, model=ANSWER_MODEL, purpose="answer"):
+            return client.chat.completions.create(
+                model=ANSWER_MODEL,
+                messages=_messages(prompt),
+                temperature=0.2,
+                max_tokens=ANSWER_MAX_TOKENS,
+            )
+
+    # 利用枠の待ち・429 などの再試行は call_upstream で行う
+    response = call_upstream("openai", request, _request_tokens(prompt))
+    return response.choices[0].message.content
+
+
+async def generate_answer_async(prompt: str) -> str:
+    """
+    generate_answer の非同期版
+    LLMの応答待ちの間もスレッドを占有しないので、多数の質問を同時に扱える
+    """
+    client = get_async_openai_client()
+
+    async def request():
+        with timed(LLM_REQUEST_SECONDS, model=ANSWER_MODEL, purpose="answer"):
+            return await client.chat.completions.create(
+                model=ANSWER_MODEL,
+                messages=_messages(prompt),
+                temperature=0.2,
+                max_tokens=ANSWER_MAX_TOKENS,
+            )
+
+    response = await call_upstream_async("openai", request, _request_tokens(prompt))
     return response.choices[0].message.content
+
+
+async def stream_answer(prompt: str) -> AsyncIterator[str]:
+    """
+    回答をトークン（断片）ごとに返す非同期ジェネレータ
+
+    呼び出し側が途中でやめた場合（クライアント切断など）は、
+    上流のストリームも閉じて生成を打ち切る。
+    再試行するのはストリームを開くまで（断片を返し始めた後に失敗した場合は、そのまま例外にする）
+    """
+    client = get_async_openai_client()
+
+    async def request():
+        return await client.chat.completions.create(
+            model=ANSWER_MODEL,
+            messages=_messages(prompt),
+            temperature=0.2,
+            max_tokens=ANSWER_MAX_TOKENS,
+            stream=True,
+        )
+
+    # 途中で切断された場合も outcome="error" として記録する
+    with timed(LLM_REQUEST_SECONDS, model=ANSWER_MODEL, purpose="answer"):
+        start = time.perf_counter()
+        stream = await call_upstream_async("openai", request, _request_tokens(prompt))
+        first = True
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, model=ANSWER_MODEL)
+                        first = False
+                    yield delta
+        finally:
+            # 切断・キャンセル時も含めて、上流への接続を必ず閉じる
+            await stream.close()
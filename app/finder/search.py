@@ -1,24 +1,177 @@
 """
-Embeddingを使ってFAISSから類似文章を検索するモジュール
+FAISS（Embedding）とキーワード（文字 bigram の BM25）で類似文章を検索するモジュール
+
+SEARCH_MODE（環境変数）で検索方法を選ぶ：
+- dense   : Embedding による FAISS 検索のみ
+- hybrid  : FAISS とキーワード検索の結果を Reciprocal Rank Fusion（RRF）で統合する
+            （規程番号・様式名・製品コードなど、文字列がそのまま一致するチャンクを拾える）
+- lexical : キーワード検索のみ（Embedding API を呼ばない。API が遅い・使えないとき用）
 """
 
+import asyncio
+import os
+
 import faiss
-from app.analyzer.embedder import get_embedding
-from app.analyzer.index_manager import index, meta_data
+import numpy as np
+from app.analyzer.embedder import EMBEDDING_MODEL, get_embedding, get_embedding_async, get_embeddings
+from app.analyzer import index_manager
+from app.analyzer.doc_filter import DocFilter
+from app.core.metrics import QUERY_EMBEDDING_SECONDS, timed
+
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid").lower()
+SEARCH_MODES = ("dense", "hybrid", "lexical")
+
+# RRF の定数（順位 r のスコアは 1 / (RRF_K + r)）
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# hybrid で、それぞれの検索から何件ずつ候補を取るか（top_k の何倍か）
+HYBRID_CANDIDATES_FACTOR = int(os.getenv("HYBRID_CANDIDATES_FACTOR", "4"))
+
+if SEARCH_MODE not in SEARCH_MODES:
+    raise ValueError(f"SEARCH_MODE が不正です: {SEARCH_MODE}（{SEARCH_MODES} のいずれか）")
+
+
+def uses_embedding() -> bool:
+    """
+    質問文の Embedding が必要な検索方法か
+    """
+    return SEARCH_MODE != "lexical"
+
+
+def embed_query(query: str) -> np.ndarray:
+    """
+    質問文をEmbeddingし、cos類似度検索のためL2正規化して返す（shape = (1, 次元数)）
+    """
+    with timed(QUERY_EMBEDDING_SECONDS, model=EMBEDDING_MODEL):
+        query_embedding = get_embedding(query).reshape(1, -1)
+    faiss.normalize_L2(query_embedding)
+    return query_embedding
+
+
+async def embed_query_async(query: str) -> np.ndarray:
+    """
+    embed_query の非同期版
+    """
+    with timed(QUERY_EMBEDDING_SECONDS, model=EMBEDDING_MODEL):
+        query_embedding = (await get_embedding_async(query)).reshape(1, -1)
+    faiss.normalize_L2(query_embedding)
+    return query_embedding
+
+
+def embed_queries(queries: list[str]) -> list[np.ndarray | None]:
+    """
+    複数の質問文をまとめてEmbeddingし、L2正規化して返す（バッチでAPIに送る）
+
+    Returns
+    -------
+    list[np.ndarray | None]
+        質問文ごとの shape = (1, 次元数) のEmbedding（失敗した質問文は None）
+    """
+    with timed(QUERY_EMBEDDING_SECONDS, model=EMBEDDING_MODEL):
+        embeddings, ok_ids = get_embeddings(queries)
+    results: list[np.ndarray | None] = [None] * len(queries)
+    if ok_ids:
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        faiss.normalize_L2(embeddings)
+        for row, i in enumerate(ok_ids):
+            results[i] = embeddings[row:row + 1]
+    return results
+
+
+def search_by_embedding(query_embedding: np.ndarray, top_k: int = 3, doc_filter: DocFilter | None = None) -> list[dict]:
+    """
+    正規化済みの質問文Embeddingで検索し、対応するメタデータを返す
+    """
+    return index_manager.search(query_embedding, top_k, doc_filter)[0]
+
+
+def search_by_keywords(query: str, top_k: int = 3, doc_filter: DocFilter | None = None) -> list[dict]:
+    """
+    質問文のキーワードで検索し、対応するメタデータを返す（Embedding 不要）
+    """
+    return index_manager.search_lexical(query, top_k, doc_filter)
+
+
+def _chunk_key(meta: dict) -> tuple:
+    return meta["doc_id"], meta["page"], meta["chunk_id"]
+
+
+def fuse_rrf(result_lists: list[list[dict]], top_k: int, k: int = RRF_K) -> list[dict]:
+    """
+    複数の検索結果（それぞれスコアの高い順）を Reciprocal Rank Fusion で1つにまとめる
+    """
+    scores: dict[tuple, float] = {}
+    metas: dict[tuple, dict] = {}
+    for results in result_lists:
+        for rank, meta in enumerate(results):
+            key = _chunk_key(meta)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            metas.setdefault(key, meta)
+    ranked = sorted(scores, key=lambda key: scores[key], reverse=True)
+    return [metas[key] for key in ranked[:top_k]]
+
+
+def search_hybrid(query: str, query_embedding: np.ndarray | None, top_k: int = 3, doc_filter: DocFilter | None = None) -> list[dict]:
+    """
+    SEARCH_MODE に応じて検索する
+
+    query_embedding が None の場合（lexical、または Embedding に失敗した場合）はキーワード検索のみ
+    doc_filter を渡した場合は、条件に合う文書のチャンクだけを対象に検索する
+    """
+    if query_embedding is None or SEARCH_MODE == "lexical":
+        return search_by_keywords(query, top_k, doc_filter)
+    if SEARCH_MODE == "dense":
+        return search_by_embedding(query_embedding, top_k, doc_filter)
+
+    candidates = top_k * HYBRID_CANDIDATES_FACTOR
+    dense = search_by_embedding(query_embedding, candidates, doc_filter)
+    lexical = search_by_keywords(query, candidates, doc_filter)
+    return fuse_rrf([dense, lexical], top_k)
+
+
+def search_hybrid_batch(
+    queries: list[str],
+    query_embeddings: list[np.ndarray | None],
+    top_k: int = 3,
+    doc_filter: DocFilter | None = None,
+) -> list[list[dict]]:
+    """
+    search_hybrid の複数質問版
+
+    Embedding がある質問は、まとめて1回の FAISS 検索（複数行のクエリ行列）で探す
+    """
+    dense_ids = [] if SEARCH_MODE == "lexical" else [i for i, e in enumerate(query_embeddings) if e is not None]
+    candidates = top_k if SEARCH_MODE == "dense" else top_k * HYBRID_CANDIDATES_FACTOR
+    dense: dict[int, list[dict]] = {}
+    if dense_ids:
+        matrix = np.vstack([query_embeddings[i] for i in dense_ids])
+        dense = dict(zip(dense_ids, index_manager.search(matrix, candidates, doc_filter)))
+
+    results = []
+    for i, query in enumerate(queries):
+        if i not in dense:
+            results.append(search_by_keywords(query, top_k, doc_filter))
+        elif SEARCH_MODE == "dense":
+            results.append(dense[i])
+        else:
+            results.append(fuse_rrf([dense[i], search_by_keywords(query, candidates, doc_filter)], top_k))
+    return results
+
 
+def search_chunks(query: str, top_k: int = 3, doc_filter: DocFilter | None = None) -> list[dict]:
+    # 質問文をEmbedding（正規化済み。lexical の場合は不要）
+    query_embedding = embed_query(query) if uses_embedding() else None
 
-def search_chunks(query: str, top_k: int = 3) -> list[dict]:
-    # 質問文をEmbedding
-    query_embedding = get_embedding(query)
+    # FAISS・キーワードで検索し、対応するメタデータを返す
+    return search_hybrid(query, query_embedding, top_k, doc_filter)
 
-    # cos類似度検索のため正規化
-    faiss.normalize_L2(query_embedding.reshape(1, -1))
 
-    # FAISSで検索
-    _, indices = index.search(
-        query_embedding.reshape(1, -1),
-        top_k,
-    )
+async def search_chunks_async(query: str, top_k: int = 3, doc_filter: DocFilter | None = None) -> list[dict]:
+    """
+    search_chunks の非同期版
+    検索はCPU処理なので、イベントループを塞がないよう別スレッドで行う
+    """
+    # 質問文をEmbedding（正規化済み。lexical の場合は不要）
+    query_embedding = await embed_query_async(query) if uses_embedding() else None
 
-    # 対応するメタデータを返す
-    return [meta_data[i] for i in indices[0]]
+    return await asyncio.to_thread(search_hybrid, query, query_embedding, top_k, doc_filter)
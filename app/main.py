@@ -8,10 +8,13 @@ main.py
 
 from __future__ import annotations  # 型ヒントをシンプルに書けるようにするための 魔法 のようなもの
 
+import json
 import os
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
@@ -21,7 +24,10 @@ from dotenv import load_dotenv
 # 分析処理が、API起動時のみ走るように指示
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    analyze_files("./test/import_documents")  # 起動時にPDFを読み込んで分析を実行
+    # 保存済みのスナップショットを読み込み、追加・更新・削除されたPDFだけを分析する
+    # 分析はバックグラウンドで行い、API はすぐにリクエストを受け付ける（進捗は /ready で確認）
+    # INDEX_SHARED=true の場合、分析するのは1ワーカーだけで、ほかのワーカーはその結果を読み込む
+    start_background_ingest("./test/import_documents")
     yield  # ← FastAPI がリクエスト受付を開始するポイント
 
 
@@ -30,8 +36,14 @@ async def lifespan(app: FastAPI):
 
 # 環境変数を読み込んでから各モジュールをインポート
 load_dotenv(override=False)
-from app.analyzer.analyzer import analyze_files
-from app.finder.finder import answer_query
+from app.analyzer.analyzer import start_background_ingest, get_ingest_status
+from app.analyzer import index_manager
+from app.analyzer.doc_filter import DocFilter
+from app.finder.finder import answer_query_async, answer_queries_async, stream_answer_query
+from app.core import metrics
+
+# /ask/batch で1回に受け付ける質問数の上限
+ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "1000"))
 
  # FastAPI起動
 app = FastAPI(title="MOF2 Prototype API", lifespan=lifespan)
@@ -58,18 +70,130 @@ def index():
 def health():
     return {"status": "ok"}
 
+# レディネスチェック用エンドポイント
+# スナップショットの読み込みが終わり、検索できる状態になったら 200 を返す
+# （取り込み中でも、登録済みの分で検索できる場合は ready とする）
+# （INDEX_SHARED=true のフォロワーは、リーダーのスナップショットを読み込めたら ready とする）
+@app.get("/ready")
+def ready():
+    status = get_ingest_status()
+    is_ready = status["index_loaded"] and (
+        len(index_manager.meta_data) > 0 or status["state"] in ("completed", "failed", "following")
+    )
+    body = {
+        "status": "ready" if is_ready else "not_ready",
+        "ingest_state": status["state"],
+        "worker_role": status["role"],
+        "snapshot": index_manager.loaded_snapshot,
+        "indexed_documents": len(index_manager.doc_manifest),
+        "pending_documents": status["pending"],
+        "processed_documents": status["processed"],
+        "total_documents": status["total"],
+        "vectors": len(index_manager.meta_data),
+        "started_at": status["started_at"],
+        "finished_at": status["finished_at"],
+        "last_result": status["stats"],
+        "error": status["error"],
+    }
+    return JSONResponse(status_code=200 if is_ready else 503, content=body)
+
+# メトリクス出力用エンドポイント（Prometheus のテキスト形式）
+# 取り込み・検索・回答生成の各段階の処理時間と件数、index の大きさ・メモリ使用量を返す
+# 使用例 curl http://localhost:8000/metrics
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # ファイル問合せ用エンドポイント
 # 使用例 http://localhost:8000/ask?q=質問文
 # askはURLログに残りやすいため本来はPOSTメソッド化が推奨される(未対応)
+# 非同期で処理するため、LLMの応答待ちの間も他の質問を受け付けられる
+# 文書の属性で検索対象を絞り込める（複数指定できる項目は ?content_type=rules&content_type=contract のように繰り返す）
+# 使用例 http://localhost:8000/ask?q=質問文&is_latest=true&department=総務部&date_from=2024-04-01
 @app.get("/ask")
-def ask(q: str = Query(..., description="質問文")):
+async def ask(
+    q: str = Query(..., description="質問文"),
+    top_k: int = Query(3, ge=1, le=50, description="検索件数"),
+    doc_id: list[str] | None = Query(None, description="対象の文書ID"),
+    is_latest: bool | None = Query(None, description="最新版だけ（true）／旧版だけ（false）"),
+    content_type: list[str] | None = Query(None, description="文書の種類"),
+    security_level: list[str] | None = Query(None, description="機密区分"),
+    department: list[str] | None = Query(None, description="部署"),
+    date_from: str | None = Query(None, description="推定更新日がこの日以降（YYYY-MM-DD）"),
+    date_to: str | None = Query(None, description="推定更新日がこの日以前（YYYY-MM-DD）"),
+):
     if not q or not q.strip():
         raise HTTPException(status_code=400, detail="404 No query message.")
 
     try:
-        result = answer_query(q)
+        doc_filter = DocFilter.create(doc_id, is_latest, content_type, security_level, department, date_from, date_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        result = await answer_query_async(q, top_k, doc_filter)
         return result
  
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+class AskBatchRequest(BaseModel):
+    questions: list[str] = Field(..., description="質問文のリスト")
+    top_k: int = Field(3, ge=1, le=50, description="1質問あたりの検索件数")
+    retrieval_only: bool = Field(False, description="True の場合は回答を生成せず、検索結果だけを返す")
+
+
+# ファイル問合せ用エンドポイント（複数質問版。評価ジョブ・社内ツール向け）
+# 質問文のEmbeddingと FAISS 検索をまとめて行い、回答は並行して生成する
+# 結果は questions と同じ順で返し、失敗した質問は "error" に理由を入れる
+# 使用例 curl -X POST http://localhost:8000/ask/batch -H "Content-Type: application/json" \
+#          -d '{"questions": ["質問1", "質問2"], "retrieval_only": false}'
+@app.post("/ask/batch")
+async def ask_batch(body: AskBatchRequest):
+    if not body.questions:
+        raise HTTPException(status_code=400, detail="No query message.")
+    if len(body.questions) > ASK_BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Too many questions (max {ASK_BATCH_MAX_QUESTIONS}).")
+
+    try:
+        results = await answer_queries_async(body.questions, body.top_k, body.retrieval_only)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"results": results}
+
+
+def _sse_event(event: str, data) -> str:
+    """
+    Server-Sent Events の1イベント分の文字列を作る
+    """
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+# ファイル問合せ用エンドポイント（ストリーミング版）
+# 検索結果（contexts）をすぐに送り、その後は回答を生成されたそばから送る
+# 使用例 curl -N "http://localhost:8000/ask/stream?q=質問文"
+@app.get("/ask/stream")
+async def ask_stream(request: Request, q: str = Query(..., description="質問文")):
+    if not q or not q.strip():
+        raise HTTPException(status_code=400, detail="404 No query message.")
+
+    async def event_stream():
+        events = stream_answer_query(q)
+        try:
+            async for event, data in events:
+                # クライアントが切断したら、上流のLLM呼び出しごと打ち切る
+                if await request.is_disconnected():
+                    break
+                yield _sse_event(event, data)
+        except Exception as e:
+            yield _sse_event("error", {"detail": str(e)})
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
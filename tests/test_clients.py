@@ -0,0 +1,163 @@
+"""
+clients の流量制御と再試行のテスト（AdaptiveConcurrency・call_upstream・call_upstream_async）
+
+上流APIの代わりに、決まった順で例外を投げたり値を返したりする偽の関数を使う。
+"""
+
+import asyncio
+
+import pytest
+
+from app.core import clients
+from app.core.clients import AdaptiveConcurrency, call_upstream, call_upstream_async
+
+
+class _ApiError(Exception):
+    """
+    SDK の例外の代わり（status_code と応答ヘッダーを持つ）
+    """
+
+    def __init__(self, status_code: int, headers: dict | None = None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class _FakeCall:
+    """
+    呼ばれるたびに outcomes の先頭を1つ取り出し、例外なら投げ、それ以外は返す
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def run_async(self):
+        return self()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    提供元の状態をテストごとに作り直し、待ち時間は実際には待たずに記録する
+    """
+    monkeypatch.setattr(clients, "_upstreams", {})
+    waits: list[float] = []
+
+    async def fake_async_sleep(seconds):
+        waits.append(seconds)
+
+    monkeypatch.setattr(clients.time, "sleep", waits.append)
+    monkeypatch.setattr(clients.asyncio, "sleep", fake_async_sleep)
+    return waits
+
+
+def test_aimd_halves_on_429_and_grows_on_success():
+    concurrency = AdaptiveConcurrency("test", maximum=8, minimum=2)
+    assert concurrency.limit == 8
+
+    concurrency.on_throttle()
+    assert concurrency.limit == 4
+    # 同じ時期にまとめて返ってきた 429 では、続けて下げない
+    concurrency.on_throttle()
+    assert concurrency.limit == 4
+
+    concurrency.on_success()
+    assert concurrency.limit == pytest.approx(4.25)
+    for _ in range(100):
+        concurrency.on_success()
+    assert concurrency.limit == 8
+
+    # 下限より下げない
+    for _ in range(5):
+        concurrency._last_decrease = 0.0
+        concurrency.on_throttle()
+    assert concurrency.limit == 2
+
+
+def test_retry_after_is_honoured(sleeps):
+    fn = _FakeCall(_ApiError(429, {"Retry-After": "3"}), "ok")
+    assert call_upstream("test", fn) == "ok"
+    assert fn.calls == 2
+    assert 3.0 in sleeps
+    upstream = clients.get_upstream("test")
+    # 429 で半分に下げ、成功で少し戻す
+    half = clients.UPSTREAM_MAX_CONCURRENCY / 2
+    assert upstream.concurrency.limit == pytest.approx(half + 1 / half)
+    assert upstream.concurrency.in_flight == 0
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"Retry-After": "Thu, 01 Jan 1970 00:00:00 GMT"}, 0.0),
+    ({"Retry-After": "120"}, 60.0),  # UPSTREAM_RETRY_MAX_SECONDS で頭打ち
+])
+def test_retry_after_formats(sleeps, headers, expected):
+    fn = _FakeCall(_ApiError(503, headers), "ok")
+    assert call_upstream("test", fn) == "ok"
+    assert expected in sleeps
+
+
+@pytest.mark.parametrize("error", [_ApiError(400), _ApiError(401), ValueError("bad request")])
+def test_non_retryable_errors_are_not_retried(sleeps, error):
+    fn = _FakeCall(error, "ok")
+    with pytest.raises(type(error)):
+        call_upstream("test", fn)
+    assert fn.calls == 1
+    assert not any(sleeps)
+    assert clients.get_upstream("test").concurrency.in_flight == 0
+
+
+def test_gives_up_after_max_retries(sleeps, monkeypatch):
+    monkeypatch.setattr(clients, "UPSTREAM_MAX_RETRIES", 2)
+    fn = _FakeCall(*[ConnectionError("reset")] * 3, "ok")
+    with pytest.raises(ConnectionError):
+        call_upstream("test", fn)
+    assert fn.calls == 3
+
+
+def test_async_retry_after_is_honoured(sleeps):
+    fn = _FakeCall(_ApiError(429, {"Retry-After": "2"}), "ok")
+    assert asyncio.run(call_upstream_async("test", fn.run_async)) == "ok"
+    assert fn.calls == 2
+    assert 2.0 in sleeps
+    assert clients.get_upstream("test").concurrency.in_flight == 0
+
+
+def test_async_non_retryable_error_is_not_retried(sleeps):
+    fn = _FakeCall(_ApiError(404), "ok")
+    with pytest.raises(_ApiError):
+        asyncio.run(call_upstream_async("test", fn.run_async))
+    assert fn.calls == 1
+
+
+def test_cancelled_woken_waiter_does_not_leak_slot():
+    async def scenario():
+        concurrency = AdaptiveConcurrency("test", maximum=1)
+        await concurrency.acquire_async()
+        first = asyncio.create_task(concurrency.acquire_async())
+        second = asyncio.create_task(concurrency.acquire_async())
+        await asyncio.sleep(0)
+        assert len(concurrency._async_waiters) == 2
+
+        # 空いた枠で first を起こし、first が動く前に取り消す
+        concurrency.release()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        # 枠は second に回る
+        await asyncio.wait_for(second, timeout=1)
+        assert concurrency.in_flight == 1
+        assert not concurrency._async_waiters
+        concurrency.release()
+        assert concurrency.in_flight == 0
+
+    asyncio.run(scenario())
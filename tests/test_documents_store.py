@@ -0,0 +1,134 @@
+"""
+documents_store.DocumentStore のテスト（保存・読み直し、同時書き出し、書き込み失敗時の再試行）
+"""
+
+import json
+import threading
+
+import pytest
+
+from app.db import documents_store
+from app.db.documents_store import DocumentStore
+
+
+def _record(path: str, summary: str = "") -> dict:
+    return {"id": None, "local_path": path, "doc_summary": summary}
+
+
+def _log_lines(store: DocumentStore) -> list[dict]:
+    return [json.loads(line) for line in store.path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_round_trip(tmp_path):
+    store = DocumentStore(tmp_path / "documents.jsonl", flush_batch=100)
+    a = store.put(_record("a.pdf", "first"))
+    b = store.put(_record("b.pdf"))
+    store.put(_record("c.pdf"))
+    # 同じパスは同じ id のまま上書きされる
+    assert store.put(_record("a.pdf", "second"))["id"] == a["id"]
+    assert store.delete_by_path("c.pdf")
+    store.flush()
+
+    reopened = DocumentStore(tmp_path / "documents.jsonl")
+    assert reopened.all() == store.all()
+    assert [r["local_path"] for r in reopened.all()] == ["a.pdf", "b.pdf"]
+    assert reopened.find_by_path("a.pdf")["doc_summary"] == "second"
+    assert reopened.get(b["id"])["local_path"] == "b.pdf"
+    assert reopened.find_by_path("c.pdf") is None
+
+    # 読み直した後に追加しても、id は重ならない
+    d = reopened.put(_record("d.pdf"))
+    assert d["id"] not in (a["id"], b["id"])
+
+
+def test_concurrent_flush(tmp_path):
+    # 別々のストア（別プロセス相当）と、同じストアを使う複数スレッドから同時に書き出す
+    path = tmp_path / "documents.jsonl"
+    stores = [DocumentStore(path, flush_batch=3) for _ in range(3)]
+    per_thread = 50
+    errors = []
+
+    def work(store: DocumentStore, name: str):
+        try:
+            for i in range(per_thread):
+                store.put(_record(f"{name}-{i}.pdf"))
+                if i % 7 == 0:
+                    store.flush()
+            store.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=work, args=(store, f"s{s}t{t}"))
+        for s, store in enumerate(stores)
+        for t in range(2)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+    reopened = DocumentStore(path)
+    records = reopened.all()
+    assert len(records) == len(threads) * per_thread
+    assert len({r["id"] for r in records}) == len(records)
+    assert {r["local_path"] for r in records} == {
+        f"s{s}t{t}-{i}.pdf" for s in range(3) for t in range(2) for i in range(per_thread)
+    }
+    # 書き出しの途中の行が混ざっていない
+    assert all("local_path" in line for line in _log_lines(reopened))
+
+
+@pytest.mark.parametrize("partial", [False, True])
+def test_failed_write_keeps_pending(tmp_path, monkeypatch, partial):
+    store = DocumentStore(tmp_path / "documents.jsonl", flush_batch=100)
+    store.put(_record("a.pdf"))
+    store.flush()
+    store.put(_record("b.pdf"))
+    store.put(_record("c.pdf"))
+
+    real_write = documents_store.os.write
+
+    def failing_write(fd, data):
+        # ログへの書き込み（改行で終わる）だけを失敗させる。partial の場合は途中まで書いてから失敗する
+        if data.endswith(b"\n"):
+            if partial:
+                real_write(fd, data[:len(data) // 2])
+            raise OSError("disk full")
+        return real_write(fd, data)
+
+    monkeypatch.setattr(documents_store.os, "write", failing_write)
+    with pytest.raises(OSError):
+        store.flush()
+    monkeypatch.setattr(documents_store.os, "write", real_write)
+
+    # 書き出せなかったレコードは残っていて、次の flush で書き出される
+    assert len(store._pending) == 2
+    store.flush()
+    assert store._pending == []
+
+    reopened = DocumentStore(tmp_path / "documents.jsonl")
+    assert [r["local_path"] for r in reopened.all()] == ["a.pdf", "b.pdf", "c.pdf"]
+    assert [line["local_path"] for line in _log_lines(reopened)] == ["a.pdf", "b.pdf", "c.pdf"]
+
+
+def test_auto_flush_failure_is_retried(tmp_path, monkeypatch):
+    store = DocumentStore(tmp_path / "documents.jsonl", flush_batch=2)
+    real_fsync = documents_store.os.fsync
+
+    def failing_fsync(fd):
+        raise OSError("fsync failed")
+
+    monkeypatch.setattr(documents_store.os, "fsync", failing_fsync)
+    # 件数がたまったときの書き出しが失敗しても、put は成功する
+    store.put(_record("a.pdf"))
+    store.put(_record("b.pdf"))
+    assert len(store._pending) == 2
+    monkeypatch.setattr(documents_store.os, "fsync", real_fsync)
+
+    store.put(_record("c.pdf"))
+    store.flush()
+    reopened = DocumentStore(tmp_path / "documents.jsonl")
+    assert [r["local_path"] for r in reopened.all()] == ["a.pdf", "b.pdf", "c.pdf"]
+    assert len(_log_lines(reopened)) == 3
@@ -0,0 +1,79 @@
+"""
+file_loader.summarize_pages のテスト（OpenAI のクライアントを偽物にして、応答の JSON の扱いを確かめる）
+"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.analyzer import file_loader
+from app.analyzer.summary_cache import SummaryCache, cache_key
+
+
+class _FakeOpenAI:
+    """
+    chat.completions.create の呼び出しを記録し、決まった文字列を返す偽のクライアント
+    """
+
+    def __init__(self, content: str):
+        self.content = content
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls += 1
+        message = SimpleNamespace(content=self.content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = SummaryCache(tmp_path / "summaries.sqlite3")
+    monkeypatch.setattr(file_loader, "summary_cache", cache)
+    return cache
+
+
+def _install(monkeypatch, content) -> _FakeOpenAI:
+    client = _FakeOpenAI(content if isinstance(content, str) else json.dumps(content))
+    monkeypatch.setattr(file_loader, "get_openai_client", lambda: client)
+    return client
+
+
+PAGES = [{"page": 1, "text": "規程第1条 この規程は社内の文書管理について定める。"}]
+
+
+def test_null_fields_use_defaults_and_are_cached(monkeypatch, cache):
+    client = _install(monkeypatch, {"summary": None, "estimated_timestamp": None})
+
+    result = file_loader.summarize_pages(PAGES, "a.pdf", "sha-a")
+    assert result == {"summary": "", "estimated_timestamp": "unknown"}
+
+    # NOT NULL の列にも保存でき、次回は API を呼ばない
+    key = cache_key("sha-a", file_loader.SUMMARY_MODEL, file_loader.SUMMARY_PROMPT_VERSION)
+    assert cache.get(key) == result
+    assert file_loader.summarize_pages(PAGES, "a.pdf", "sha-a") == result
+    assert client.calls == 1
+
+
+def test_missing_and_non_string_fields(monkeypatch, cache):
+    _install(monkeypatch, {"summary": 123})
+    assert file_loader.summarize_pages(PAGES, "b.pdf", "sha-b") == {"summary": "123", "estimated_timestamp": "unknown"}
+
+
+def test_long_document_null_fields(monkeypatch, cache):
+    # map-reduce と日付の推定の経路でも、null は既定値になる
+    monkeypatch.setattr(file_loader, "SUMMARY_TOKEN_BUDGET", 20)
+    monkeypatch.setattr(file_loader, "SUMMARY_MAP_TOKENS", 10)
+    _install(monkeypatch, {"summary": None, "estimated_timestamp": None})
+    pages = [{"page": i, "text": f"第{i}条 " + "文書の管理について定める。" * 5} for i in range(1, 5)]
+    assert file_loader.summarize_pages(pages, "c.pdf") == {"summary": "", "estimated_timestamp": "unknown"}
+
+
+@pytest.mark.parametrize("content", [["summary"], "just text", json.dumps("just text"), "null"])
+def test_non_object_reply_fails_without_caching(monkeypatch, cache, content):
+    _install(monkeypatch, content)
+    with pytest.raises((ValueError, json.JSONDecodeError)):
+        file_loader.summarize_pages(PAGES, "d.pdf", "sha-d")
+    key = cache_key("sha-d", file_loader.SUMMARY_MODEL, file_loader.SUMMARY_PROMPT_VERSION)
+    assert cache.get(key) is None
@@ -0,0 +1,170 @@
+"""
+index_manager の削除・差し替え・重複チャンクの代表の引き継ぎ・compact() のテスト
+
+flat / hnsw / ivf のそれぞれで、FAISS 検索（search）とキーワード検索（search_lexical）の
+両方から、消したチャンクが見えないこと・残したチャンクが見え続けることを確かめる。
+"""
+
+import faiss
+import numpy as np
+import pytest
+
+from app.analyzer import index_manager as im
+from app.analyzer.chunk_dedup import ChunkDeduper, fingerprint
+from app.analyzer.index_types import build_ivf, create_index, index_type_of
+from app.analyzer.lexical_index import LexicalIndex
+from app.analyzer.meta_store import MetaStore
+
+DIM = 16
+
+
+def _empty_ivf() -> faiss.Index:
+    # 学習済みで空の ivf（学習用のベクトルは登録後にすぐ消す）
+    rng = np.random.default_rng(123)
+    vectors = rng.standard_normal((200, DIM)).astype("float32")
+    faiss.normalize_L2(vectors)
+    ids = np.arange(10**9, 10**9 + len(vectors), dtype="int64")
+    index = build_ivf(vectors, ids, nlist=4)
+    index.remove_ids(faiss.IDSelectorArray(ids))
+    index.nprobe = 4
+    return index
+
+
+@pytest.fixture(params=["flat", "hnsw", "ivf"])
+def index_type(request, monkeypatch):
+    index = _empty_ivf() if request.param == "ivf" else create_index(DIM, request.param)
+    monkeypatch.setattr(im, "index", index)
+    monkeypatch.setattr(im, "meta_data", MetaStore())
+    monkeypatch.setattr(im, "lexical", LexicalIndex())
+    monkeypatch.setattr(im, "deduper", ChunkDeduper())
+    monkeypatch.setattr(im, "doc_manifest", {})
+    monkeypatch.setattr(im, "next_chunk_uid", 0)
+    monkeypatch.setattr(im, "_mmap_path", None)
+    monkeypatch.setattr(im, "_filter_cache", {})
+    assert index_type_of(im.index) == request.param
+    return request.param
+
+
+_RNG = np.random.default_rng(0)
+_VECTORS: dict[str, np.ndarray] = {}
+
+
+def _vector(text: str) -> np.ndarray:
+    # 同じ本文には同じベクトル（本文ごとにランダムな単位ベクトル）
+    if text not in _VECTORS:
+        v = _RNG.standard_normal(DIM).astype("float32")
+        _VECTORS[text] = v / np.linalg.norm(v)
+    return _VECTORS[text]
+
+
+def _text(doc_id: str, i: int, version: int = 1) -> str:
+    return f"{doc_id}の第{i}条 様式{doc_id}{i}v{version} について定める"
+
+
+def _put(doc_id: str, texts: list[str], duplicates: list[tuple[int, str]] = ()) -> int:
+    """
+    文書を登録する（duplicates は Embedding しない重複チャンクの (chunk_id, 本文)）
+    """
+    metas = [{"doc_id": doc_id, "page": 1, "chunk_id": i, "text": t} for i, t in enumerate(texts)]
+    embeddings = np.vstack([_vector(t) for t in texts]) if texts else np.empty((0, DIM), dtype="float32")
+    dups = [({"doc_id": doc_id, "page": 1, "chunk_id": i, "text": t}, fingerprint(t)) for i, t in duplicates]
+    return im.replace_document(doc_id, embeddings, metas, [fingerprint(t) for t in texts], dups)
+
+
+def _dense(text: str, top_k: int = 3) -> list[tuple[str, int]]:
+    query = _vector(text).reshape(1, -1).copy()
+    return [(m["doc_id"], m["chunk_id"]) for m in im.search(query, top_k)[0]]
+
+
+def _lexical(text: str, top_k: int = 3) -> list[tuple[str, int]]:
+    return [(m["doc_id"], m["chunk_id"]) for m in im.search_lexical(text, top_k)]
+
+
+def _hit_texts(text: str, top_k: int = 10) -> set[str]:
+    query = _vector(text).reshape(1, -1).copy()
+    return {m["text"] for m in im.search(query, top_k)[0]} | {m["text"] for m in im.search_lexical(text, top_k)}
+
+
+def test_remove_document_hides_its_chunks(index_type):
+    _put("A", [_text("A", i) for i in range(3)])
+    _put("B", [_text("B", i) for i in range(3)])
+    uids_a = set(im.meta_data.ids_of_docs(["A"]).tolist())
+    assert _dense(_text("A", 1))[0] == ("A", 1)
+    assert _lexical(_text("A", 1))[0] == ("A", 1)
+
+    generation = im.generation
+    assert im.remove_documents(["A"]) == 3
+    assert im.generation > generation
+
+    for i in range(3):
+        assert all(doc_id != "A" for doc_id, _ in _dense(_text("A", i), top_k=6))
+        assert all(doc_id != "A" for doc_id, _ in _lexical(_text("A", i), top_k=6))
+    hits = im.lexical.search(_text("A", 0), 10)
+    assert not uids_a & {uid for uid, _ in hits}
+    assert _dense(_text("B", 2))[0] == ("B", 2)
+    assert _lexical(_text("B", 2))[0] == ("B", 2)
+
+
+def test_replace_document_never_returns_old_chunks(index_type):
+    old = [_text("A", i, version=1) for i in range(3)]
+    new = [_text("A", i, version=2) for i in range(2)]
+    _put("A", old)
+    _put("B", [_text("B", 0)])
+    old_uids = set(im.meta_data.ids_of_docs(["A"]).tolist())
+
+    assert _put("A", new) == 3
+    new_uids = set(im.meta_data.ids_of_docs(["A"]).tolist())
+    # チャンクIDは使い回さない
+    assert not old_uids & new_uids
+
+    for text in old:
+        assert not set(old) & _hit_texts(text)
+    assert _dense(new[1])[0] == ("A", 1)
+    assert _lexical(new[1])[0] == ("A", 1)
+
+    im.compact(force=True)
+    for text in old:
+        assert not set(old) & _hit_texts(text)
+    assert _dense(new[0])[0] == ("A", 0)
+
+
+def test_removing_representative_promotes_duplicate(index_type):
+    shared = "共通の注意事項 この文書は社外に持ち出さないこと"
+    _put("A", [shared, _text("A", 1)])
+    [representative] = im.find_duplicates("B", [fingerprint(shared)])
+    assert representative is not None
+
+    # B の共通チャンクは Embedding せず、A の代表チャンクの参照として登録する
+    _put("B", [_text("B", 1)], duplicates=[(0, shared)])
+    hit = im.search(_vector(shared).reshape(1, -1).copy(), 1)[0][0]
+    assert (hit["doc_id"], hit["chunk_id"]) == ("A", 0)
+    assert hit["duplicates"] == [{"doc_id": "B", "page": 1, "chunk_id": 0}]
+
+    im.remove_documents(["A"])
+    assert _dense(shared)[0] == ("B", 0)
+    assert _lexical(shared)[0] == ("B", 0)
+    # 引き継いだ代表チャンクは、次の重複の参照先になる
+    [promoted] = im.find_duplicates("C", [fingerprint(shared)])
+    assert promoted is not None and promoted != representative
+    assert im.meta_data.get_by_id(promoted)["doc_id"] == "B"
+
+    im.compact(force=True)
+    assert _dense(shared)[0] == ("B", 0)
+    assert _lexical(shared)[0] == ("B", 0)
+
+
+def test_compact_keeps_search_results(index_type, monkeypatch):
+    # 削除のたびに自動で詰め直さないようにして、削除済みの行が残った状態と比べる
+    monkeypatch.setattr(im, "INDEX_COMPACT_RATIO", 1.0)
+    for doc in "ABCD":
+        _put(doc, [_text(doc, i) for i in range(4)])
+    im.remove_documents(["B"])
+    _put("C", [_text("C", i, version=2) for i in range(4)])
+
+    queries = [_text(doc, i, version) for doc in "ABCD" for i in range(4) for version in (1, 2)]
+    before = [(_dense(q, 5), _lexical(q, 5)) for q in queries]
+    assert im.meta_data.dead_rows == 8
+    assert im.compact(force=True)
+    assert im.meta_data.dead_rows == 0
+    after = [(_dense(q, 5), _lexical(q, 5)) for q in queries]
+    assert after == before